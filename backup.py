@@ -1,36 +1,83 @@
 #!/usr/bin/python
 
 import sys
-import xml.etree.ElementTree as ET
 import backuplib
 
 def usageMsg():
 	print 'backup.py - GoodBackup core backup utility (install using install.py)'
 	print 'Usage: backup.py <path-to-config-file>'
+	print '       backup.py --daemon <path-to-config-file>'
+	print '       backup.py --plan <path-to-config-file>'
 	print
 
 def parseArgs(argv):
 	parsedArgs = None
 	if len(argv) == 2 and argv[1] not in ['--h', '-?', '/?', '--help']:
-		parsedArgs = [argv[1]]
+		parsedArgs = [argv[1], None]
+	elif len(argv) == 3 and argv[1] in ['--daemon', '--plan']:
+		parsedArgs = [argv[2], argv[1]]
 	return parsedArgs
 
+def formatDuration(seconds):
+	if seconds < 60:
+		return '{0:.0f}s'.format(seconds)
+	if seconds < 60 * 60:
+		return '{0:.0f}m'.format(seconds / 60)
+	return '{0:.1f}h'.format(seconds / 60 / 60)
+
+def printPlan(plan):
+	approx = '~' if plan['sampled'] else ''
+	print '{0}{1}'.format(plan['name'], ' (due now)' if plan['due'] else '')
+	print '  {0}{1} files, {0}{2} to read{3}'.format(approx, plan['files'], backuplib.formatBytes(plan['bytes']),
+		' (changed since the last run)' if plan['incremental'] else '')
+	if plan['databases'] > 0:
+		print '  {0} databases, {1}'.format(plan['databases'], backuplib.formatBytes(plan['databaseBytes']) if plan['databaseBytes'] is not None else 'size unknown')
+	print '  Estimated archive: {0}{1}'.format(backuplib.formatBytes(plan['bytesOut']),
+		' (compression ratio {0:.2f})'.format(plan['ratio']) if plan['ratio'] is not None else '')
+	print '  Estimated time: {0} (runs every {1})'.format(
+		formatDuration(plan['seconds']) if plan['seconds'] is not None else 'unknown, no throughput recorded yet', formatDuration(plan['intervalSeconds']))
+	if plan['tooSlow']:
+		print '  Warning: this backup will not finish within its interval.'
+
 def main(argv):
 	# Read cmd arguments.
 	parsedArgs = parseArgs(argv)
 	if parsedArgs is None:
 		usageMsg()
 		return
-	
+
+	# In plan mode, estimate what each target's backup would take without writing anything. The
+	# config cache isn't used, since loading through it writes the cache.
+	if parsedArgs[1] == '--plan':
+		config = backuplib.loadConfig(parsedArgs[0])
+		if not config.isValid():
+			for error in config.errors:
+				print 'Config error: ' + error
+			return
+		for plan in backuplib.planBackup(config):
+			printPlan(plan)
+		return
+
+	# In daemon mode, stay resident and back up each target whenever it falls due.
+	if parsedArgs[1] == '--daemon':
+		try:
+			daemon = backuplib.Daemon(parsedArgs[0])
+		except ValueError as e:
+			backuplib.log('{0}. Aborting.'.format(e))
+			return
+		daemon.run()
+		return
+
 	# Read configuration file.
-	tree = ET.parse(parsedArgs[0])
-	root = tree.getroot()
+	config = backuplib.loadCachedConfig(parsedArgs[0])
 
 	# Do the backup tasks.
 	backuplib.log('********Starting backup routine.********')
-	if backuplib.validateConfig(root):
-		backuplib.doBackup(root)
+	if config.isValid():
+		backuplib.doBackup(config)
 	else:
+		for error in config.errors:
+			backuplib.log('Config error: ' + error)
 		backuplib.log('Invalid configuration file. Aborting backup.')
 	backuplib.log('********Backup routine complete.********')
 	
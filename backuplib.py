@@ -5,6 +5,37 @@ import os
 import xml.etree.ElementTree as ET
 import time
 import datetime
+import StringIO
+import zlib
+import collections
+import json
+import Queue
+import threading
+import hashlib
+import string
+import random
+import fcntl
+import gzip
+import stat
+import fnmatch
+import marshal
+import itertools
+import re
+import errno
+import bisect
+import heapq
+import struct
+import signal
+import pwd
+import grp
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 #
 # XML helper functions.
@@ -65,115 +96,4230 @@ def validateAttributeReference(root, xpathReferer, attrReferer, xpathReferred, a
 	return True
 
 #
-# Backup helper methods.
+# Metrics.
 #
 
-def dumpDatabase(dbname, username, password, outfile):
-	os.system("mysqldump --user={1} --password={2} --single-transaction --add-drop-database --add-drop-table --hex-blob {0} > {3}".format(dbname, username, password, outfile))
+METRICS_LOG = 'goodbackup-metrics.jsonl'
+METRICS_PROM = 'goodbackup.prom'
 
-def log(line):
-	startTime = time.time()
-	timestamp = datetime.datetime.fromtimestamp(startTime).strftime('%Y-%m-%d %H:%M:%S.%f')
-	print '[{0}] {1}'.format(timestamp, line)
-	sys.stdout.flush()
+class PhaseTimer(object):
+	def __init__(self, phases, name):
+		self.phases = phases
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+
+	def __exit__(self, excType, excValue, traceback):
+		self.phases[self.name] += time.time() - self.start
+
+class TargetMetrics(object):
+	# Phase durations and counters for one target's backup. Phases may nest: 'archive' includes
+	# the 'enumerate' and 'compress' time spent while archiving.
+	enabled = True
+
+	def __init__(self, name):
+		self.name = name
+		self.phases = collections.defaultdict(float)
+		self.counters = collections.defaultdict(int)
+
+	def phase(self, name):
+		return PhaseTimer(self.phases, name)
+
+	def add(self, counter, value=1):
+		self.counters[counter] += value
+
+	def timeIterator(self, iterable, phaseName):
+		# Charges the time spent producing each item to a phase, e.g. walking a folder.
+		iterator = iter(iterable)
+		while True:
+			start = time.time()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				self.phases[phaseName] += time.time() - start
+				return
+			self.phases[phaseName] += time.time() - start
+			yield item
+
+class NullPhaseTimer(object):
+	def __enter__(self):
+		pass
+
+	def __exit__(self, excType, excValue, traceback):
+		pass
+
+class NullMetrics(object):
+	# Stands in for TargetMetrics when metrics are disabled; nothing is wrapped or timed.
+	enabled = False
+	nullPhase = NullPhaseTimer()
+
+	def phase(self, name):
+		return self.nullPhase
+
+	def add(self, counter, value=1):
+		pass
+
+	def timeIterator(self, iterable, phaseName):
+		return iterable
+
+NO_METRICS = NullMetrics()
+
+class TimingWriter(object):
+	# Charges the time spent in the wrapped file's write() to a phase.
+	def __init__(self, fileobj, metrics, phaseName):
+		self.fileobj = fileobj
+		self.metrics = metrics
+		self.phaseName = phaseName
+
+	def write(self, data):
+		with self.metrics.phase(self.phaseName):
+			self.fileobj.write(data)
+
+def metricsRecord(job, metrics):
+	result = job.result or {'bytesIn': 0, 'bytesOut': 0, 'seconds': 0, 'throttleSeconds': 0, 'success': False}
+	return {
+		'time': job.finishTime,
+		'target': job.name,
+		'success': result['success'],
+		'seconds': job.wallSeconds,
+		'queueSeconds': job.queueSeconds,
+		'bytesIn': result['bytesIn'],
+		'bytesOut': result['bytesOut'],
+		'compressionRatio': result['bytesIn'] / float(result['bytesOut']) if result['bytesOut'] > 0 else None,
+		'throttleSeconds': result['throttleSeconds'],
+		'files': metrics.counters['files'],
+		'databases': metrics.counters['databases'],
+		'dumpBytes': metrics.counters['dumpBytes'],
+		'errors': metrics.counters['errors'] + (0 if job.result is not None else 1),
+		'phases': dict(metrics.phases),
+	}
+
+def appendMetrics(outputDir, records):
+	with open(os.path.join(outputDir, METRICS_LOG), 'a') as metricsFile:
+		for record in records:
+			metricsFile.write(json.dumps(record, sort_keys=True) + '\n')
+
+def promLabel(value):
+	return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+# Prometheus metric name -> (help text, record field).
+PROM_GAUGES = [
+	('goodbackup_target_success', 'Whether the last backup of the target succeeded.', 'success'),
+	('goodbackup_target_last_run_timestamp_seconds', 'When the last backup of the target finished.', 'time'),
+	('goodbackup_target_duration_seconds', 'Wall time of the last backup of the target.', 'seconds'),
+	('goodbackup_target_queue_seconds', 'Time the last backup of the target waited to start.', 'queueSeconds'),
+	('goodbackup_target_bytes_in', 'Bytes read by the last backup of the target.', 'bytesIn'),
+	('goodbackup_target_bytes_out', 'Bytes written by the last backup of the target.', 'bytesOut'),
+	('goodbackup_target_compression_ratio', 'Bytes in per byte out for the last backup of the target.', 'compressionRatio'),
+	('goodbackup_target_throttle_seconds', 'Time the last backup of the target spent held back by I/O limits.', 'throttleSeconds'),
+	('goodbackup_target_files', 'Files archived by the last backup of the target.', 'files'),
+	('goodbackup_target_dump_bytes', 'Database dump bytes archived by the last backup of the target.', 'dumpBytes'),
+	('goodbackup_target_errors', 'Errors and warnings during the last backup of the target.', 'errors'),
+]
+
+def writePrometheusMetrics(outputDir, records):
+	# Writes the latest record of every target in the node_exporter textfile collector format.
+	# The file is replaced atomically so a scrape never sees it half-written.
+	lines = []
+	for metricName, helpText, field in PROM_GAUGES:
+		lines.append('# HELP {0} {1}'.format(metricName, helpText))
+		lines.append('# TYPE {0} gauge'.format(metricName))
+		for name in sorted(records):
+			if records[name].get(field) is not None:
+				lines.append('{0}{{target={1}}} {2}'.format(metricName, promLabel(name), float(records[name][field])))
+	lines.append('# HELP goodbackup_target_phase_seconds Time spent in each phase of the last backup of the target.')
+	lines.append('# TYPE goodbackup_target_phase_seconds gauge')
+	for name in sorted(records):
+		for phase, seconds in sorted(records[name]['phases'].items()):
+			lines.append('goodbackup_target_phase_seconds{{target={0},phase={1}}} {2}'.format(promLabel(name), promLabel(phase), seconds))
+	tempPath = os.path.join(outputDir, METRICS_PROM + '.tmp')
+	with open(tempPath, 'w') as promFile:
+		promFile.write('\n'.join(lines) + '\n')
+	os.rename(tempPath, os.path.join(outputDir, METRICS_PROM))
 
 #
-# Public API methods.
+# Throttling.
 #
 
-def validateConfig(root):
-	# Check top-level sections are intact.
-	if root.tag != 'settings' \
-		or not validateUniqueSection(root, './credentials') \
-		or not validateUniqueSection(root, './targets') \
-		or not validateRequiredSection(root, './output') \
-		or not validateUniqueSection(root, './output') \
-		or not validateRequiredAttribute(root, './output', 'path'):
-		return False
-	
-	# Check 'credentials' section is well-formed, with no duplicates.
-	if not validateRequiredAttribute(root, './credentials/credential', 'name') \
-		or not validateRequiredAttribute(root, './credentials/credential', 'username') \
-		or not validateRequiredAttribute(root, './credentials/credential', 'password') \
-		or not validateUniqueAttribute(root, './credentials/credential', 'name'):
-		return False
-	
-	# Check 'targets' section is well-formed, with no duplicates.
-	if not validateRequiredAttribute(root, './targets/target', 'name') \
-		or not validateIntAttribute(root, './targets/target', 'intervalHours') \
-		or not validateRequiredAttribute(root, './targets/target/folder', 'path') \
-		or not validateRequiredAttribute(root, './targets/target/file', 'path') \
-		or not validateRequiredAttribute(root, './targets/target/database', 'name') \
-		or not validateRequiredAttribute(root, './targets/target/database', 'credential') \
-		or not validateUniqueAttribute(root, './targets/target', 'name'):
+class TokenBucket(object):
+	# Limits a rate (bytes per second, say) shared by any number of threads. Callers may overdraw
+	# the bucket, then sleep until it refills, so large requests are throttled as well as small ones.
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.capacity = float(burst or rate)
+		self.tokens = self.capacity
+		self.last = time.time()
+		self.lock = threading.Lock()
+
+	def consume(self, amount):
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate) - amount
+			self.last = now
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait > 0:
+			time.sleep(wait)
+
+def diskQueueDepth():
+	# Requests currently in flight across all whole disks, from /proc/diskstats (Linux only).
+	try:
+		disks = set(os.listdir('/sys/block'))
+		with open('/proc/diskstats') as statsFile:
+			return sum(int(fields[11]) for fields in (line.split() for line in statsFile) if len(fields) >= 12 and fields[2] in disks)
+	except (IOError, OSError, ValueError):
+		return 0
+
+# How often the adaptive throttle samples system load, and the shortest and longest pause it
+# takes per busy sample. Pauses are capped rather than waiting for the load to drop, so a host
+# that is always busy slows its backups down (to a fifth, at worst) but still gets them.
+LOAD_SAMPLE_SECONDS = 1.0
+LOAD_BACKOFF_SECONDS = 0.5
+LOAD_BACKOFF_MAX_SECONDS = 4.0
+
+class Throttle(object):
+	# Meters one direction of a target's I/O (reads or writes) through any number of token
+	# buckets, typically the target's own and one shared by all targets. With load limits it also
+	# backs off while the load average or disk queue depth is above them. Counts the bytes and the
+	# time spent waiting, so the effective throughput can be reported.
+	def __init__(self, buckets=(), maxLoad=None, maxQueue=None):
+		self.buckets = [bucket for bucket in buckets if bucket is not None]
+		self.maxLoad = maxLoad
+		self.maxQueue = maxQueue
+		self.bytes = 0
+		self.waitSeconds = 0.0
+		self.nextSample = 0
+		self.pause = 0.0
+		self.resumeAt = 0
+		self.lock = threading.Lock()
+
+	@property
+	def enabled(self):
+		return len(self.buckets) > 0 or self.maxLoad is not None or self.maxQueue is not None
+
+	def isBusy(self):
+		if self.maxLoad is not None and os.getloadavg()[0] > self.maxLoad:
+			return True
+		return self.maxQueue is not None and diskQueueDepth() > self.maxQueue
+
+	def backOff(self):
+		# Pauses all I/O through the throttle for a while after each sample. The pause doubles
+		# for every busy sample in a row, up to LOAD_BACKOFF_MAX_SECONDS, and halves for every
+		# calm one, so the rate drops while the system is busy and recovers gradually after.
+		busy = self.isBusy()
+		with self.lock:
+			if busy:
+				self.pause = min(max(self.pause * 2, LOAD_BACKOFF_SECONDS), LOAD_BACKOFF_MAX_SECONDS)
+			else:
+				self.pause = self.pause / 2 if self.pause > LOAD_BACKOFF_SECONDS else 0.0
+			self.resumeAt = time.time() + self.pause
+			self.nextSample = self.resumeAt + LOAD_SAMPLE_SECONDS
+
+	def consume(self, amount):
+		start = time.time()
+		for bucket in self.buckets:
+			bucket.consume(amount)
+		# Load is only sampled now and then; reading /proc for every block would cost more than it saves.
+		if self.maxLoad is not None or self.maxQueue is not None:
+			with self.lock:
+				sample = start >= self.nextSample
+				if sample:
+					self.nextSample = start + LOAD_SAMPLE_SECONDS
+			if sample:
+				self.backOff()
+			wait = self.resumeAt - time.time()
+			if wait > 0:
+				time.sleep(wait)
+		with self.lock:
+			self.bytes += amount
+			self.waitSeconds += time.time() - start
+
+# ioClass attribute -> ionice arguments.
+IO_CLASSES = {
+	'idle': ['-c', '3'],
+	'best-effort': ['-c', '2', '-n', '7'],
+}
+
+def priorityCommand(niceLevel=None, ioClass=None):
+	# Command prefix that runs a child process at a lower CPU and/or I/O priority.
+	prefix = []
+	if ioClass is not None:
+		prefix += ['ionice'] + IO_CLASSES[ioClass]
+	if niceLevel is not None:
+		prefix += ['nice', '-n', str(niceLevel)]
+	return prefix
+
+#
+# Encryption.
+#
+
+# An encrypted file starts with a magic string and a cipher id, followed by frames of
+# <4-byte big-endian length><12-byte nonce><ciphertext with 16-byte tag>. Each frame's number and
+# whether it is the last one are authenticated with it, so frames cannot be reordered, dropped or
+# cut off unnoticed. The last frame of an archive is always empty.
+ENCRYPTION_MAGIC = 'GBENC1'
+ENCRYPTED_EXTENSION = '.enc'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+FRAME_LENGTH = struct.Struct('>I')
+FRAME_AAD = struct.Struct('>Q?')
+
+# Cipher name -> (id byte in the file header, AEAD class in cryptography.hazmat.primitives.ciphers.aead).
+CIPHERS = {
+	'aes-gcm': ('\x01', 'AESGCM'),
+	'chacha20-poly1305': ('\x02', 'ChaCha20Poly1305'),
+}
+
+def isEncryptionAvailable():
+	try:
+		import cryptography.hazmat.primitives.ciphers.aead
+		return True
+	except ImportError:
 		return False
 
-	# Check each target for duplicate entities.
-	for target in root.findall('./targets/target'):
-		if not validateUniqueAttribute(target, './folder', 'path') \
-			or not validateUniqueAttribute(target, './file', 'path') \
-			or not validateUniqueAttribute(target, './database', 'name'):
+def loadEncryptionKey(path):
+	# A key file holds 32 random bytes, raw or hex-encoded.
+	with open(path, 'rb') as keyFile:
+		key = keyFile.read()
+	if len(key.strip()) == 64 and all(c in string.hexdigits for c in key.strip()):
+		key = key.strip().decode('hex')
+	if len(key) != 32:
+		raise ValueError('Key file {0} must hold 32 bytes, raw or hex-encoded.'.format(path))
+	return key
+
+class BlockCipher(object):
+	# Seals and opens frames with one key. Frames are independent, so blocks can be sealed in
+	# parallel (OpenSSL releases the GIL) and opened in any order.
+	def __init__(self, key, cipher='aes-gcm'):
+		from cryptography.hazmat.primitives.ciphers import aead
+		self.name = cipher
+		self.keyId = hashlib.sha256(key).hexdigest()[:16]
+		self.aead = getattr(aead, CIPHERS[cipher][1])(key)
+		self.header = ENCRYPTION_MAGIC + CIPHERS[cipher][0]
+
+	def seal(self, number, data, last=False):
+		nonce = os.urandom(NONCE_SIZE)
+		sealed = self.aead.encrypt(nonce, data, FRAME_AAD.pack(number, last))
+		return FRAME_LENGTH.pack(len(sealed)) + nonce + sealed
+
+	def open(self, number, frame, last=False):
+		from cryptography.exceptions import InvalidTag
+		nonceEnd = FRAME_LENGTH.size + NONCE_SIZE
+		try:
+			return self.aead.decrypt(frame[FRAME_LENGTH.size:nonceEnd], frame[nonceEnd:], FRAME_AAD.pack(number, last))
+		except InvalidTag:
+			raise IOError('Frame {0} failed authentication; the key is wrong or the data is damaged.'.format(number))
+
+	def sealFile(self, data):
+		return self.header + self.seal(0, data, True)
+
+	def openFile(self, data):
+		return self.open(0, data[len(self.header):], True)
+
+def cipherForHeader(key, header):
+	for name, (cipherId, className) in CIPHERS.items():
+		if header == ENCRYPTION_MAGIC + cipherId:
+			return BlockCipher(key, name)
+	raise IOError('Not an encrypted file.')
+
+def isEncryptedArchive(path):
+	return path.endswith(ENCRYPTED_EXTENSION)
+
+class DecryptingReader(object):
+	# A seekable, read-only view of the plaintext of an encrypted file. The frames are located
+	# from their length prefixes alone, then decrypted one at a time as they are read, so memory
+	# use stays at one frame and GzipFile and tarfile can read through it as if it were a file.
+	def __init__(self, fileobj, key):
+		self.fileobj = fileobj
+		self.cipher = cipherForHeader(key, fileobj.read(len(ENCRYPTION_MAGIC) + 1))
+		self.frames = []
+		fileOffset = len(self.cipher.header)
+		plainOffset = 0
+		while True:
+			prefix = fileobj.read(FRAME_LENGTH.size)
+			if len(prefix) < FRAME_LENGTH.size:
+				break
+			frameLength = FRAME_LENGTH.size + NONCE_SIZE + FRAME_LENGTH.unpack(prefix)[0]
+			self.frames.append((plainOffset, fileOffset, frameLength))
+			plainOffset += frameLength - FRAME_LENGTH.size - NONCE_SIZE - TAG_SIZE
+			fileOffset += frameLength
+			fileobj.seek(fileOffset)
+		self.frameStarts = [frame[0] for frame in self.frames]
+		self.size = plainOffset
+		self.position = 0
+		self.cachedFrame = (None, None)
+		# Opening the last frame proves nothing was cut off the end.
+		if len(self.frames) == 0 or len(prefix) > 0:
+			raise IOError('Encrypted file is truncated.')
+		self.readFrame(len(self.frames) - 1)
+
+	def readFrame(self, number):
+		if self.cachedFrame[0] != number:
+			plainOffset, fileOffset, frameLength = self.frames[number]
+			self.fileobj.seek(fileOffset)
+			frame = self.fileobj.read(frameLength)
+			if len(frame) < frameLength:
+				raise IOError('Encrypted file is truncated.')
+			self.cachedFrame = (number, self.cipher.open(number, frame, number == len(self.frames) - 1))
+		return self.cachedFrame[1]
+
+	def read(self, size=-1):
+		if size < 0:
+			size = self.size - self.position
+		pieces = []
+		while size > 0 and self.position < self.size:
+			number = bisect.bisect_right(self.frameStarts, self.position) - 1
+			start = self.position - self.frames[number][0]
+			data = self.readFrame(number)[start:start + size]
+			pieces.append(data)
+			self.position += len(data)
+			size -= len(data)
+		return ''.join(pieces)
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.position
+		elif whence == 2:
+			offset += self.size
+		self.position = max(0, offset)
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		self.fileobj.close()
+
+#
+# Storage backends.
+#
+
+PARTIAL_EXTENSION = '.partial'
+
+class LocalStorage(object):
+	# Keeps archives in a folder on the local filesystem. An archive is written under a '.partial'
+	# name and only renamed into place once it is committed, so a run that dies never leaves a
+	# half-written archive that looks like a good one.
+	def __init__(self, path):
+		self.path = path
+
+	def describe(self, name):
+		return os.path.join(self.path, name)
+
+	def partialPath(self, name):
+		return os.path.join(self.path, name + PARTIAL_EXTENSION)
+
+	def create(self, name):
+		return open(self.partialPath(name), 'wb')
+
+	def reopen(self, name):
+		# Opens a partial archive for reading and appending, to resume writing it.
+		return open(self.partialPath(name), 'r+b')
+
+	def commit(self, name):
+		fd = os.open(self.partialPath(name), os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+		os.rename(self.partialPath(name), os.path.join(self.path, name))
+
+	def put(self, name, data):
+		# Replaces a small file atomically.
+		tempPath = os.path.join(self.path, name + '.tmp')
+		with open(tempPath, 'wb') as outfile:
+			outfile.write(data)
+		os.rename(tempPath, os.path.join(self.path, name))
+
+	def delete(self, name):
+		try:
+			os.remove(os.path.join(self.path, name))
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+
+S3_DEFAULT_PART_SIZE = 16 * 1024 * 1024
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_DEFAULT_WORKERS = 4
+S3_MAX_ATTEMPTS = 4
+S3_TIMEOUT_SECONDS = 120
+
+def s3Quote(value, safe=''):
+	import urllib
+	return urllib.quote(value, safe='-_.~' + safe)
+
+def canonicalQuery(query):
+	return '&'.join('{0}={1}'.format(s3Quote(name), s3Quote(value)) for name, value in sorted(query))
+
+def signV4(method, path, query, headers, payloadHash, accessKey, secretKey, region, service='s3'):
+	# Returns the Authorization header for a request under AWS Signature Version 4. Every header
+	# given is signed; 'headers' must include host and x-amz-date.
+	import hmac
+	canonicalHeaders = sorted((name.lower(), ' '.join(str(value).split())) for name, value in headers.items())
+	amzDate = dict(canonicalHeaders)['x-amz-date']
+	scope = '{0}/{1}/{2}/aws4_request'.format(amzDate[:8], region, service)
+	signedHeaders = ';'.join(name for name, value in canonicalHeaders)
+	canonicalRequest = '\n'.join([
+		method,
+		s3Quote(path, '/'),
+		canonicalQuery(query),
+		''.join('{0}:{1}\n'.format(name, value) for name, value in canonicalHeaders),
+		signedHeaders,
+		payloadHash,
+	])
+	stringToSign = '\n'.join(['AWS4-HMAC-SHA256', amzDate, scope, hashlib.sha256(canonicalRequest).hexdigest()])
+	signingKey = 'AWS4' + secretKey
+	for part in [amzDate[:8], region, service, 'aws4_request']:
+		signingKey = hmac.new(signingKey, part, hashlib.sha256).digest()
+	return 'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+		accessKey, scope, signedHeaders, hmac.new(signingKey, stringToSign, hashlib.sha256).hexdigest())
+
+class S3Client(object):
+	# Just enough of the S3 API for uploading backups, with path-style addressing so it also works
+	# against MinIO and similar servers. Requests share a pool of persistent connections, and are
+	# retried on connection errors and 5xx responses.
+	def __init__(self, endpoint, bucket, region='us-east-1', accessKey=None, secretKey=None, connections=S3_DEFAULT_WORKERS):
+		import urlparse
+		parsed = urlparse.urlparse(endpoint)
+		self.secure = parsed.scheme == 'https'
+		self.host = parsed.netloc
+		self.bucket = bucket
+		self.region = region
+		self.accessKey = accessKey or os.environ.get('AWS_ACCESS_KEY_ID', '')
+		self.secretKey = secretKey or os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+		self.connections = Queue.Queue()
+		for i in range(connections):
+			self.connections.put(None)
+
+	def connect(self):
+		import httplib
+		if self.secure:
+			return httplib.HTTPSConnection(self.host, timeout=S3_TIMEOUT_SECONDS)
+		return httplib.HTTPConnection(self.host, timeout=S3_TIMEOUT_SECONDS)
+
+	def request(self, method, key, query=(), body='', extraHeaders=None):
+		# Returns (response headers, response body). Blocks while every connection is in use.
+		import httplib
+		import socket
+		path = '/' + self.bucket + '/' + key
+		payloadHash = hashlib.sha256(body).hexdigest()
+		error = None
+		for attempt in range(S3_MAX_ATTEMPTS):
+			if attempt > 0:
+				time.sleep(0.5 * 2 ** attempt)
+			headers = dict(extraHeaders or {})
+			headers.update({'host': self.host, 'x-amz-date': time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), 'x-amz-content-sha256': payloadHash})
+			headers['authorization'] = signV4(method, path, query, headers, payloadHash, self.accessKey, self.secretKey, self.region)
+			connection = self.connections.get()
+			try:
+				connection = connection or self.connect()
+				connection.request(method, s3Quote(path, '/') + ('?' + canonicalQuery(query) if query else ''), body, headers)
+				response = connection.getresponse()
+				data = response.read()
+			except (httplib.HTTPException, socket.error) as e:
+				if connection is not None:
+					connection.close()
+				connection = None
+				error = e
+				continue
+			finally:
+				self.connections.put(connection)
+			if response.status >= 500:
+				error = 'HTTP {0}'.format(response.status)
+				continue
+			if response.status >= 300:
+				raise IOError('S3 {0} of {1} failed with HTTP {2}: {3}'.format(method, key, response.status, data[:200]))
+			return (dict(response.getheaders()), data)
+		raise IOError('S3 {0} of {1} failed after {2} attempts: {3}'.format(method, key, S3_MAX_ATTEMPTS, error))
+
+	def putObject(self, key, data):
+		self.request('PUT', key, body=data)
+
+	def deleteObject(self, key):
+		self.request('DELETE', key)
+
+	def createMultipartUpload(self, key):
+		headers, data = self.request('POST', key, [('uploads', '')])
+		return findXmlText(data, 'UploadId')
+
+	def uploadPart(self, key, uploadId, number, data):
+		headers, body = self.request('PUT', key, [('partNumber', str(number)), ('uploadId', uploadId)], data)
+		return headers['etag']
+
+	def completeMultipartUpload(self, key, uploadId, parts):
+		# 'parts' lists the (part number, etag) of every part uploaded.
+		parts = ''.join('<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(number, etag) for number, etag in sorted(parts))
+		headers, data = self.request('POST', key, [('uploadId', uploadId)], '<CompleteMultipartUpload>' + parts + '</CompleteMultipartUpload>')
+		# S3 may report a failure in the body of a 200 response.
+		if findXmlText(data, 'Code') is not None:
+			raise IOError('S3 could not complete the upload of {0}: {1}'.format(key, findXmlText(data, 'Code')))
+
+	def abortMultipartUpload(self, key, uploadId):
+		self.request('DELETE', key, [('uploadId', uploadId)])
+
+def findXmlText(data, tag):
+	# The text of the first element named 'tag' in an S3 response, ignoring namespaces.
+	for elem in ET.fromstring(data).iter():
+		if elem.tag == tag or elem.tag.endswith('}' + tag):
+			return elem.text
+	return None
+
+class S3UploadWriter(object):
+	# Streams an object to S3 while it is being produced. The data is cut into parts, which are
+	# uploaded on a thread pool as more is written; at most 'workers' parts are in flight, plus the
+	# one being filled. An object smaller than one part is sent with a single PUT. Once a part has
+	# failed, the upload can only be aborted.
+	def __init__(self, client, key, partSize=S3_DEFAULT_PART_SIZE, workers=S3_DEFAULT_WORKERS):
+		from multiprocessing.pool import ThreadPool
+		self.client = client
+		self.key = key
+		self.partSize = partSize
+		self.workers = workers
+		self.buffer = []
+		self.bufferSize = 0
+		self.uploadId = None
+		self.partCount = 0
+		self.pending = collections.deque()
+		self.parts = []
+		self.failed = False
+		self.pool = ThreadPool(workers)
+
+	def write(self, data):
+		if self.failed:
+			raise IOError('Upload of {0} already failed.'.format(self.key))
+		self.buffer.append(data)
+		self.bufferSize += len(data)
+		if self.bufferSize >= self.partSize:
+			data = ''.join(self.buffer)
+			offset = 0
+			while len(data) - offset >= self.partSize:
+				self.submit(data[offset:offset + self.partSize])
+				offset += self.partSize
+			self.buffer = [data[offset:]]
+			self.bufferSize = len(data) - offset
+
+	def submit(self, part):
+		if self.uploadId is None:
+			self.uploadId = self.client.createMultipartUpload(self.key)
+		self.partCount += 1
+		self.pending.append((self.partCount, self.pool.apply_async(self.client.uploadPart, (self.key, self.uploadId, self.partCount, part))))
+		while len(self.pending) > self.workers:
+			self.collect()
+
+	def collect(self):
+		number, result = self.pending.popleft()
+		try:
+			self.parts.append((number, result.get()))
+		except:
+			self.failed = True
+			raise
+
+	def close(self):
+		try:
+			if self.failed:
+				raise IOError('Upload of {0} already failed.'.format(self.key))
+			if self.uploadId is None:
+				self.client.putObject(self.key, ''.join(self.buffer))
+			else:
+				if self.bufferSize > 0:
+					self.submit(''.join(self.buffer))
+				while len(self.pending) > 0:
+					self.collect()
+				self.client.completeMultipartUpload(self.key, self.uploadId, self.parts)
+		except:
+			self.abort()
+			raise
+		self.uploadId = None
+		self.buffer = []
+		self.pool.close()
+		self.pool.join()
+
+	def abort(self):
+		# Gives up on the upload once the parts in flight are done, so none of the parts uploaded
+		# so far are left behind, taking up (billed) space.
+		self.buffer = []
+		self.pool.terminate()
+		self.pool.join()
+		if self.uploadId is not None:
+			try:
+				self.client.abortMultipartUpload(self.key, self.uploadId)
+			except IOError:
+				pass
+			self.uploadId = None
+
+class S3Storage(object):
+	# Keeps archives in an S3-compatible bucket, under an optional key prefix.
+	def __init__(self, client, prefix='', partSize=S3_DEFAULT_PART_SIZE, workers=S3_DEFAULT_WORKERS):
+		self.client = client
+		self.prefix = prefix
+		self.partSize = partSize
+		self.workers = workers
+
+	def describe(self, name):
+		return 's3://{0}/{1}{2}'.format(self.client.bucket, self.prefix, name)
+
+	def create(self, name):
+		return S3UploadWriter(self.client, self.prefix + name, self.partSize, self.workers)
+
+	def commit(self, name):
+		# Multipart uploads only become visible once they are complete.
+		pass
+
+	def put(self, name, data):
+		self.client.putObject(self.prefix + name, data)
+
+	def delete(self, name):
+		self.client.deleteObject(self.prefix + name)
+
+def openStorage(config):
+	# Archives go to the output folder, unless <output> has an <s3> element.
+	s3 = config.output.find('./s3')
+	if s3 is None:
+		return LocalStorage(config.output.get('path'))
+	workers = int(s3.get('uploadWorkers', S3_DEFAULT_WORKERS))
+	client = S3Client(
+		s3.get('endpoint', 'https://s3.{0}.amazonaws.com'.format(s3.get('region', 'us-east-1'))),
+		s3.get('bucket'),
+		s3.get('region', 'us-east-1'),
+		s3.get('accessKey'),
+		s3.get('secretKey'),
+		workers)
+	return S3Storage(client, s3.get('prefix', ''), int(s3.get('partSize', S3_DEFAULT_PART_SIZE)), workers)
+
+#
+# Large and sparse files.
+#
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+POSIX_FADV_SEQUENTIAL = 2
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+LARGE_READ_SIZE = 1024 * 1024
+SPARSE_SLOTS = 4
+SPARSE_EXTENSION_SLOTS = 21
+
+fadvise = {}
+
+def adviseSequential(fd):
+	# Tells the kernel a file will be read front to back, so it reads further ahead and drops
+	# pages behind. Python 2 has no os.posix_fadvise, so it is called through libc; where neither
+	# is there, this does nothing.
+	if hasattr(os, 'posix_fadvise'):
+		os.posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+		return
+	if 'call' not in fadvise:
+		try:
+			import ctypes
+			import ctypes.util
+			call = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).posix_fadvise
+			call.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+			fadvise['call'] = call
+		except (ImportError, OSError, AttributeError):
+			fadvise['call'] = None
+	if fadvise['call'] is not None:
+		fadvise['call'](fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+def dataSegments(fd, size):
+	# Returns the (offset, length) runs of a file's first 'size' bytes that hold data, skipping
+	# holes, or None if the filesystem can't tell (no SEEK_DATA/SEEK_HOLE). Holes are never
+	# allocated, so they are never read.
+	segments = []
+	offset = 0
+	try:
+		while offset < size:
+			try:
+				start = os.lseek(fd, offset, SEEK_DATA)
+			except OSError as e:
+				# Nothing but a hole up to the end of the file.
+				if e.errno == errno.ENXIO:
+					break
+				raise
+			if start >= size:
+				break
+			end = min(os.lseek(fd, start, SEEK_HOLE), size)
+			segments.append((start, end - start))
+			offset = end
+	except OSError:
+		return None
+	finally:
+		os.lseek(fd, 0, os.SEEK_SET)
+	return segments
+
+class SegmentReader(object):
+	# Reads the data runs of a file back to back, in reads of up to LARGE_READ_SIZE aligned to
+	# that size, and hands them out in whatever sizes tarfile asks for. A file that shrank while
+	# being read is padded with zeros, so the runs keep their recorded lengths.
+	def __init__(self, fileobj, segments, readSize=LARGE_READ_SIZE):
+		self.fileobj = fileobj
+		self.segments = collections.deque((offset, length) for offset, length in segments if length > 0)
+		self.readSize = readSize
+		self.buffer = ''
+		self.position = 0
+		self.truncated = False
+
+	def fill(self):
+		if len(self.segments) == 0:
 			return False
+		offset, length = self.segments[0]
+		chunkSize = min(length, self.readSize - offset % self.readSize)
+		self.fileobj.seek(offset)
+		data = self.fileobj.read(chunkSize)
+		if len(data) < chunkSize:
+			data += '\0' * (chunkSize - len(data))
+			self.truncated = True
+		if chunkSize == length:
+			self.segments.popleft()
+		else:
+			self.segments[0] = (offset + chunkSize, length - chunkSize)
+		self.buffer = data
+		self.position = 0
+		return True
+
+	def read(self, size=-1):
+		chunks = []
+		wanted = size if size >= 0 else sys.maxint
+		while wanted > 0:
+			if self.position == len(self.buffer) and not self.fill():
+				break
+			data = self.buffer[self.position:self.position + wanted]
+			self.position += len(data)
+			wanted -= len(data)
+			chunks.append(data)
+		return ''.join(chunks)
+
+def sparseHeader(tarinfo, realSize, segments):
+	# The header of an old GNU sparse member (what 'tar --sparse' writes): the regular header with
+	# the first runs and the file's real size in it, followed by extension blocks for the rest of
+	# the runs. The member's data is just the runs, back to back. Unused slots are filled with
+	# empty runs at the end of the file, as Python 2's tarfile reads a blank slot as a run at 0.
+	import tarfile
+	def packRuns(runs):
+		return ''.join(tarfile.itn(offset, 12, tarfile.GNU_FORMAT) + tarfile.itn(length, 12, tarfile.GNU_FORMAT) for offset, length in runs)
+
+	tarinfo.type = tarfile.GNUTYPE_SPARSE
+	header = tarinfo.tobuf(tarfile.GNU_FORMAT)
+	runs = [(offset, length) for offset, length in segments] + [(realSize, 0)]
+	extensions = (max(0, len(runs) - SPARSE_SLOTS) + SPARSE_EXTENSION_SLOTS - 1) // SPARSE_EXTENSION_SLOTS
+	runs += [(realSize, 0)] * (SPARSE_SLOTS + extensions * SPARSE_EXTENSION_SLOTS - len(runs))
+	block = header[-tarfile.BLOCKSIZE:]
+	block = block[:386] + packRuns(runs[:SPARSE_SLOTS]) + chr(1 if extensions else 0) + tarfile.itn(realSize, 12, tarfile.GNU_FORMAT) + block[495:]
+	block = block[:148] + '%06o\0' % tarfile.calc_chksums(block)[0] + block[155:]
+	blocks = [header[:-tarfile.BLOCKSIZE], block]
+	for number in range(extensions):
+		start = SPARSE_SLOTS + number * SPARSE_EXTENSION_SLOTS
+		blocks.append(packRuns(runs[start:start + SPARSE_EXTENSION_SLOTS]) + chr(1 if number < extensions - 1 else 0) + '\0' * 7)
+	return ''.join(blocks)
+
+def writeSegments(outfile, chunks, segments, size):
+	# The reverse of SegmentReader: writes data runs read back to back from 'chunks' at their
+	# offsets, leaving the holes between them unallocated.
+	segments = collections.deque((offset, length) for offset, length in segments if length > 0)
+	for data in chunks:
+		position = 0
+		while position < len(data):
+			offset, length = segments[0]
+			piece = data[position:position + length]
+			outfile.seek(offset)
+			outfile.write(piece)
+			position += len(piece)
+			if len(piece) == length:
+				segments.popleft()
+			else:
+				segments[0] = (offset + len(piece), length - len(piece))
+	outfile.truncate(size)
+
+#
+# Archive writer.
+#
+
+class ArchiveWriteError(Exception):
+	# The archive itself could not be written. Unlike a source file that can't be read, this
+	# spoils the whole archive, so it is deliberately not an IOError: the handlers that skip
+	# unreadable sources must not swallow it.
+	pass
+
+class CountingWriter(object):
+	# Passes writes through to the underlying file, keeping a running byte count and checksum, and
+	# charging the writes to an optional throttle. Failures to write, sync or close the file are
+	# raised as ArchiveWriteError.
+	def __init__(self, fileobj, throttle=None):
+		self.fileobj = fileobj
+		self.throttle = throttle
+		self.bytesWritten = 0
+		self.hasher = hashlib.new(HASH_ALGORITHM)
+
+	def write(self, data):
+		if self.throttle is not None:
+			self.throttle.consume(len(data))
+		try:
+			self.fileobj.write(data)
+		except (IOError, OSError) as e:
+			raise ArchiveWriteError(e)
+		self.bytesWritten += len(data)
+		self.hasher.update(data)
 
-	# Cross-reference database credentials against the credential list.
-	if not validateAttributeReference(root, './targets/target/database', 'credential', './credentials/credential', 'name'):
+	def resume(self, size):
+		# Picks up after the first 'size' bytes of a partly written file, which are hashed again
+		# and kept; anything after them is cut off.
+		self.fileobj.seek(0)
+		while self.bytesWritten < size:
+			data = self.fileobj.read(min(1024 * 1024, size - self.bytesWritten))
+			if len(data) == 0:
+				raise IOError('Partial archive is shorter than its last checkpoint.')
+			self.bytesWritten += len(data)
+			self.hasher.update(data)
+		self.fileobj.truncate(size)
+		self.fileobj.seek(size)
+
+	def sync(self):
+		try:
+			self.fileobj.flush()
+			os.fsync(self.fileobj.fileno())
+		except (IOError, OSError) as e:
+			raise ArchiveWriteError(e)
+
+	def close(self):
+		try:
+			self.fileobj.close()
+		except (IOError, OSError) as e:
+			raise ArchiveWriteError(e)
+
+	def abort(self):
+		# Closes the file without caring whether what is buffered makes it out, or abandons an
+		# upload (see S3UploadWriter).
+		try:
+			if hasattr(self.fileobj, 'abort'):
+				self.fileobj.abort()
+			else:
+				self.fileobj.close()
+		except (IOError, OSError):
+			pass
+
+class HashingReader(object):
+	# Hashes everything read through it, so content hashes come for free while archiving. Given
+	# the size recorded in a tar header, it pads a file that shrank or could not be read to the
+	# end with zeros (as GNU tar does) so the archive stays well-formed; a read error is kept in
+	# 'error'. Reads are charged to an optional throttle.
+	def __init__(self, fileobj, expectedSize=None, throttle=None):
+		self.fileobj = fileobj
+		self.hasher = hashlib.new(HASH_ALGORITHM)
+		self.remaining = expectedSize
+		self.truncated = False
+		self.error = None
+		self.throttle = throttle
+
+	def read(self, size=-1):
+		data = ''
+		if self.error is None:
+			try:
+				data = self.fileobj.read(size)
+			except (IOError, OSError) as e:
+				if self.remaining is None:
+					raise
+				self.error = e
+		if self.throttle is not None:
+			self.throttle.consume(len(data))
+		if self.remaining is not None:
+			if size >= 0 and len(data) < size and self.remaining > len(data):
+				data += '\0' * (min(size, self.remaining) - len(data))
+				self.truncated = True
+			self.remaining -= len(data)
+		self.hasher.update(data)
+		return data
+
+	def hexdigest(self):
+		return self.hasher.hexdigest()
+
+class GzipWriter(object):
+	# Compresses a stream into a single gzip member, same as running 'gzip' over it afterwards.
+	def __init__(self, fileobj, level=6):
+		self.fileobj = fileobj
+		self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+	def write(self, data):
+		self.fileobj.write(self.compressor.compress(data))
+
+	def close(self):
+		self.fileobj.write(self.compressor.flush())
+		self.fileobj.close()
+
+def compressGzipBlock(data, level):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+def compressZstdBlock(data, level):
+	import zstandard
+	return zstandard.ZstdCompressor(level=level).compress(data)
+
+def compressLz4Block(data, level):
+	import lz4.frame
+	return lz4.frame.compress(data, compression_level=level)
+
+def decompressGzipBlock(data):
+	return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def decompressZstdBlock(data):
+	import zstandard
+	return zstandard.ZstdDecompressor().decompress(data)
+
+def decompressLz4Block(data):
+	import lz4.frame
+	return lz4.frame.decompress(data)
+
+# Codec name -> (archive extension, default level, block compression function, required module,
+# block decompression function).
+CODECS = {
+	'gzip': ('.gz', 6, compressGzipBlock, 'zlib', decompressGzipBlock),
+	'zstd': ('.zst', 3, compressZstdBlock, 'zstandard', decompressZstdBlock),
+	'lz4': ('.lz4', 0, compressLz4Block, 'lz4.frame', decompressLz4Block),
+}
+
+HASH_ALGORITHM = 'blake2b' if hasattr(hashlib, 'blake2b') else 'sha1'
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+DELETED_MEMBER = '.goodbackup-deleted'
+
+def isCodecAvailable(codec):
+	try:
+		__import__(CODECS[codec][3])
+		return True
+	except ImportError:
 		return False
 
-	return True
+class BlockCompressWriter(object):
+	# Splits a stream into fixed-size blocks and compresses them independently on a thread pool
+	# (zlib, zstandard and lz4 all release the GIL while compressing). Blocks are written back in
+	# order, each as a complete member, so the result is a standard multi-member gzip file (or a
+	# sequence of zstd/lz4 frames) that the stock command-line tools decompress as one stream.
+	# With a cipher, each compressed block is also sealed into an encrypted frame on the pool.
+	# 'blocks' lists the blocks already in the file when appending to a partial archive.
+	def __init__(self, fileobj, codec='gzip', workers=1, blockSize=DEFAULT_BLOCK_SIZE, level=None, cipher=None, blocks=None):
+		from multiprocessing.pool import ThreadPool
+		self.fileobj = fileobj
+		self.compressBlock = CODECS[codec][2]
+		self.level = CODECS[codec][1] if level is None else level
+		self.workers = workers
+		self.blockSize = blockSize
+		self.buffer = []
+		self.bufferSize = 0
+		self.pending = collections.deque()
+		self.pool = ThreadPool(workers) if workers > 1 else None
+		# (uncompressed offset, uncompressed length, compressed offset, compressed length) of every
+		# block written, for building a random-access index.
+		self.blocks = []
+		self.rawOffset = 0
+		self.compressedOffset = 0
+		self.cipher = cipher
+		if cipher is not None:
+			self.compressedOffset = len(cipher.header)
+		if blocks is None:
+			if cipher is not None:
+				self.fileobj.write(cipher.header)
+		elif len(blocks) > 0:
+			self.blocks = [tuple(block) for block in blocks]
+			self.rawOffset = blocks[-1][0] + blocks[-1][1]
+			self.compressedOffset = blocks[-1][2] + blocks[-1][3]
 
-def doBackup(root):
-	startTime = time.time()
-	timestamp = datetime.datetime.fromtimestamp(startTime).strftime('%Y-%m-%d.%H-%M-%S.%f')
-	outputDir = root.find('output').get('path')
-	if not os.path.isdir(outputDir):
-		log("Error: No such path: {0}. Aborting backup.".format(outputDir))
+	def write(self, data):
+		self.buffer.append(data)
+		self.bufferSize += len(data)
+		if self.bufferSize >= self.blockSize:
+			data = ''.join(self.buffer)
+			offset = 0
+			while len(data) - offset >= self.blockSize:
+				self.submit(data[offset:offset + self.blockSize])
+				offset += self.blockSize
+			self.buffer = [data[offset:]]
+			self.bufferSize = len(data) - offset
+
+	def encodeBlock(self, number, block):
+		compressed = self.compressBlock(block, self.level)
+		return compressed if self.cipher is None else self.cipher.seal(number, compressed)
+
+	def submit(self, block):
+		number = len(self.blocks) + len(self.pending)
+		if self.pool is None:
+			self.writeBlock(len(block), self.encodeBlock(number, block))
+			return
+
+		# Keep a bounded number of blocks in flight so memory use stays proportional to the pool size.
+		self.pending.append((len(block), self.pool.apply_async(self.encodeBlock, (number, block))))
+		while len(self.pending) > self.workers * 2:
+			self.writePending()
+
+	def writePending(self):
+		rawLength, result = self.pending.popleft()
+		self.writeBlock(rawLength, result.get())
+
+	def writeBlock(self, rawLength, compressed):
+		self.fileobj.write(compressed)
+		self.blocks.append((self.rawOffset, rawLength, self.compressedOffset, len(compressed)))
+		self.rawOffset += rawLength
+		self.compressedOffset += len(compressed)
+
+	def flush(self):
+		# Writes out everything buffered, ending the current block early if need be.
+		if self.bufferSize > 0:
+			self.submit(''.join(self.buffer))
+			self.buffer = []
+			self.bufferSize = 0
+		while len(self.pending) > 0:
+			self.writePending()
+
+	def close(self):
+		self.flush()
+		if self.cipher is not None:
+			self.fileobj.write(self.cipher.seal(len(self.blocks), '', True))
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+		self.fileobj.close()
+
+def iterStreamChunks(name, stream, chunkSize):
+	# Splits a stream of unknown length into archive members, holding at most two chunks in
+	# memory. A tar header needs the member size up front, so a stream that fits in one chunk
+	# becomes a single member; longer streams are split into '<name>.000000', '<name>.000001', ...
+	# members that concatenate back into the original ('cat <name>.*').
+	chunk = stream.read(chunkSize)
+	nextChunk = stream.read(chunkSize)
+	if len(nextChunk) == 0:
+		yield (name, chunk)
 		return
 
-	found = False
-	for target in root.findall('./targets/target'):
-		if int(startTime / 60 / 60) % int(target.get('intervalHours')) == 0:
-			sources = []
-			tempFiles = []
-			found = True
-			log('Starting backup for "{0}".'.format(target.get('name')))
-			
-			# Add folder targets to source list.
-			for folder in target.findall('./folder'):
-				if os.path.isdir(folder.get('path')):
-					sources.append(folder.get('path'))
+	index = 0
+	while len(chunk) > 0:
+		yield ('{0}.{1:06d}'.format(name, index), chunk)
+		index += 1
+		chunk = nextChunk
+		nextChunk = stream.read(chunkSize) if len(chunk) > 0 else ''
+
+def openCompressor(fileobj, codec='gzip', workers=1, blockSize=DEFAULT_BLOCK_SIZE, indexed=False, cipher=None, blocks=None):
+	# A single gzip worker keeps the classic single-member output, unless the archive is indexed
+	# or encrypted; anything else is block-based.
+	if codec == 'gzip' and workers <= 1 and not indexed and cipher is None:
+		return GzipWriter(fileobj)
+	return BlockCompressWriter(fileobj, codec, workers, blockSize, cipher=cipher, blocks=blocks)
+
+def archiveExtension(codec, encrypted=False):
+	return '.tar' + CODECS[codec][0] + (ENCRYPTED_EXTENSION if encrypted else '')
+
+def archiveCodec(path):
+	codecs = [codec for codec in CODECS if path.endswith(archiveExtension(codec, isEncryptedArchive(path)))]
+	return codecs[0] if codecs else 'gzip'
+
+class ArchiveWriter(object):
+	# Streams sources into a compressed tar archive in a single pass. An indexed archive is
+	# compressed in independent blocks and gets a '.idx' sidecar (see ArchiveReader). Source reads
+	# and archive writes are metered by the optional read and write throttles. With a cipher, the
+	# archive and its sidecars are encrypted (see BlockCipher). The archive is written to the folder
+	# in 'path', or under the same name to 'storage' (see LocalStorage and S3Storage). Given the
+	# state saved by checkpoint(), a partial archive is cut back to that point and appended to.
+	# Content already in another archive of the same run is only referenced (see SharedContent).
+	# Files with holes are stored as GNU sparse members holding only their data (see sparseHeader).
+	def __init__(self, path, codec='gzip', workers=1, blockSize=DEFAULT_BLOCK_SIZE, metrics=NO_METRICS, indexed=False, readThrottle=None, writeThrottle=None, cipher=None, storage=None, resume=None):
+		import tarfile
+		self.path = path
+		self.codec = codec
+		self.bytesIn = 0
+		self.filesIn = 0
+		self.metrics = metrics
+		self.members = [] if indexed else None
+		self.checksums = []
+		self.refs = []
+		self.databaseRefs = []
+		self.bytesShared = 0
+		self.readThrottle = readThrottle
+		self.cipher = cipher
+		self.storage = storage or LocalStorage(os.path.dirname(path))
+		self.name = os.path.basename(path)
+		if resume is None:
+			self.output = CountingWriter(self.storage.create(self.name), writeThrottle)
+		else:
+			self.output = CountingWriter(self.storage.reopen(self.name), writeThrottle)
+			self.output.resume(resume['size'])
+			self.members = list(resume['members'])
+			self.checksums = list(resume['checksums'])
+			self.refs = list(resume['refs'])
+			self.databaseRefs = list(resume['databaseRefs'])
+			self.bytesIn = resume['bytesIn']
+			self.filesIn = resume['filesIn']
+		self.compressor = openCompressor(self.output, codec, workers, blockSize, indexed, cipher, resume['blocks'] if resume else None)
+		compressorInput = TimingWriter(self.compressor, self.metrics, 'compress') if self.metrics.enabled else self.compressor
+		self.tar = tarfile.open(mode='w|', fileobj=compressorInput)
+		if resume is not None:
+			self.tar.offset = resume['rawOffset']
+		self.links = {}
+		self.closed = False
+		self.checkpointed = (len(self.compressor.blocks) if resume else 0, len(self.members or []), len(self.checksums), len(self.refs), len(self.databaseRefs))
+
+	@property
+	def bytesOut(self):
+		return self.output.bytesWritten
+
+	@property
+	def keyId(self):
+		return self.cipher.keyId if self.cipher is not None else None
+
+	@property
+	def checksum(self):
+		return self.output.hasher.hexdigest()
+
+	def addMember(self, tarinfo, fileobj=None, sparse=None):
+		# Writes a member, checksumming its data on the way in for the manifest. Returns the
+		# content hash of members with data, or None. 'sparse' is (real size, data runs) for a
+		# sparse member, whose tarinfo.size is the length of the runs; its checksum covers the runs
+		# and is recorded along with them.
+		contentHash = None
+		if fileobj is not None and not isinstance(fileobj, HashingReader):
+			fileobj = HashingReader(fileobj, throttle=self.readThrottle)
+		if tarinfo.isreg():
+			self.bytesIn += tarinfo.size
+			self.filesIn += 1
+		if sparse is None:
+			self.tar.addfile(tarinfo, fileobj)
+		else:
+			self.addSparseMember(tarinfo, fileobj, *sparse)
+		if fileobj is not None:
+			contentHash = fileobj.hexdigest()
+			if sparse is None:
+				self.checksums.append([tarinfo.name, tarinfo.size, contentHash])
+			else:
+				self.checksums.append([tarinfo.name, sparse[0], contentHash, [list(segment) for segment in sparse[1]]])
+		if self.members is not None:
+			# The tar offset now points past the member's data and padding.
+			dataOffset = self.tar.offset - (tarinfo.size + 511) // 512 * 512 if tarinfo.isreg() else None
+			self.members.append([tarinfo.name, tarinfo.type, tarinfo.size, tarinfo.mtime, tarinfo.mode, dataOffset, tarinfo.linkname])
+		return contentHash
+
+	def addSparseMember(self, tarinfo, fileobj, realSize, segments):
+		# Same as TarFile.addfile, with a sparse header.
+		import tarfile
+		header = sparseHeader(tarinfo, realSize, segments)
+		self.tar.fileobj.write(header)
+		self.tar.offset += len(header)
+		tarfile.copyfileobj(fileobj, self.tar.fileobj, tarinfo.size)
+		blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+		if remainder > 0:
+			self.tar.fileobj.write('\0' * (tarfile.BLOCKSIZE - remainder))
+			blocks += 1
+		self.tar.offset += blocks * tarfile.BLOCKSIZE
+		self.tar.members.append(tarinfo)
+
+	def addPath(self, path):
+		# Equivalent to 'tar rf <archive> -C $(dirname <path>) $(basename <path>)'.
+		for entry in walkTree(path):
+			self.addFile(entry.path, entry.arcname, entry.stat)
+
+	def makeTarInfo(self, path, arcname, st):
+		# Same as TarFile.gettarinfo, but reuses a stat result from the walker and caches
+		# user and group name lookups.
+		import tarfile
+		tarinfo = tarfile.TarInfo(arcname)
+		if stat.S_ISREG(st.st_mode):
+			if st.st_nlink > 1 and (st.st_dev, st.st_ino) in self.links:
+				tarinfo.type = tarfile.LNKTYPE
+				tarinfo.linkname = self.links[(st.st_dev, st.st_ino)]
+			else:
+				tarinfo.type = tarfile.REGTYPE
+				tarinfo.size = st.st_size
+				if st.st_nlink > 1:
+					self.links[(st.st_dev, st.st_ino)] = arcname
+		elif stat.S_ISDIR(st.st_mode):
+			tarinfo.type = tarfile.DIRTYPE
+		elif stat.S_ISLNK(st.st_mode):
+			tarinfo.type = tarfile.SYMTYPE
+			tarinfo.linkname = os.readlink(path)
+		elif stat.S_ISFIFO(st.st_mode):
+			tarinfo.type = tarfile.FIFOTYPE
+		elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+			tarinfo.type = tarfile.CHRTYPE if stat.S_ISCHR(st.st_mode) else tarfile.BLKTYPE
+			tarinfo.devmajor = os.major(st.st_rdev)
+			tarinfo.devminor = os.minor(st.st_rdev)
+		else:
+			return None
+		tarinfo.mode = stat.S_IMODE(st.st_mode)
+		tarinfo.uid = st.st_uid
+		tarinfo.gid = st.st_gid
+		tarinfo.uname = lookupUserName(st.st_uid)
+		tarinfo.gname = lookupGroupName(st.st_gid)
+		tarinfo.mtime = st.st_mtime
+		return tarinfo
+
+	def addFile(self, path, arcname, st=None, data=None):
+		# Adds a single filesystem entry without recursing into directories, using the file's
+		# contents from 'data' if they were already read. Returns the content hash of regular
+		# files, or None for anything else.
+		st = st or os.lstat(path)
+		tarinfo = self.makeTarInfo(path, arcname, st)
+		if tarinfo is None:
+			return None
+		if not tarinfo.isreg():
+			self.addMember(tarinfo)
+			return None
+		if data is not None:
+			tarinfo.size = len(data)
+			return self.addMember(tarinfo, StringIO.StringIO(data))
+		if tarinfo.size < LARGE_FILE_SIZE and st.st_blocks * 512 >= tarinfo.size:
+			with open(path, 'rb') as fileobj:
+				reader = HashingReader(fileobj, tarinfo.size, self.readThrottle)
+				contentHash = self.addMember(tarinfo, reader)
+		else:
+			reader = self.addLargeFile(path, tarinfo, st)
+			contentHash = reader.hexdigest()
+		if reader.error is not None:
+			raise IOError(reader.error.errno, 'Read failed partway, so the rest of the file was padded with zeros ({0})'.format(reader.error.strerror))
+		if reader.truncated:
+			log('Warning: {0} shrank while being archived; padded with zeros.'.format(path))
+		return contentHash
+
+	def addLargeFile(self, path, tarinfo, st):
+		# Reads a large or sparse file in big sequential reads, skipping its holes, which are
+		# stored as such rather than as runs of zeros. Fewer allocated blocks than the file size
+		# calls for is the cheap hint that there are holes (or that the filesystem compresses).
+		# Returns the HashingReader the file was read through.
+		with open(path, 'rb', 0) as fileobj:
+			adviseSequential(fileobj.fileno())
+			segments = None
+			if st.st_blocks * 512 < tarinfo.size:
+				segments = dataSegments(fileobj.fileno(), tarinfo.size)
+			if segments is None:
+				segments = [(0, tarinfo.size)]
+			stored = sum(length for offset, length in segments)
+			segmentReader = SegmentReader(fileobj, segments)
+			reader = HashingReader(segmentReader, stored, self.readThrottle)
+			if stored == tarinfo.size:
+				self.addMember(tarinfo, reader)
+			else:
+				realSize = tarinfo.size
+				tarinfo.size = stored
+				self.addMember(tarinfo, reader, (realSize, segments))
+		reader.truncated |= segmentReader.truncated
+		return reader
+
+	def addReference(self, arcname, st, archiveName, sourceName, contentHash):
+		# Adds a regular file whose content is already archived as 'sourceName' in 'archiveName':
+		# as a hard link if that is this archive, or else as an entry in the refs member written
+		# at the end of the archive. Returns the content hash.
+		import tarfile
+		if archiveName == self.name:
+			tarinfo = self.makeTarInfo(None, arcname, st)
+			tarinfo.type = tarfile.LNKTYPE
+			tarinfo.linkname = sourceName
+			tarinfo.size = 0
+			self.addMember(tarinfo)
+		else:
+			self.refs.append([arcname, st.st_size, st.st_mtime, stat.S_IMODE(st.st_mode), archiveName, sourceName, contentHash])
+		self.bytesShared += st.st_size
+		return contentHash
+
+	def addDatabaseReference(self, dbname, archiveName):
+		# Notes that the dump of 'dbname' is in another archive of the same run.
+		self.databaseRefs.append([dbname, archiveName])
+
+	def referencedArchives(self):
+		return set(ref[4] for ref in self.refs) | set(archiveName for dbname, archiveName in self.databaseRefs)
+
+	def addBuffer(self, name, data):
+		import tarfile
+		tarinfo = tarfile.TarInfo(name)
+		tarinfo.size = len(data)
+		tarinfo.mtime = time.time()
+		tarinfo.mode = 0644
+		self.addMember(tarinfo, StringIO.StringIO(data))
+
+	def addStream(self, name, stream, chunkSize=DEFAULT_CHUNK_SIZE):
+		# Archives a stream of unknown length with bounded memory (see iterStreamChunks).
+		memberNames = []
+		for memberName, data in iterStreamChunks(name, stream, chunkSize):
+			self.addBuffer(memberName, data)
+			memberNames.append(memberName)
+		return memberNames
+
+	def checkpoint(self):
+		# Flushes everything added so far through to disk, ending the current compressed block
+		# early, so the archive can later be cut back to this point and appended to. Returns what
+		# changed since the last checkpoint, for a Journal. Needs an indexed archive on local storage.
+		stream = self.tar.fileobj
+		stream.fileobj.write(stream.buf)
+		stream.buf = ''
+		self.compressor.flush()
+		self.output.sync()
+		blockCount, memberCount, checksumCount, refCount, databaseRefCount = self.checkpointed
+		self.checkpointed = (len(self.compressor.blocks), len(self.members), len(self.checksums), len(self.refs), len(self.databaseRefs))
+		return {
+			'size': self.bytesOut,
+			'rawOffset': self.tar.offset,
+			'bytesIn': self.bytesIn,
+			'filesIn': self.filesIn,
+			'blocks': self.compressor.blocks[blockCount:],
+			'members': self.members[memberCount:],
+			'checksums': self.checksums[checksumCount:],
+			'refs': self.refs[refCount:],
+			'databaseRefs': self.databaseRefs[databaseRefCount:],
+		}
+
+	def close(self):
+		if len(self.refs) > 0 or len(self.databaseRefs) > 0:
+			self.addBuffer(REFS_MEMBER, json.dumps({'files': self.refs, 'databases': dict(self.databaseRefs)}, separators=(',', ':')))
+		self.tar.close()
+		with self.metrics.phase('compress'):
+			self.compressor.close()
+		try:
+			self.writeSidecars()
+		except (IOError, OSError) as e:
+			raise ArchiveWriteError(e)
+		self.closed = True
+
+	def writeSidecars(self):
+		# The manifest and index, then the archive is committed.
+		writeArchiveManifest(self.storage, self.name, {
+			'archive': self.name,
+			'algorithm': HASH_ALGORITHM,
+			'size': self.bytesOut,
+			'checksum': self.checksum,
+			'members': self.checksums,
+		}, self.cipher)
+		if self.members is not None:
+			writeArchiveIndex(self.storage, self.name, {
+				'version': 1,
+				'codec': self.codec,
+				'blocks': self.compressor.blocks,
+				'members': self.members,
+				'refs': self.refs,
+				'sparse': dict((entry[0], [entry[1], entry[3]]) for entry in self.checksums if len(entry) > 3),
+			}, self.cipher)
+		self.storage.commit(self.name)
+
+	def abort(self):
+		# Gives up on the archive without committing it. A local '.partial' file is left for the
+		# next run to resume or remove. Does nothing once the archive is closed.
+		if self.closed:
+			return
+		if isinstance(self.compressor, BlockCompressWriter) and self.compressor.pool is not None:
+			self.compressor.pool.terminate()
+			self.compressor.pool.join()
+		self.output.abort()
+		# Keep tarfile from finishing the stream when it is garbage collected.
+		self.tar.fileobj.closed = True
+		self.tar.closed = True
+
+ARCHIVE_INDEX_EXTENSION = '.idx'
+MANIFEST_EXTENSION = '.manifest.json'
+
+ArchiveMember = collections.namedtuple('ArchiveMember', ['name', 'type', 'size', 'mtime', 'mode', 'offset', 'linkname'])
+
+def writeSidecar(storage, name, data, cipher=None):
+	# Stores a file next to an archive, encrypting it along with the archive.
+	storage.put(name, data if cipher is None else cipher.sealFile(data))
+
+def readSidecar(path, key=None):
+	with open(path, 'rb') as sidecarFile:
+		data = sidecarFile.read()
+	if not data.startswith(ENCRYPTION_MAGIC):
+		return data
+	if key is None:
+		raise IOError('{0} is encrypted; its key is needed to read it.'.format(path))
+	cipher = cipherForHeader(key, data[:len(ENCRYPTION_MAGIC) + 1])
+	return cipher.openFile(data)
+
+def writeArchiveIndex(storage, archiveName, index, cipher=None):
+	writeSidecar(storage, archiveName + ARCHIVE_INDEX_EXTENSION, compressGzipBlock(json.dumps(index, separators=(',', ':')), 6), cipher)
+
+def writeArchiveManifest(storage, archiveName, manifest, cipher=None):
+	# Checksums of the archive and of every member with data, for verify.py.
+	writeSidecar(storage, archiveName + MANIFEST_EXTENSION, json.dumps(manifest, separators=(',', ':')), cipher)
+
+def hasArchiveIndex(archivePath):
+	return os.path.isfile(archivePath + ARCHIVE_INDEX_EXTENSION)
+
+class ArchiveReader(object):
+	# Random access to an indexed archive. The '.idx' sidecar lists every member with the offset
+	# of its data in the uncompressed tar stream, and every compressed block with its offsets, so
+	# a member is read by seeking to the blocks it spans and decompressing only those. Listing
+	# members reads nothing but the index. Encrypted archives need their key. Files referenced in
+	# other archives of the same run are listed too, and read from those archives when extracted.
+	# Sparse members are extracted with their holes.
+	def __init__(self, path, key=None):
+		import tarfile
+		index = json.loads(decompressGzipBlock(readSidecar(path + ARCHIVE_INDEX_EXTENSION, key)))
+		self.path = path
+		self.key = key
+		self.cipher = None
+		if isEncryptedArchive(path):
+			with open(path, 'rb') as fileobj:
+				self.cipher = cipherForHeader(key, fileobj.read(len(ENCRYPTION_MAGIC) + 1))
+		self.decompressBlock = CODECS[index['codec']][4]
+		self.blocks = index['blocks']
+		self.blockStarts = [block[0] for block in self.blocks]
+		self.members = [ArchiveMember(*member) for member in index['members']]
+		self.refs = {}
+		for name, size, mtime, mode, archiveName, sourceName, contentHash in index.get('refs', []):
+			self.members.append(ArchiveMember(name, tarfile.REGTYPE, size, mtime, mode, None, None))
+			self.refs[name] = (archiveName, sourceName)
+		self.sparse = index.get('sparse', {})
+		self.referenced = {}
+		self.fileobj = None
+		self.cachedBlock = (None, None)
+		self.blocksRead = 0
+
+	def readBlock(self, number):
+		# Consecutive small members usually share a block, so keep the last one decompressed.
+		if self.cachedBlock[0] != number:
+			if self.fileobj is None:
+				self.fileobj = open(self.path, 'rb')
+			rawOffset, rawLength, compressedOffset, compressedLength = self.blocks[number]
+			self.fileobj.seek(compressedOffset)
+			data = self.fileobj.read(compressedLength)
+			if self.cipher is not None:
+				data = self.cipher.open(number, data)
+			self.cachedBlock = (number, self.decompressBlock(data))
+			self.blocksRead += 1
+		return self.cachedBlock[1]
+
+	def iterRange(self, offset, length):
+		# Yields the uncompressed tar stream between 'offset' and 'offset + length', a block at a time.
+		number = bisect.bisect_right(self.blockStarts, offset) - 1
+		while length > 0:
+			block = self.readBlock(number)
+			start = offset - self.blocks[number][0]
+			data = block[start:start + length]
+			if len(data) == 0:
+				raise IOError('Archive index for {0} does not match its contents.'.format(self.path))
+			yield data
+			offset += len(data)
+			length -= len(data)
+			number += 1
+
+	def read(self, member):
+		return ''.join(self.iterRange(member.offset, member.size))
+
+	def select(self, names):
+		# The members named, or under a directory named, in archive order.
+		prefixes = tuple(name.rstrip('/') + '/' for name in names)
+		names = set(name.rstrip('/') for name in names)
+		return [member for member in self.members if member.name in names or member.name.startswith(prefixes)]
+
+	def extract(self, members, destDir):
+		# Extracts members under 'destDir', fixing up directory times once their contents are in.
+		import tarfile
+		byName = dict((member.name, member) for member in self.members)
+		directories = []
+		for member in sorted(members, key=lambda member: member.offset):
+			path = os.path.join(destDir, member.name)
+			if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			if member.type == tarfile.DIRTYPE:
+				if not os.path.isdir(path):
+					os.makedirs(path)
+				directories.append(member)
+				continue
+			if os.path.lexists(path):
+				os.remove(path)
+			if member.type == tarfile.SYMTYPE:
+				os.symlink(member.linkname, path)
+				continue
+			reader, source = self.resolve(member, byName)
+			if source is None or source.offset is None:
+				continue
+			with open(path, 'wb') as outfile:
+				if source.name in reader.sparse:
+					realSize, segments = reader.sparse[source.name]
+					writeSegments(outfile, reader.iterRange(source.offset, source.size), segments, realSize)
 				else:
-					log("Warning: Could not find folder " + folder.get('path') + ".")
-					
-			# Add database targets to source list.
-			for database in target.findall('./database'):
-				for elem in root.findall('./credentials/credential'):
-					if elem.get('name') == database.get('credential'):
-						credential = elem
-						break
-				dumpFile = "{0}/{1}.{2}.sql".format(outputDir, database.get('name'), timestamp)
-				dumpDatabase(database.get('name'), credential.get('username'), credential.get('password'), dumpFile)
-				sources.append(dumpFile)
-				tempFiles.append(dumpFile)
-			
-			# Add file targets to source list.
-			for file in target.findall('./file'):
-				if os.path.isfile(file.get('path')):
-					sources.append(file.get('path'))
+					for data in reader.iterRange(source.offset, source.size):
+						outfile.write(data)
+			os.chmod(path, source.mode)
+			os.utime(path, (source.mtime, source.mtime))
+		for member in reversed(directories):
+			path = os.path.join(destDir, member.name)
+			os.chmod(path, member.mode)
+			os.utime(path, (member.mtime, member.mtime))
+
+	def resolve(self, member, byName):
+		# Returns (reader, member) for where a member's data is stored: the member itself, the
+		# member a hard link points to, or the member a reference points to in another archive.
+		import tarfile
+		if member.name in self.refs:
+			archiveName, sourceName = self.refs[member.name]
+			if archiveName not in self.referenced:
+				self.referenced[archiveName] = ArchiveReader(os.path.join(os.path.dirname(self.path), archiveName), self.key)
+			reader = self.referenced[archiveName]
+			source = reader.select([sourceName])
+			if len(source) == 0:
+				raise IOError('{0} refers to {1} in {2}, which is not there.'.format(member.name, sourceName, archiveName))
+			return reader.resolve(source[0], dict((other.name, other) for other in reader.members))
+		if member.type == tarfile.LNKTYPE and member.linkname in byName:
+			return self.resolve(byName[member.linkname], byName)
+		return (self, member)
+
+	def close(self):
+		if self.fileobj is not None:
+			self.fileobj.close()
+		for reader in self.referenced.values():
+			reader.close()
+
+def formatBytes(numBytes):
+	for unit in ['B', 'KB', 'MB', 'GB']:
+		if numBytes < 1024:
+			return '{0:.1f} {1}'.format(numBytes, unit)
+		numBytes /= 1024.0
+	return '{0:.1f} TB'.format(numBytes)
+
+def formatRate(numBytes, seconds):
+	return formatBytes(numBytes / max(seconds, 0.001)) + '/s'
+
+#
+# Filesystem walking.
+#
+
+WalkEntry = collections.namedtuple('WalkEntry', ['path', 'arcname', 'stat'])
+
+userNames = {}
+groupNames = {}
+
+def lookupUserName(uid):
+	if uid not in userNames:
+		try:
+			userNames[uid] = pwd.getpwuid(uid)[0]
+		except KeyError:
+			userNames[uid] = ''
+	return userNames[uid]
+
+def lookupGroupName(gid):
+	if gid not in groupNames:
+		try:
+			groupNames[gid] = grp.getgrgid(gid)[0]
+		except KeyError:
+			groupNames[gid] = ''
+	return groupNames[gid]
+
+class StatCache(object):
+	# Remembers directory listings between runs. A directory's mtime changes whenever an entry is
+	# added, removed or renamed, so an unchanged mtime means the cached names can be used instead
+	# of reading the directory again. Directories modified in the last few seconds are not cached,
+	# since further changes could land within the same timestamp.
+	def __init__(self, path):
+		self.path = path
+		self.cutoff = time.time() - 2
+		self.updated = {}
+		try:
+			with open(path, 'rb') as cacheFile:
+				self.listings = marshal.load(cacheFile)
+		except (IOError, EOFError, ValueError, TypeError):
+			self.listings = {}
+
+	def lookup(self, dirpath, mtime):
+		listing = self.listings.get(dirpath)
+		if listing is None or listing[0] != mtime:
+			return None
+		self.updated[dirpath] = listing
+		return listing[1]
+
+	def store(self, dirpath, mtime, names):
+		if mtime < self.cutoff:
+			self.updated[dirpath] = (mtime, names)
+
+	def save(self):
+		# Only directories seen this run are kept, so deleted ones drop out of the cache.
+		with open(self.path + '.tmp', 'wb') as cacheFile:
+			marshal.dump(self.updated, cacheFile)
+		os.rename(self.path + '.tmp', self.path)
+
+def listDirectory(dirpath, dirStat, statCache=None):
+	# Returns (name, lstat result) for every entry in a directory, reusing the stat results
+	# os.scandir gathers where it's available.
+	names = statCache.lookup(dirpath, dirStat.st_mtime) if statCache is not None else None
+	if names is None and scandir is not None:
+		listing = []
+		for entry in scandir(dirpath):
+			try:
+				listing.append((entry.name, entry.stat(follow_symlinks=False)))
+			except OSError:
+				pass
+		if statCache is not None:
+			statCache.store(dirpath, dirStat.st_mtime, [name for name, st in listing])
+		return listing
+
+	if names is None:
+		names = os.listdir(dirpath)
+		if statCache is not None:
+			statCache.store(dirpath, dirStat.st_mtime, names)
+	listing = []
+	for name in names:
+		try:
+			listing.append((name, os.lstat(os.path.join(dirpath, name))))
+		except OSError:
+			pass
+	return listing
+
+def matchesPattern(relpath, name, patterns):
+	for pattern in patterns:
+		if fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(name, pattern):
+			return True
+	return False
+
+def walkTree(source, includes=(), excludes=(), workers=1, statCache=None):
+	# Yields a WalkEntry for 'source' and everything below it, named the way 'tar' names them
+	# relative to the parent of 'source'. Patterns are matched against both the path relative to
+	# 'source' and the entry's own name. Excluded directories are skipped without being listed,
+	# as are folder snapshots (see Snapshot); files must also match one of the include patterns,
+	# if there are any. Directories are
+	# listed on a pool of 'workers' threads, with a bounded number of listings in flight.
+	from multiprocessing.pool import ThreadPool
+	arcroot = os.path.basename(os.path.normpath(source))
+	rootStat = os.lstat(source)
+	yield WalkEntry(source, arcroot, rootStat)
+	if not stat.S_ISDIR(rootStat.st_mode):
+		return
+
+	pending = collections.deque([(source, arcroot, rootStat)])
+	results = Queue.Queue()
+	outstanding = 0
+	pool = ThreadPool(workers) if workers > 1 else None
+
+	def scan(dirpath, arcdir, dirStat):
+		try:
+			results.put((dirpath, arcdir, listDirectory(dirpath, dirStat, statCache), None))
+		except OSError as e:
+			results.put((dirpath, arcdir, None, e))
+
+	try:
+		while len(pending) > 0 or outstanding > 0:
+			while len(pending) > 0 and outstanding < workers * 4:
+				if pool is None:
+					scan(*pending.popleft())
 				else:
-					log("Warning: Could not find file " + file.get('path') + ".")
+					pool.apply_async(scan, pending.popleft())
+				outstanding += 1
+
+			dirpath, arcdir, listing, error = results.get()
+			outstanding -= 1
+			if error is not None:
+				log('Warning: Could not list {0}: {1}'.format(dirpath, error))
+				continue
+			for name, st in listing:
+				arcname = arcdir + '/' + name
+				relpath = arcname[len(arcroot) + 1:]
+				if matchesPattern(relpath, name, excludes) or name.startswith(SNAPSHOT_PREFIX):
+					continue
+				if stat.S_ISDIR(st.st_mode):
+					pending.append((os.path.join(dirpath, name), arcname, st))
+				elif len(includes) > 0 and not matchesPattern(relpath, name, includes):
+					continue
+				yield WalkEntry(os.path.join(dirpath, name), arcname, st)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
 
-			# Create the archive.
-			outfile = outputDir + '/' + target.get('name') + 'backup' + timestamp + '.tar'
-			for source in sources:
-				os.system('tar rf {0} -C $(dirname {1}) $(basename {1})'.format(outfile, source))
-			if os.path.isfile(outfile):
-				os.system('gzip ' + outfile)
+#
+# Filesystem snapshots.
+#
+
+SNAPSHOT_PREFIX = '.goodbackup-snapshot.'
+BTRFS_SUBVOLUME_INODE = 256
+LVM_SNAPSHOT_EXTENTS = '10%ORIGIN'
+
+def findMount(path):
+	# Returns (mount point, device, filesystem type) for the mount holding 'path'.
+	path = os.path.abspath(path)
+	found = ('/', None, None)
+	with open('/proc/mounts') as mounts:
+		for line in mounts:
+			device, mountPoint, fsType = line.split()[:3]
+			mountPoint = mountPoint.replace('\\040', ' ')
+			if (path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/')) and len(mountPoint) >= len(found[0]):
+				found = (mountPoint, device, fsType)
+	return found
+
+def runSnapshotCommand(args):
+	# Runs a snapshot tool, raising OSError with what it printed if it fails.
+	import subprocess
+	child = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output = child.communicate()[0]
+	if child.returncode != 0:
+		raise OSError('{0} failed: {1}'.format(' '.join(args[:3]), output.strip()))
+	return output
+
+def snapshotName(targetName, path):
+	return re.sub(r'[^\w.-]', '_', targetName) + '.' + hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]
+
+class Snapshot(object):
+	# A read-only, point-in-time copy of a folder, archived in place of the live folder so writers
+	# are never blocked while the archive is written. create() returns where the folder appears
+	# in the snapshot, under its own name, so it is archived under the usual member names. Each
+	# snapshot lives in a '.goodbackup-snapshot.<target>.<hash>' folder (which walkTree never
+	# enters), so one left behind by a killed run is released by the next. Subclasses say where
+	# that folder goes, and how to take and drop the snapshot inside it.
+	keepsInodes = True
+
+	def __init__(self, source, name):
+		self.source = os.path.abspath(source)
+		self.name = name
+		self.container = None
+
+	def create(self):
+		self.container = os.path.join(self.location(), SNAPSHOT_PREFIX + self.name)
+		self.release()
+		os.mkdir(self.container)
+		try:
+			return self.take()
+		except (IOError, OSError):
+			self.release()
+			raise
+
+	def release(self):
+		if os.path.isdir(self.container):
+			self.drop()
+			os.rmdir(self.container)
+
+class BtrfsSnapshot(Snapshot):
+	# A read-only snapshot of the btrfs subvolume holding the folder, kept inside that subvolume.
+	def subvolumeRoot(self):
+		if findMount(self.source)[2] != 'btrfs':
+			raise OSError('{0} is not on a btrfs filesystem'.format(self.source))
+		root = self.source
+		while os.stat(root).st_ino != BTRFS_SUBVOLUME_INODE and root != '/':
+			root = os.path.dirname(root)
+		return root
+
+	def location(self):
+		return self.subvolumeRoot()
+
+	def take(self):
+		root = self.subvolumeRoot()
+		snapshot = os.path.join(self.container, os.path.basename(root) or 'root')
+		runSnapshotCommand(['btrfs', 'subvolume', 'snapshot', '-r', root, snapshot])
+		return os.path.normpath(os.path.join(snapshot, os.path.relpath(self.source, root)))
+
+	def drop(self):
+		for name in os.listdir(self.container):
+			runSnapshotCommand(['btrfs', 'subvolume', 'delete', os.path.join(self.container, name)])
+
+class LvmSnapshot(Snapshot):
+	# An LVM snapshot of the logical volume holding the folder, mounted read-only under the
+	# temporary folder. The snapshot volume gets LVM_SNAPSHOT_EXTENTS of space for changes made
+	# while it exists.
+	def location(self):
+		import tempfile
+		return tempfile.gettempdir()
+
+	def volume(self):
+		# Returns (volume group, logical volume, snapshot volume, mount point, filesystem type).
+		mountPoint, device, fsType = findMount(self.source)
+		fields = runSnapshotCommand(['lvs', '--noheadings', '-o', 'vg_name,lv_name', device]).split()
+		if len(fields) != 2:
+			raise OSError('{0} is not on an LVM logical volume'.format(self.source))
+		return (fields[0], fields[1], 'goodbackup-' + hashlib.sha1(self.name).hexdigest()[:12], mountPoint, fsType)
+
+	def take(self):
+		group, volume, snapshotVolume, mountPoint, fsType = self.volume()
+		mountDir = os.path.join(self.container, os.path.basename(mountPoint) or 'root')
+		os.mkdir(mountDir)
+		runSnapshotCommand(['lvcreate', '--snapshot', '--extents', LVM_SNAPSHOT_EXTENTS, '--name', snapshotVolume, group + '/' + volume])
+		runSnapshotCommand(['mount', '-o', 'ro,nouuid' if fsType == 'xfs' else 'ro', '/dev/{0}/{1}'.format(group, snapshotVolume), mountDir])
+		return os.path.normpath(os.path.join(mountDir, os.path.relpath(self.source, mountPoint)))
+
+	def drop(self):
+		for name in os.listdir(self.container):
+			if os.path.ismount(os.path.join(self.container, name)):
+				runSnapshotCommand(['umount', os.path.join(self.container, name)])
+			os.rmdir(os.path.join(self.container, name))
+		try:
+			group, volume, snapshotVolume, mountPoint, fsType = self.volume()
+			runSnapshotCommand(['lvs', group + '/' + snapshotVolume])
+		except OSError:
+			return
+		runSnapshotCommand(['lvremove', '--force', group + '/' + snapshotVolume])
+
+class ReflinkSnapshot(Snapshot):
+	# A copy of the folder next to it that shares its data blocks, on filesystems with reflinks
+	# (btrfs, XFS). Elsewhere taking it fails rather than quietly copying all the data. Each file
+	# is copied whole, but the folder as a whole isn't frozen at one instant. Copies get new inode
+	# numbers.
+	keepsInodes = False
+
+	def location(self):
+		return os.path.dirname(self.source)
+
+	def take(self):
+		try:
+			runSnapshotCommand(['cp', '-a', '--reflink=always', self.source, self.container])
+		except OSError as e:
+			raise OSError('{0} can\'t be reflinked, so it would have to be copied in full (use snapshot="copy" for that): {1}'.format(self.source, e))
+		return os.path.join(self.container, os.path.basename(self.source))
+
+	def drop(self):
+		import shutil
+		for name in os.listdir(self.container):
+			shutil.rmtree(os.path.join(self.container, name))
+
+class CopySnapshot(ReflinkSnapshot):
+	# A full copy of the folder next to it, on any filesystem. It needs as much free space, and
+	# as much I/O, as the folder itself.
+	def take(self):
+		runSnapshotCommand(['cp', '-a', self.source, self.container])
+		return os.path.join(self.container, os.path.basename(self.source))
+
+SNAPSHOT_METHODS = {
+	'btrfs': BtrfsSnapshot,
+	'lvm': LvmSnapshot,
+	'reflink': ReflinkSnapshot,
+	'copy': CopySnapshot,
+}
+
+def openSnapshot(method, source, name):
+	# 'auto' picks btrfs on btrfs, LVM on device-mapper volumes, and a reflink copy elsewhere;
+	# it never falls back to a full copy.
+	if method == 'auto':
+		mountPoint, device, fsType = findMount(source)
+		if fsType == 'btrfs':
+			method = 'btrfs'
+		elif device is not None and device.startswith('/dev/mapper/'):
+			method = 'lvm'
+		else:
+			method = 'reflink'
+	return SNAPSHOT_METHODS[method](source, name)
+
+class SnapshotIndex(object):
+	# Presents the files in a folder's snapshot to a FileIndex under their live paths, so
+	# incremental runs line up with earlier ones. Inode numbers are only compared if the
+	# snapshot keeps them.
+	def __init__(self, index, snapshot, snapshotPath):
+		self.index = index
+		self.snapshot = snapshot
+		self.snapshotPath = snapshotPath
+
+	def livePath(self, path):
+		return self.snapshot.source + path[len(self.snapshotPath):]
+
+	def isChanged(self, path, st):
+		return self.index.isChanged(self.livePath(path), st, self.snapshot.keepsInodes)
+
+	def record(self, path, arcname, st, contentHash):
+		self.index.record(self.livePath(path), arcname, st, contentHash)
+
+#
+# Incremental backups.
+#
 
-			# Clean up.
-			for tempFile in tempFiles:
-				os.remove(tempFile)
+class FileIndex(object):
+	# Per-target record of every archived filesystem entry, kept in SQLite next to the archives.
+	# The whole table is loaded into a dict up front, so checking a file for changes costs one
+	# dict lookup rather than a query, well below the cost of the stat that precedes it.
+	def __init__(self, path):
+		import sqlite3
+		self.db = sqlite3.connect(path)
+		self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, arcname TEXT, size INTEGER, mtime REAL, inode INTEGER, hash TEXT)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+		self.entries = dict((row[0], row[1:]) for row in self.db.execute('SELECT path, arcname, size, mtime, inode FROM files'))
+		self.state = dict(self.db.execute('SELECT key, value FROM state'))
+		self.updates = []
 
-			log('Backup complete for "{0}".'.format(target.get('name')))
+	def isFullDue(self, fullEveryN):
+		# A full backup is due on the first run, then every fullEveryN runs to bound restore chains.
+		if 'lastFull' not in self.state:
+			return True
+		return fullEveryN > 0 and int(self.state['incrementalsSinceFull']) + 1 >= fullEveryN
 
-	if not found:
-		log('No targets need to be backed up right now ({0} targets considered).'.format(len(root.findall('./targets/target'))))
+	def isChanged(self, path, st, checkInode=True):
+		# Entries left over once every source has been checked are the deleted ones.
+		entry = self.entries.pop(path, None)
+		return entry is None or entry[1] != st.st_size or entry[2] != st.st_mtime or (checkInode and entry[3] != st.st_ino)
+
+	def record(self, path, arcname, st, contentHash):
+		self.updates.append((path, arcname, st.st_size, st.st_mtime, st.st_ino, contentHash))
+
+	def deletedArcnames(self):
+		return sorted(entry[0] for entry in self.entries.itervalues())
+
+	def commit(self, archiveName, full):
+		# Only called once the archive is safely written, so a failed run is simply retried.
+		if full:
+			self.db.execute('DELETE FROM files')
+			self.state['lastFull'] = archiveName
+			self.state['incrementalsSinceFull'] = 0
+		else:
+			self.db.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in self.entries))
+			self.state['incrementalsSinceFull'] = int(self.state['incrementalsSinceFull']) + 1
+		self.state['lastArchive'] = archiveName
+		self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', self.updates)
+		self.db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)', self.state.items())
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+SMALL_FILE_SIZE = 1024 * 1024
+DEFAULT_READ_AHEAD_BYTES = 64 * 1024 * 1024
+READ_BATCH_SIZE = 1024
+
+def readSmallFile(path):
+	try:
+		with open(path, 'rb') as fileobj:
+			return fileobj.read()
+	except (IOError, OSError):
+		# Leave it to the archive writer, which reports the error.
+		return None
+
+def readEntries(entries, workers=4, maxBytes=DEFAULT_READ_AHEAD_BYTES):
+	# Yields (entry, data) pairs, where 'data' holds the contents of small regular files read ahead
+	# on a pool of 'workers' threads, and is None for everything else (large files are streamed
+	# by the archive writer itself). Entries are sorted by inode within batches, which roughly
+	# follows on-disk order, and no more than 'maxBytes' of file data or READ_BATCH_SIZE entries
+	# are in flight at once, so trees of empty or large files aren't buffered either.
+	from multiprocessing.pool import ThreadPool
+	if workers < 1:
+		for entry in entries:
+			yield (entry, None)
+		return
+
+	pool = ThreadPool(workers)
+	inFlight = collections.deque()
+	inFlightBytes = 0
+	try:
+		batch = []
+		for entry in itertools.chain(entries, [None]):
+			if entry is not None:
+				batch.append(entry)
+				if len(batch) < READ_BATCH_SIZE:
+					continue
+			batch.sort(key=lambda entry: entry.stat.st_ino)
+			for entry in batch:
+				size = entry.stat.st_size if stat.S_ISREG(entry.stat.st_mode) and 0 < entry.stat.st_size <= SMALL_FILE_SIZE else 0
+				while len(inFlight) >= READ_BATCH_SIZE or (len(inFlight) > 0 and inFlightBytes + size > maxBytes):
+					pendingEntry, result, pendingSize = inFlight.popleft()
+					inFlightBytes -= pendingSize
+					yield (pendingEntry, result.get() if result is not None else None)
+				inFlight.append((entry, pool.apply_async(readSmallFile, (entry.path,)) if size > 0 else None, size))
+				inFlightBytes += size
+			batch = []
+
+		while len(inFlight) > 0:
+			pendingEntry, result, pendingSize = inFlight.popleft()
+			yield (pendingEntry, result.get() if result is not None else None)
+	finally:
+		pool.terminate()
+		pool.join()
+
+def skipArchived(entries, archived, index=None):
+	# Passes on the entries a resumed archive doesn't hold yet, or holds with a different size or
+	# mtime because they changed after being checkpointed (the copy added now wins on extract),
+	# recording the others in the index. 'archived' maps member names to [size, mtime, hash].
+	for entry in entries:
+		member = archived.get(entry.arcname)
+		if member is None or member[1] != entry.stat.st_mtime or (member[0] is not None and member[0] != entry.stat.st_size):
+			yield entry
+		elif index is not None:
+			index.record(entry.path, entry.arcname, entry.stat, member[2])
+
+def archiveEntries(archive, entries, index=None, full=True, readWorkers=0, readAheadBytes=DEFAULT_READ_AHEAD_BYTES, metrics=NO_METRICS, archived=None, checkpoint=None, shared=None):
+	# Adds walked entries to the archive. With an index, only entries that are new or changed
+	# since the index was last committed are read (or all of them, for a full backup), and each
+	# added entry is recorded in the index. Entries already in a resumed archive ('archived' maps
+	# their names to content hashes) are only recorded. 'checkpoint' is called after each entry.
+	# Files already archived this run are referenced rather than read again (see SharedContent).
+	if index is not None:
+		entries = (entry for entry in entries if index.isChanged(entry.path, entry.stat) or full)
+	if archived:
+		entries = skipArchived(entries, archived, index)
+	if shared is not None:
+		entries = shareEntries(entries, archive, shared, index)
+	for entry, data in readEntries(entries, readWorkers, readAheadBytes):
+		try:
+			contentHash = archive.addFile(entry.path, entry.arcname, entry.stat, data)
+			if index is not None:
+				index.record(entry.path, entry.arcname, entry.stat, contentHash)
+			if shared is not None:
+				shared.offer(archive, entry, contentHash)
+		except (IOError, OSError) as e:
+			log('Warning: Could not archive {0}: {1}'.format(entry.path, e))
+			metrics.add('errors')
+		if checkpoint is not None:
+			checkpoint()
+
+#
+# Sharing content between targets.
+#
+
+REFS_MEMBER = 'goodbackup-refs.json'
+SAMPLE_BYTES = 64 * 1024
+
+def sampleHash(path, size):
+	# A quick fingerprint of a file's content: its content hash if it is small, or else the hash of
+	# its first and last SAMPLE_BYTES.
+	hasher = hashlib.new(HASH_ALGORITHM)
+	with open(path, 'rb') as fileobj:
+		if size <= 2 * SAMPLE_BYTES:
+			hasher.update(fileobj.read())
+		else:
+			hasher.update(fileobj.read(SAMPLE_BYTES))
+			fileobj.seek(size - SAMPLE_BYTES)
+			hasher.update(fileobj.read(SAMPLE_BYTES))
+	return hasher.hexdigest()
+
+class SharedContent(object):
+	# The files and database dumps archived so far in a run, so targets that overlap read and
+	# compress each copy only once. Files are matched on (device, inode, size, mtime) and confirmed
+	# by sampleHash; dumps on (host, database). What an archive holds is only shared with other
+	# targets once that archive is complete, so a reference never points into a failed archive,
+	# and only between archives encrypted with the same key (or both unencrypted).
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.files = {}
+		self.databases = {}
+		self.pending = collections.defaultdict(lambda: ({}, {}))
+
+	def fileKey(self, archive, st):
+		return (archive.keyId, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+	def find(self, archive, entry):
+		# Returns (archive name, member name, content hash) for an archived copy of the entry's
+		# file, looking in this archive first, or None.
+		if not stat.S_ISREG(entry.stat.st_mode) or entry.stat.st_size == 0:
+			return None
+		key = self.fileKey(archive, entry.stat)
+		with self.lock:
+			found = self.pending[archive.name][0].get(key) or self.files.get(key)
+		if found is None:
+			return None
+		archiveName, arcname, sample, contentHash = found
+		try:
+			if sampleHash(entry.path, entry.stat.st_size) != sample:
+				return None
+		except (IOError, OSError):
+			return None
+		return (archiveName, arcname, contentHash)
+
+	def offer(self, archive, entry, contentHash):
+		# Remembers a file just archived, to be shared once the archive is published.
+		size = entry.stat.st_size
+		if contentHash is None or size == 0:
+			return
+		try:
+			sample = contentHash if size <= 2 * SAMPLE_BYTES else sampleHash(entry.path, size)
+		except (IOError, OSError):
+			return
+		with self.lock:
+			self.pending[archive.name][0][self.fileKey(archive, entry.stat)] = (archive.name, entry.arcname, sample, contentHash)
+
+	def findDatabase(self, archive, host, dbname):
+		with self.lock:
+			return self.databases.get((archive.keyId, host, dbname))
+
+	def offerDatabase(self, archive, host, dbname):
+		with self.lock:
+			self.pending[archive.name][1][(archive.keyId, host, dbname)] = archive.name
+
+	def publish(self, archive):
+		# Shares everything offered from a completed archive with later targets of the run.
+		with self.lock:
+			files, databases = self.pending.pop(archive.name, ({}, {}))
+			for key, found in files.items():
+				self.files.setdefault(key, found)
+			for key, archiveName in databases.items():
+				self.databases.setdefault(key, archiveName)
+
+def shareEntries(entries, archive, shared, index=None):
+	# Passes on the entries whose content isn't archived yet this run. The others are added as
+	# references to the earlier copy, and recorded in the index.
+	for entry in entries:
+		found = shared.find(archive, entry)
+		if found is None:
+			yield entry
+			continue
+		contentHash = archive.addReference(entry.arcname, entry.stat, *found)
+		if index is not None:
+			index.record(entry.path, entry.arcname, entry.stat, contentHash)
+
+#
+# Deduplicating repository.
+#
+
+REPOSITORY_DIR = 'repository'
+PACK_SIZE = 64 * 1024 * 1024
+# New chunks are indexed in short transactions every so many chunks (and whenever a pack is
+# rotated), so concurrent writers to one repository never wait long on each other.
+INDEX_BATCH_CHUNKS = 1000
+CDC_MIN_SIZE = 64 * 1024
+CDC_MAX_SIZE = 1024 * 1024
+CDC_READ_SIZE = 4 * CDC_MAX_SIZE
+
+# Content-defined chunking: every byte is mapped to one bit through a fixed random table, and a
+# chunk ends wherever the bits of the last 18 bytes spell out a fixed anchor pattern (on average
+# every 256 KB). Boundaries depend only on nearby content, so an insertion shifts at most the
+# chunks around it. Both the mapping (str.translate) and the search (str.find) run in C, which is
+# far faster than a per-byte rolling hash in Python.
+cdcRandom = random.Random(0x676f6f64)
+CDC_TABLE = string.maketrans(''.join(chr(i) for i in range(256)), ''.join(cdcRandom.choice('01') for i in range(256)))
+CDC_ANCHOR = ''.join(cdcRandom.choice('01') for i in range(18))
+
+def iterContentChunks(stream):
+	buf = ''
+	bits = ''
+	pos = 0
+	eof = False
+	while True:
+		if not eof and len(buf) - pos < CDC_MAX_SIZE:
+			data = stream.read(CDC_READ_SIZE)
+			eof = len(data) == 0
+			buf = buf[pos:] + data
+			bits = buf.translate(CDC_TABLE)
+			pos = 0
+			continue
+		if pos >= len(buf):
+			return
+		limit = min(pos + CDC_MAX_SIZE, len(buf))
+		anchor = bits.find(CDC_ANCHOR, pos + CDC_MIN_SIZE - len(CDC_ANCHOR), limit)
+		cut = anchor + len(CDC_ANCHOR) if anchor >= 0 else limit
+		yield buf[pos:cut]
+		pos = cut
+
+class Repository(object):
+	# A content-addressed store shared by every target using the 'repository' output format.
+	# Unique chunks are zlib-compressed and appended to pack files, located through a SQLite
+	# index; each backup run adds a small snapshot manifest listing the chunks of every entry.
+	def __init__(self, path):
+		import sqlite3
+		self.path = path
+		for subdir in ['packs', 'snapshots']:
+			if not os.path.isdir(os.path.join(path, subdir)):
+				os.makedirs(os.path.join(path, subdir))
+		self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=60, check_same_thread=False)
+		self.db.execute('CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, pack INTEGER, offset INTEGER, length INTEGER, size INTEGER)')
+		self.lock = threading.Lock()
+		self.packNumber = None
+		self.packFile = None
+		self.readers = {}
+		self.pending = {}
+
+	def packPath(self, number):
+		return os.path.join(self.path, 'packs', '{0:08d}.pack'.format(number))
+
+	def openLock(self, mode):
+		# Backups hold a shared lock while writing; garbage collection needs it exclusively.
+		lockFile = open(os.path.join(self.path, 'lock'), 'a')
+		fcntl.flock(lockFile, mode)
+		return lockFile
+
+	def newPack(self):
+		# Claim the next unused pack number; O_EXCL keeps concurrent processes from sharing one.
+		number = max([int(name.split('.')[0]) for name in os.listdir(os.path.join(self.path, 'packs'))] + [0]) + 1
+		while True:
+			try:
+				fd = os.open(self.packPath(number), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0644)
+				break
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+				number += 1
+		if self.packFile is not None:
+			self.syncPack()
+			self.packFile.close()
+		self.packNumber = number
+		self.packFile = os.fdopen(fd, 'ab')
+
+	def hasChunk(self, chunkId):
+		with self.lock:
+			return chunkId in self.pending or self.db.execute('SELECT 1 FROM chunks WHERE id = ?', (chunkId,)).fetchone() is not None
+
+	def appendChunk(self, compressed):
+		# Appends to the current pack, rotating it when full; returns (pack, offset). Call
+		# holding the lock.
+		if self.packFile is None or self.packFile.tell() >= PACK_SIZE:
+			if len(self.pending) > 0:
+				self.commitIndex()
+			self.newPack()
+		offset = self.packFile.tell()
+		self.packFile.write(compressed)
+		return (self.packNumber, offset)
+
+	def storeChunk(self, chunkId, compressed, size):
+		# Returns False if the chunk is already stored. Another process may store the same chunk
+		# at the same time; the first to index it wins, and the other copy is never read.
+		with self.lock:
+			if chunkId in self.pending or self.db.execute('SELECT 1 FROM chunks WHERE id = ?', (chunkId,)).fetchone() is not None:
+				return False
+			pack, offset = self.appendChunk(compressed)
+			self.pending[chunkId] = (chunkId, pack, offset, len(compressed), size)
+			if len(self.pending) >= INDEX_BATCH_CHUNKS:
+				self.commitIndex()
+			return True
+
+	def readChunk(self, chunkId):
+		with self.lock:
+			row = self.pending.get(chunkId) or self.db.execute('SELECT id, pack, offset, length FROM chunks WHERE id = ?', (chunkId,)).fetchone()
+			pack, offset, length = row[1:4]
+			if pack == self.packNumber and self.packFile is not None:
+				self.packFile.flush()
+			if pack not in self.readers:
+				self.readers[pack] = open(self.packPath(pack), 'rb')
+			self.readers[pack].seek(offset)
+			return zlib.decompress(self.readers[pack].read(length))
+
+	def syncPack(self):
+		self.packFile.flush()
+		os.fsync(self.packFile.fileno())
+
+	def syncPacks(self):
+		# Makes the current pack's data, and the directory entries of new packs, durable; earlier
+		# packs were synced when they were rotated.
+		if self.packFile is not None:
+			self.syncPack()
+		fd = os.open(os.path.join(self.path, 'packs'), os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	def commitIndex(self):
+		# Indexes the chunks stored since the last call, once their data is durable. Call holding
+		# the lock.
+		self.syncPacks()
+		self.db.executemany('INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?, ?)', self.pending.values())
+		self.db.commit()
+		self.pending = {}
+
+	def commit(self):
+		with self.lock:
+			self.commitIndex()
+
+	def snapshotPath(self, name):
+		return os.path.join(self.path, 'snapshots', name + '.json.gz')
+
+	def writeSnapshot(self, name, manifest):
+		tempPath = self.snapshotPath(name) + '.tmp'
+		snapshotFile = gzip.open(tempPath, 'wb')
+		json.dump(manifest, snapshotFile)
+		snapshotFile.close()
+		os.rename(tempPath, self.snapshotPath(name))
+
+	def listSnapshots(self):
+		return sorted(name[:-len('.json.gz')] for name in os.listdir(os.path.join(self.path, 'snapshots')) if name.endswith('.json.gz'))
+
+	def loadSnapshot(self, name):
+		snapshotFile = gzip.open(self.snapshotPath(name), 'rb')
+		manifest = json.load(snapshotFile)
+		snapshotFile.close()
+		return manifest
+
+	def forgetSnapshot(self, name):
+		os.remove(self.snapshotPath(name))
+
+	def collectGarbage(self):
+		# Drops every chunk no snapshot refers to. Packs holding only dead chunks are deleted;
+		# packs holding a mix have their live chunks copied into a fresh pack first.
+		lockFile = self.openLock(fcntl.LOCK_EX)
+		try:
+			# Copied chunks go into a brand new pack, never one that is about to be deleted.
+			with self.lock:
+				if self.packFile is not None:
+					self.packFile.close()
+					self.packFile = None
+
+			live = set()
+			for name in self.listSnapshots():
+				for entry in self.loadSnapshot(name)['entries']:
+					live.update(entry.get('chunks', []))
+
+			packs = collections.defaultdict(list)
+			for row in self.db.execute('SELECT id, pack, offset, length, size FROM chunks'):
+				packs[row[1]].append(row)
+			removedChunks = 0
+			freedBytes = 0
+			for pack, rows in packs.iteritems():
+				dead = [row for row in rows if row[0] not in live]
+				if len(dead) == 0:
+					continue
+				moved = []
+				with self.lock:
+					with open(self.packPath(pack), 'rb') as packFile:
+						for row in rows:
+							if row[0] in live:
+								packFile.seek(row[2])
+								moved.append(self.appendChunk(packFile.read(row[3])) + (row[0],))
+					# The copies are durable before the index points at them, in one transaction.
+					self.syncPacks()
+					self.db.executemany('UPDATE chunks SET pack = ?, offset = ? WHERE id = ?', moved)
+					self.db.executemany('DELETE FROM chunks WHERE id = ?', ((row[0],) for row in dead))
+					self.db.commit()
+				if pack in self.readers:
+					self.readers.pop(pack).close()
+				os.remove(self.packPath(pack))
+				removedChunks += len(dead)
+				freedBytes += sum(row[3] for row in dead)
+			return (removedChunks, freedBytes)
+		finally:
+			lockFile.close()
+
+repositories = {}
+repositoriesLock = threading.Lock()
+
+def openRepository(path):
+	# Concurrent targets share one Repository object per path.
+	with repositoriesLock:
+		if path not in repositories:
+			repositories[path] = Repository(path)
+		return repositories[path]
+
+class RepositoryWriter(object):
+	# Writes one snapshot into a repository. Offers the same interface as ArchiveWriter.
+	def __init__(self, repository, name, readThrottle=None, writeThrottle=None):
+		self.repository = repository
+		self.name = name
+		self.readThrottle = readThrottle
+		self.writeThrottle = writeThrottle
+		self.entries = []
+		self.bytesIn = 0
+		self.filesIn = 0
+		self.bytesNew = 0
+		self.bytesOut = 0
+		self.lockFile = repository.openLock(fcntl.LOCK_SH)
+
+	def storeStream(self, stream):
+		# Returns the chunk ids, content hash and size of the stream, storing any new chunks.
+		chunkIds = []
+		hasher = hashlib.new(HASH_ALGORITHM)
+		size = 0
+		for chunk in iterContentChunks(stream):
+			chunkId = hashlib.sha256(chunk).hexdigest()
+			hasher.update(chunk)
+			size += len(chunk)
+			self.bytesIn += len(chunk)
+			if self.readThrottle is not None:
+				self.readThrottle.consume(len(chunk))
+			if not self.repository.hasChunk(chunkId):
+				compressed = zlib.compress(chunk, 6)
+				if self.writeThrottle is not None:
+					self.writeThrottle.consume(len(compressed))
+				try:
+					stored = self.repository.storeChunk(chunkId, compressed, len(chunk))
+				except (IOError, OSError) as e:
+					raise ArchiveWriteError(e)
+				if stored:
+					self.bytesNew += len(chunk)
+					self.bytesOut += len(compressed)
+			chunkIds.append(chunkId)
+		return (chunkIds, hasher.hexdigest(), size)
+
+	def addFile(self, path, arcname, st=None, data=None):
+		st = st or os.lstat(path)
+		entry = {'name': arcname, 'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime}
+		contentHash = None
+		if stat.S_ISLNK(st.st_mode):
+			entry.update(type='symlink', target=os.readlink(path))
+		elif stat.S_ISDIR(st.st_mode):
+			entry.update(type='dir')
+		elif stat.S_ISREG(st.st_mode):
+			if data is not None:
+				chunkIds, contentHash, size = self.storeStream(StringIO.StringIO(data))
+			else:
+				with open(path, 'rb') as fileobj:
+					chunkIds, contentHash, size = self.storeStream(fileobj)
+			entry.update(type='file', size=size, chunks=chunkIds)
+			self.filesIn += 1
+		else:
+			return None
+		self.entries.append(entry)
+		return contentHash
+
+	def addPath(self, path):
+		for entry in walkTree(path):
+			self.addFile(entry.path, entry.arcname, entry.stat)
+
+	def addStream(self, name, stream, chunkSize=None):
+		# Snapshot entries need no size up front, so streams are never split into members.
+		chunkIds, contentHash, size = self.storeStream(stream)
+		self.entries.append({'name': name, 'type': 'file', 'mode': 0644, 'mtime': time.time(), 'size': size, 'chunks': chunkIds})
+		return [name]
+
+	def addBuffer(self, name, data):
+		self.addStream(name, StringIO.StringIO(data))
+
+	def close(self):
+		try:
+			self.repository.commit()
+			self.repository.writeSnapshot(self.name, {'name': self.name, 'time': time.time(), 'entries': self.entries})
+		except (IOError, OSError) as e:
+			raise ArchiveWriteError(e)
+		self.lockFile.close()
+
+	def abort(self):
+		# Chunks stored so far stay in their packs, but no snapshot refers to them.
+		self.lockFile.close()
+
+def restoreSnapshot(repository, name, destDir):
+	# Recreates every entry of a snapshot under destDir.
+	entries = repository.loadSnapshot(name)['entries']
+	for entry in entries:
+		path = os.path.join(destDir, entry['name'])
+		if entry['type'] == 'dir':
+			if not os.path.isdir(path):
+				os.makedirs(path)
+			continue
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		if entry['type'] == 'symlink':
+			os.symlink(entry['target'], path)
+			continue
+		with open(path, 'wb') as outfile:
+			for chunkId in entry['chunks']:
+				outfile.write(repository.readChunk(chunkId))
+		os.chmod(path, entry['mode'])
+		os.utime(path, (entry['mtime'], entry['mtime']))
+
+	# Directory times last, since creating their contents updates them.
+	for entry in entries:
+		if entry['type'] == 'dir':
+			path = os.path.join(destDir, entry['name'])
+			os.chmod(path, entry['mode'])
+			os.utime(path, (entry['mtime'], entry['mtime']))
+
+#
+# Catalog and retention.
+#
+
+CATALOG_FILE = 'goodbackup-catalog.sqlite'
+
+# Retention attribute -> strftime pattern naming the period each kept backup stands for.
+RETENTION_PERIODS = [
+	('keepHourly', '%Y-%m-%d %H'),
+	('keepDaily', '%Y-%m-%d'),
+	('keepWeekly', '%G-%V'),
+	('keepMonthly', '%Y-%m'),
+]
+RETENTION_ATTRIBUTES = ['keepLast'] + [attrName for attrName, pattern in RETENTION_PERIODS]
+
+def parseArchiveName(name):
+	# Recovers (target, time, incremental) from '<target>backup<timestamp>[.incr].tar.<ext>[.enc]'.
+	match = re.match(r'^(.+)backup(\d{4}-\d{2}-\d{2}\.\d{2}-\d{2}-\d{2})(\.\d+)?(\.incr)?\.tar\.(gz|zst|lz4)(\.enc)?$', name)
+	if match is None:
+		return None
+	when = time.mktime(datetime.datetime.strptime(match.group(2), '%Y-%m-%d.%H-%M-%S').timetuple()) + float('0' + (match.group(3) or ''))
+	return (match.group(1), when, match.group(4) is not None)
+
+class Catalog(object):
+	# Every archive and snapshot produced into an output directory, kept in SQLite so retention
+	# never has to list or stat the directory. 'chain' names the full backup an incremental
+	# archive builds on (a full backup is its own chain). The refs table lists the archives each
+	# archive refers to for content it shares with them (see SharedContent).
+	def __init__(self, outputDir):
+		import sqlite3
+		self.outputDir = outputDir
+		path = os.path.join(outputDir, CATALOG_FILE)
+		isNew = not os.path.exists(path)
+		self.db = sqlite3.connect(path, timeout=60)
+		self.db.execute('CREATE TABLE IF NOT EXISTS archives (name TEXT PRIMARY KEY, target TEXT, time REAL, size INTEGER, checksum TEXT, kind TEXT, chain TEXT)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS archivesByTarget ON archives (target, time)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS refs (name TEXT, referenced TEXT)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS refsByReferenced ON refs (referenced)')
+		if isNew:
+			self.importExisting()
+		self.db.commit()
+
+	def importExisting(self):
+		# Adopts archives written before the catalog existed, once, when it is first created.
+		# Incremental archives are assumed to build on the latest full one before them.
+		found = []
+		for name in os.listdir(self.outputDir):
+			parsed = parseArchiveName(name)
+			if parsed is not None:
+				found.append((parsed[1], name, parsed[0], parsed[2]))
+		chains = {}
+		for when, name, target, incremental in sorted(found):
+			if not incremental:
+				chains[target] = name
+			size = os.path.getsize(os.path.join(self.outputDir, name))
+			self.db.execute('INSERT OR IGNORE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)',
+				(name, target, when, size, None, 'incr' if incremental else 'full', chains.get(target, name)))
+
+	def add(self, name, target, when, size, checksum, kind, chain=None):
+		self.db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)', (name, target, when, size, checksum, kind, chain or name))
+		self.db.commit()
+
+	def addReferences(self, name, referenced):
+		self.db.executemany('INSERT INTO refs VALUES (?, ?)', ((name, other) for other in referenced))
+		self.db.commit()
+
+	def isReferenced(self, name):
+		return self.db.execute('SELECT 1 FROM refs WHERE referenced = ? LIMIT 1', (name,)).fetchone() is not None
+
+	def archives(self, target):
+		# Newest first.
+		return self.db.execute('SELECT name, time, size, kind, chain FROM archives WHERE target = ? ORDER BY time DESC', (target,)).fetchall()
+
+	def remove(self, names):
+		self.db.executemany('DELETE FROM archives WHERE name = ?', ((name,) for name in names))
+		self.db.executemany('DELETE FROM refs WHERE name = ?', ((name,) for name in names))
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+def selectRetained(archives, policy):
+	# Given archives as (name, time, size, kind, chain) rows, newest first, returns the names to
+	# keep. 'policy' maps retention attributes to counts: keepLast keeps the newest N, and each
+	# periodic rule keeps the newest archive of each of the last N hours/days/weeks/months that
+	# have one. The newest archive is always kept, and keeping an archive keeps every older
+	# archive of its incremental chain, since a restore needs all of them.
+	kept = set(row[0] for row in archives[:max(1, policy.get('keepLast', 0))])
+	for attrName, pattern in RETENTION_PERIODS:
+		periods = set()
+		for row in archives:
+			if len(periods) >= policy.get(attrName, 0):
+				break
+			period = time.strftime(pattern, time.localtime(row[1]))
+			if period not in periods:
+				periods.add(period)
+				kept.add(row[0])
+	for row in archives:
+		if row[0] in kept and row[3] == 'incr':
+			kept.update(other[0] for other in archives if other[4] == row[4] and other[1] <= row[1])
+	return kept
+
+def pruneTarget(catalog, target, policy, repository=None, storage=None):
+	# Deletes the target's archives that the policy no longer retains from 'storage' (by default,
+	# the output folder), then drops them from the catalog in one batch. Archives that other
+	# archives still refer to are kept until those are gone. Returns (archives removed, bytes freed).
+	storage = storage or LocalStorage(catalog.outputDir)
+	archives = catalog.archives(target)
+	kept = selectRetained(archives, policy)
+	removed = []
+	freed = 0
+	for name, when, size, kind, chain in archives:
+		if name in kept or catalog.isReferenced(name):
+			continue
+		try:
+			if kind == 'snapshot':
+				repository.forgetSnapshot(name)
+			else:
+				for fileName in [name, name + ARCHIVE_INDEX_EXTENSION, name + MANIFEST_EXTENSION]:
+					storage.delete(fileName)
+		except (IOError, OSError) as e:
+			if getattr(e, 'errno', None) != errno.ENOENT:
+				log('Warning: Could not delete {0}: {1}'.format(name, e))
+				continue
+		removed.append(name)
+		freed += size or 0
+	catalog.remove(removed)
+	return (len(removed), freed)
+
+#
+# Checkpoints.
+#
+
+JOURNAL_EXTENSION = '.journal'
+DEFAULT_CHECKPOINT_BYTES = 256 * 1024 * 1024
+
+def journalPath(outputDir, targetName):
+	return os.path.join(outputDir, targetName + JOURNAL_EXTENSION)
+
+class Journal(object):
+	# An append-only record of a run's progress, so a run that is killed can resume from its last
+	# checkpoint rather than start over. The first line describes the run; every later line is one
+	# checkpoint, holding what was added since the one before (see ArchiveWriter.checkpoint) and
+	# the databases dumped. Each line is synced to disk; a line torn by a crash is ignored.
+	def __init__(self, path):
+		self.path = path
+		self.journalFile = None
+
+	def load(self):
+		# Returns (run, state) for an interrupted run with at least one checkpoint, or None.
+		try:
+			with open(self.path) as journalFile:
+				lines = journalFile.read().split('\n')
+		except IOError:
+			return None
+		records = []
+		for line in lines:
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				break
+		if len(records) < 2:
+			return None
+		state = {'blocks': [], 'members': [], 'checksums': [], 'refs': [], 'databaseRefs': [], 'databases': []}
+		for record in records[1:]:
+			for key in ['blocks', 'members', 'checksums', 'refs', 'databaseRefs', 'databases']:
+				state[key].extend(record[key])
+			for key in ['size', 'rawOffset', 'bytesIn', 'filesIn']:
+				state[key] = record[key]
+		return (records[0], state)
+
+	def begin(self, run, state=None):
+		# Starts the journal for a run. A resumed run's checkpoints so far are folded into one line,
+		# which also drops any torn line at the end.
+		self.journalFile = open(self.path + '.tmp', 'w')
+		self.append(run)
+		if state is not None:
+			self.append(state)
+		os.rename(self.path + '.tmp', self.path)
+
+	def append(self, record):
+		self.journalFile.write(json.dumps(record, separators=(',', ':')) + '\n')
+		self.journalFile.flush()
+		os.fsync(self.journalFile.fileno())
+
+	def remove(self):
+		if self.journalFile is not None:
+			self.journalFile.close()
+			self.journalFile = None
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+#
+# Verification.
+#
+
+class ChecksumReader(object):
+	# Checksums a file as it is read, throttled by an optional token bucket. GzipFile seeks back
+	# over data it has read ahead, so only bytes past the furthest point read so far are hashed.
+	def __init__(self, fileobj, bucket=None):
+		self.fileobj = fileobj
+		self.bucket = bucket
+		self.hasher = hashlib.new(HASH_ALGORITHM)
+		self.hashedTo = 0
+
+	def read(self, size=-1):
+		position = self.fileobj.tell()
+		data = self.fileobj.read(size)
+		if self.bucket is not None:
+			self.bucket.consume(len(data))
+		if position + len(data) > self.hashedTo:
+			self.hasher.update(data[self.hashedTo - position:] if position < self.hashedTo else data)
+			self.hashedTo = position + len(data)
+		return data
+
+	def seek(self, offset, whence=0):
+		self.fileobj.seek(offset, whence)
+
+	def tell(self):
+		return self.fileobj.tell()
+
+	def hexdigest(self):
+		return self.hasher.hexdigest()
+
+def openDecompressor(fileobj, codec):
+	# A reader over the concatenated blocks or frames of an archive.
+	if codec == 'zstd':
+		import zstandard
+		return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+	if codec == 'lz4':
+		import lz4.frame
+		return lz4.frame.LZ4FrameFile(fileobj)
+	return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+def verifyArchive(path, bytesPerSecond=None, key=None):
+	# Re-reads an archive once, checking the whole-file checksum and every member's checksum
+	# against its manifest. Returns a list of problems, empty if the archive is intact. Every
+	# frame of an encrypted archive is authenticated as it is decrypted, which stands in for the
+	# whole-file checksum.
+	import tarfile
+	encrypted = isEncryptedArchive(path)
+	if encrypted and key is None:
+		return ['Archive is encrypted; its key is needed to verify it.']
+	try:
+		manifest = json.loads(readSidecar(path + MANIFEST_EXTENSION, key))
+	except (IOError, ValueError) as e:
+		return ['No readable manifest: {0}'.format(e)]
+	if manifest['algorithm'] != HASH_ALGORITHM:
+		return ['Manifest uses {0}, which is not available here.'.format(manifest['algorithm'])]
+
+	problems = []
+	# A resumed archive may hold a file twice, if it changed after being checkpointed.
+	expected = collections.OrderedDict()
+	for entry in manifest['members']:
+		expected.setdefault(entry[0], []).append(entry[1:])
+	try:
+		with open(path, 'rb') as fileobj:
+			reader = ChecksumReader(fileobj, TokenBucket(bytesPerSecond) if bytesPerSecond else None)
+			source = DecryptingReader(reader, key) if encrypted else reader
+			tar = tarfile.open(fileobj=openDecompressor(source, archiveCodec(path)), mode='r|')
+			for member in tar:
+				if member.name not in expected:
+					continue
+				entry = expected[member.name].pop(0)
+				if len(expected[member.name]) == 0:
+					del expected[member.name]
+				size, contentHash = entry[:2]
+				hasher = hashlib.new(HASH_ALGORITHM)
+				data = tar.extractfile(member)
+				if len(entry) > 2:
+					# A sparse member's checksum covers its data runs; the holes would read as zeros.
+					for offset, length in entry[2]:
+						data.seek(offset)
+						while length > 0:
+							block = data.read(min(1024 * 1024, length))
+							if len(block) == 0:
+								break
+							hasher.update(block)
+							length -= len(block)
+				else:
+					for block in iter(lambda: data.read(1024 * 1024), ''):
+						hasher.update(block)
+				if hasher.hexdigest() != contentHash or member.size != size:
+					problems.append('Member {0} does not match its checksum.'.format(member.name))
+			tar.close()
+			# Anything after the end-of-archive marker still counts towards the file checksum.
+			while len(source.read(1024 * 1024)) > 0:
+				pass
+	except (IOError, EOFError, zlib.error, tarfile.TarError) as e:
+		problems.append('Archive is unreadable: {0}'.format(e))
+		return problems
+	for name in sorted(expected):
+		problems.append('Member {0} is missing.'.format(name))
+	if encrypted and os.path.getsize(path) != manifest['size']:
+		problems.append('Archive does not match its recorded size.')
+	elif not encrypted and reader.hexdigest() != manifest['checksum']:
+		problems.append('Archive does not match its checksum.')
+	return problems
+
+def verifyArchiveTask(args):
+	# Pool entry point; must be a module-level function so it can be pickled.
+	return (args[0], verifyArchive(*args))
+
+def verifyArchives(paths, workers, bytesPerSecond=None, keys=None):
+	# Verifies archives on 'workers' processes, so checksumming and decompression use every core.
+	# The read rate is split evenly between the workers. 'keys' maps the paths of encrypted
+	# archives to their keys. Yields (path, problems) as each finishes.
+	from multiprocessing import Pool
+	rate = bytesPerSecond / float(workers) if bytesPerSecond else None
+	tasks = [(path, rate, (keys or {}).get(path)) for path in paths]
+	if workers <= 1:
+		for task in tasks:
+			yield verifyArchiveTask(task)
+		return
+	pool = Pool(workers)
+	try:
+		for result in pool.imap_unordered(verifyArchiveTask, tasks):
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+#
+# Backup helper methods.
+#
+
+def getSetting(config, target, attrName, default=None):
+	# Target-level attributes override the defaults set on <output>.
+	val = target.get(attrName)
+	if val is None:
+		val = config.output.get(attrName)
+	return default if val is None else val
+
+def mysqlLoginArgs(username, password, host=None):
+	return ['--user=' + username, '--password=' + password] + (['--host=' + host] if host else [])
+
+def openDatabaseDump(dbname, username, password, tables=None, host=None, commandPrefix=()):
+	# 'commandPrefix' (see priorityCommand) lets the dump run at a lower priority.
+	import subprocess
+	return subprocess.Popen(
+		list(commandPrefix) + ['mysqldump'] + mysqlLoginArgs(username, password, host) + ['--single-transaction', '--add-drop-database', '--add-drop-table', '--hex-blob', dbname] + (tables or []),
+		stdout=subprocess.PIPE)
+
+def runMysqlQuery(dbname, username, password, query, host=None):
+	# Returns the result rows of a query as lists of column values, or None if the query failed.
+	import subprocess
+	try:
+		client = subprocess.Popen(
+			['mysql'] + mysqlLoginArgs(username, password, host) + ['--batch', '--skip-column-names', '--execute=' + query] + ([dbname] if dbname else []),
+			stdout=subprocess.PIPE)
+	except OSError as e:
+		log('Error: Could not run mysql for database {0}: {1}'.format(dbname, e))
+		return None
+	output = client.communicate()[0]
+	if client.returncode != 0:
+		return None
+	return [line.split('\t') for line in output.splitlines() if len(line) > 0]
+
+def dumpDatabase(archive, memberName, dbname, username, password, chunkSize=DEFAULT_CHUNK_SIZE, host=None, commandPrefix=()):
+	# Streams the dump straight from the mysqldump pipe into the archive, so no .sql file ever
+	# touches the output volume.
+	try:
+		dump = openDatabaseDump(dbname, username, password, host=host, commandPrefix=commandPrefix)
+	except OSError as e:
+		log('Error: Could not run mysqldump for database {0}: {1}'.format(dbname, e))
+		return False
+	archive.addStream(memberName, dump.stdout, chunkSize)
+	dump.stdout.close()
+	if dump.wait() != 0:
+		log('Error: mysqldump failed for database {0} (exit code {1}).'.format(dbname, dump.returncode))
+		return False
+	return True
+
+def dumpDatabaseTables(archive, memberPrefix, dbname, username, password, workers, chunkSize=DEFAULT_CHUNK_SIZE, host=None, commandPrefix=()):
+	# Dumps every table on its own mysqldump connection, 'workers' tables at a time. Each table
+	# becomes its own member(s) under '<memberPrefix>/', followed by a manifest.json describing the
+	# dump. Workers hand finished chunks to this thread through a bounded queue, so memory use
+	# stays around three chunks per worker. Each table is consistent in itself, but tables are
+	# snapshotted at different times, so the dump as a whole is not one consistent snapshot and
+	# carries no binary log position; use a single-connection dump where that matters.
+	from multiprocessing.pool import ThreadPool
+	tables = runMysqlQuery(dbname, username, password, 'SHOW TABLES', host)
+	if tables is None:
+		log('Error: Could not list tables for database {0}.'.format(dbname))
+		return False
+
+	# Each table records when its own transaction started.
+	manifest = {
+		'database': dbname,
+		'time': time.time(),
+		'consistent': False,
+		'tables': [{'name': row[0], 'members': [], 'bytes': 0, 'started': None} for row in tables],
+	}
+	chunks = Queue.Queue(workers)
+
+	def dumpTable(table):
+		returnCode = None
+		try:
+			table['started'] = time.time()
+			dump = openDatabaseDump(dbname, username, password, [table['name']], host, commandPrefix)
+			for memberName, data in iterStreamChunks('{0}/{1}.sql'.format(memberPrefix, table['name']), dump.stdout, chunkSize):
+				chunks.put((table, memberName, data))
+			dump.stdout.close()
+			returnCode = dump.wait()
+		finally:
+			chunks.put((table, None, returnCode))
+
+	pool = ThreadPool(workers)
+	pool.map_async(dumpTable, manifest['tables'])
+	pool.close()
+
+	# Archive chunks as they arrive until every table has reported back.
+	success = True
+	remaining = len(manifest['tables'])
+	while remaining > 0:
+		table, memberName, data = chunks.get()
+		if memberName is not None:
+			archive.addBuffer(memberName, data)
+			table['members'].append(memberName)
+			table['bytes'] += len(data)
+			continue
+		remaining -= 1
+		table['exitCode'] = data
+		if data != 0:
+			log('Error: mysqldump failed for table {0}.{1} (exit code {2}).'.format(dbname, table['name'], data))
+			success = False
+	pool.join()
+
+	archive.addBuffer(memberPrefix + '/manifest.json', json.dumps(manifest, indent=1, sort_keys=True))
+	return success
+
+def replayDatabaseDump(fileobjs, dbname, username, password, host=None):
+	# Pipes the given dump pieces, in order, into a mysql client.
+	import subprocess
+	import shutil
+	client = subprocess.Popen(['mysql'] + mysqlLoginArgs(username, password, host) + [dbname], stdin=subprocess.PIPE)
+	for fileobj in fileobjs:
+		shutil.copyfileobj(fileobj, client.stdin)
+		fileobj.close()
+	client.stdin.close()
+	return client.wait() == 0
+
+def openArchive(path, key=None):
+	# Opens an archive with tarfile, decrypting it on the fly if it is encrypted.
+	import tarfile
+	if not isEncryptedArchive(path):
+		return tarfile.open(path, 'r:*')
+	if key is None:
+		raise IOError('{0} is encrypted; its key is needed to read it.'.format(path))
+	return tarfile.open(fileobj=DecryptingReader(open(path, 'rb'), key), mode='r:*')
+
+def restoreDatabase(archivePath, dbname, username, password, workers=4, host=None, key=None):
+	# Restores a database from a backup archive. Per-table dumps are replayed on 'workers'
+	# parallel mysql connections; whole-database dumps are replayed as a single stream.
+	import tempfile
+	import shutil
+	from multiprocessing.pool import ThreadPool
+	tar = openArchive(archivePath, key)
+	allNames = tar.getnames()
+	# Only the names dumpDatabase and dumpDatabaseTables write, '<db>.<timestamp>.sql[.NNNNNN]'
+	# and '<db>.<timestamp>/manifest.json'; a backed-up file such as 'app.sql.gz' is left alone.
+	prefix = re.escape(dbname) + r'\.[0-9][0-9._-]*'
+	manifests = [name for name in allNames if re.match(prefix + r'/manifest\.json$', name)]
+	dumps = sorted(name for name in allNames if re.match(prefix + r'\.sql(\.[0-9]{6})?$', name))
+	if len(manifests) == 0 and len(dumps) == 0 and REFS_MEMBER in allNames:
+		# The dump may have been shared with another target's archive from the same run.
+		databaseRefs = json.load(tar.extractfile(REFS_MEMBER))['databases']
+		if dbname in databaseRefs:
+			tar.close()
+			log('Database {0} is stored in {1}.'.format(dbname, databaseRefs[dbname]))
+			return restoreDatabase(os.path.join(os.path.dirname(archivePath), databaseRefs[dbname]), dbname, username, password, workers, host, key)
+	if len(manifests) == 0 and len(dumps) == 0:
+		log('Error: No dump of database {0} found in {1}.'.format(dbname, archivePath))
+		tar.close()
+		return False
+	if runMysqlQuery(None, username, password, 'CREATE DATABASE IF NOT EXISTS `{0}`'.format(dbname), host) is None:
+		log('Error: Could not create database {0}.'.format(dbname))
+		tar.close()
+		return False
+
+	if len(manifests) == 0:
+		success = replayDatabaseDump([tar.extractfile(name) for name in dumps], dbname, username, password, host)
+		tar.close()
+		return success
+
+	# Per-table members are interleaved in the archive, so unpack them to a scratch directory
+	# first and replay each table from there.
+	manifest = json.load(tar.extractfile(sorted(manifests)[-1]))
+	scratchDir = tempfile.mkdtemp(prefix='goodbackup-restore-')
+	try:
+		tables = []
+		for table in manifest['tables']:
+			tar.extractall(scratchDir, [tar.getmember(name) for name in table['members']])
+			tables.append([os.path.join(scratchDir, name) for name in table['members']])
+		tar.close()
+
+		pool = ThreadPool(workers)
+		results = pool.map(lambda paths: replayDatabaseDump([open(path, 'rb') for path in paths], dbname, username, password, host), tables)
+		pool.close()
+		pool.join()
+		return all(results)
+	finally:
+		shutil.rmtree(scratchDir)
+
+logLock = threading.Lock()
+
+def log(line):
+	startTime = time.time()
+	timestamp = datetime.datetime.fromtimestamp(startTime).strftime('%Y-%m-%d %H:%M:%S.%f')
+	with logLock:
+		print '[{0}] {1}'.format(timestamp, line)
+		sys.stdout.flush()
+
+#
+# Scheduling.
+#
+
+class Job(object):
+	# A unit of work for a JobRunner. 'resources' lists the (kind, key) pairs the job occupies while it
+	# runs, e.g. ('device', 2049) or ('dbhost', 'localhost').
+	def __init__(self, name, func, resources=(), expectedSeconds=None):
+		self.name = name
+		self.func = func
+		self.resources = set(resources)
+		self.expectedSeconds = expectedSeconds
+		self.result = None
+		self.queueSeconds = 0
+		self.wallSeconds = 0
+		self.finishTime = None
+
+class JobRunner(object):
+	# Runs jobs on up to 'maxConcurrent' threads, never letting more than resourceLimits[kind] jobs
+	# hold the same resource at once. Jobs can be added while others run. Of the jobs waiting, those
+	# expected to take longest start first, with never-seen jobs treated as the longest, which keeps
+	# one slow job from running alone at the end.
+	def __init__(self, maxConcurrent, resourceLimits=None):
+		self.maxConcurrent = maxConcurrent
+		self.resourceLimits = resourceLimits or {}
+		self.pending = []
+		self.usage = collections.defaultdict(int)
+		self.running = 0
+		self.condition = threading.Condition()
+
+	def canStart(self, job):
+		for resource in job.resources:
+			if self.usage[resource] >= self.resourceLimits.get(resource[0], self.maxConcurrent):
+				return False
+		return True
+
+	def add(self, jobs, onFinish=None):
+		# Queues jobs; 'onFinish' is called with each one once it has run, on its own thread.
+		with self.condition:
+			for job in jobs:
+				self.pending.append((job, onFinish, time.time()))
+			self.pending.sort(key=lambda entry: -entry[0].expectedSeconds if entry[0].expectedSeconds is not None else float('-inf'))
+			self.startJobs()
+
+	def startJobs(self):
+		# Called holding the condition.
+		while self.running < self.maxConcurrent:
+			startable = [entry for entry in self.pending if self.canStart(entry[0])]
+			if len(startable) == 0:
+				return
+			job, onFinish, queued = startable[0]
+			self.pending.remove(startable[0])
+			for resource in job.resources:
+				self.usage[resource] += 1
+			self.running += 1
+			job.queueSeconds = time.time() - queued
+			thread = threading.Thread(target=self.runJob, args=(job, onFinish), name=job.name)
+			thread.daemon = True
+			thread.start()
+
+	def runJob(self, job, onFinish):
+		jobStart = time.time()
+		try:
+			job.result = job.func()
+		except Exception as e:
+			log('Error: "{0}" failed: {1}'.format(job.name, e))
+		finally:
+			job.finishTime = time.time()
+			job.wallSeconds = job.finishTime - jobStart
+			try:
+				if onFinish is not None:
+					onFinish(job)
+			finally:
+				with self.condition:
+					for resource in job.resources:
+						self.usage[resource] -= 1
+					self.running -= 1
+					self.startJobs()
+					self.condition.notify_all()
+
+	def wait(self):
+		# Blocks until every job added so far has run.
+		with self.condition:
+			while self.running > 0 or len(self.pending) > 0:
+				self.condition.wait(1)
+
+def runJobs(jobs, maxConcurrent, resourceLimits=None):
+	# Runs a fixed set of jobs (see JobRunner) and waits for them all.
+	runner = JobRunner(maxConcurrent, resourceLimits)
+	runner.add(jobs)
+	runner.wait()
+
+def historyPath(outputDir):
+	return os.path.join(outputDir, 'goodbackup-history.json')
+
+def loadHistory(outputDir):
+	# Per-target statistics from earlier runs, used to predict how long each target will take.
+	try:
+		with open(historyPath(outputDir)) as historyFile:
+			return json.load(historyFile)
+	except (IOError, ValueError):
+		return {}
+
+def saveHistory(outputDir, history):
+	tempPath = historyPath(outputDir) + '.tmp'
+	with open(tempPath, 'w') as historyFile:
+		json.dump(history, historyFile, indent=1, sort_keys=True)
+	os.rename(tempPath, historyPath(outputDir))
+
+def recordHistory(history, name, stats, finishTime):
+	# Keep an exponentially weighted average so one unusual run doesn't skew the prediction.
+	entry = history.setdefault(name, {})
+	for key in ['seconds', 'bytesIn', 'bytesOut']:
+		entry[key] = stats[key] if key not in entry else 0.7 * entry[key] + 0.3 * stats[key]
+	entry['bytesPerSecond'] = entry['bytesIn'] / max(entry['seconds'], 0.001)
+	if stats['success']:
+		entry['lastSuccess'] = finishTime
+
+DAEMON_RETRY_SECONDS = 15 * 60
+DAEMON_MAX_SLEEP_SECONDS = 60
+
+class Daemon(object):
+	# Backs up targets on their own intervals from a long-running process. Each target's next run
+	# sits on a timer heap, due one interval after its last successful completion; a target that
+	# was missed (the daemon was down, or an earlier run overran) is due at once, and runs once.
+	# Failed targets are retried after DAEMON_RETRY_SECONDS, or their interval if shorter. Each
+	# target runs as its own job, so a long backup never holds up the others; a target is off
+	# the heap while it runs, and goes back on when its job completes.
+	def __init__(self, configPath):
+		self.configPath = configPath
+		self.config = None
+		self.lastSuccess = {}
+		self.lastFailure = {}
+		self.heap = []
+		self.running = {}
+		self.runner = None
+		self.sharedBuckets = {}
+		self.lock = threading.Lock()
+		self.reloadRequested = False
+		self.stopRequested = False
+		self.load()
+
+	def load(self):
+		# (Re)reads the config, keeping the previous one if the new one is invalid. Running jobs
+		# finish under the config they started with.
+		config = loadCachedConfig(self.configPath)
+		if not config.isValid():
+			for error in config.errors:
+				log('Config error: ' + error)
+			if self.config is None:
+				raise ValueError('Invalid configuration file: {0}'.format(self.configPath))
+			log('Invalid configuration file; keeping the previous configuration.')
+			return
+		maxConcurrent, resourceLimits = jobLimits(config)
+		if self.runner is None:
+			self.runner = JobRunner(maxConcurrent, resourceLimits)
+		else:
+			with self.runner.condition:
+				self.runner.maxConcurrent, self.runner.resourceLimits = (maxConcurrent, resourceLimits)
+		self.sharedBuckets = totalBuckets(config)
+		with self.lock:
+			self.config = config
+			for name, entry in loadHistory(config.output.get('path')).items():
+				if 'lastSuccess' in entry:
+					self.lastSuccess[name] = max(entry['lastSuccess'], self.lastSuccess.get(name, 0))
+			self.heap = []
+			for target in config.targets:
+				if target.get('name') not in self.running:
+					heapq.heappush(self.heap, (self.nextDue(target), target.get('name')))
+		log('Loaded {0} targets from {1}.'.format(len(config.targets), self.configPath))
+
+	def nextDue(self, target):
+		name = target.get('name')
+		interval = targetInterval(target)
+		due = self.lastSuccess[name] + interval if name in self.lastSuccess else 0
+		if self.lastFailure.get(name, 0) > self.lastSuccess.get(name, 0):
+			due = max(due, self.lastFailure[name] + min(interval, DAEMON_RETRY_SECONDS))
+		return due
+
+	def secondsUntilDue(self):
+		with self.lock:
+			return max(0, self.heap[0][0] - time.time()) if len(self.heap) > 0 else None
+
+	def runDue(self):
+		# Starts a job for every target that is due now and not still running, without waiting
+		# for them. Returns the names of the targets started.
+		now = time.time()
+		names = []
+		with self.lock:
+			config = self.config
+			while len(self.heap) > 0 and self.heap[0][0] <= now:
+				due, name = heapq.heappop(self.heap)
+				if name in self.running:
+					continue
+				if due > 0 and now - due > 60:
+					log('Target "{0}" is {1:.0f}s overdue; catching up.'.format(name, now - due))
+				names.append(name)
+		if len(names) == 0:
+			return []
+
+		targets = [config.targetsByName[name] for name in names]
+		if not os.path.isdir(config.output.get('path')):
+			log("Error: No such path: {0}. Aborting backup.".format(config.output.get('path')))
+			jobs = [Job(name, None) for name in names]
+			for job in jobs:
+				self.finish(job)
+			return names
+		jobs, jobMetrics = backupJobs(config, targets, now, self.sharedBuckets)
+		with self.lock:
+			for job in jobs:
+				self.running[job.name] = job
+		self.runner.add(jobs, lambda job: self.finish(job, config, jobMetrics))
+		return names
+
+	def finish(self, job, config=None, jobMetrics=None):
+		# Records a target's run and puts it back on the heap, due again from now.
+		if config is not None:
+			recordJobs(config, [job], jobMetrics)
+		with self.lock:
+			self.running.pop(job.name, None)
+			if job.result is not None and job.result['success']:
+				self.lastSuccess[job.name] = job.finishTime
+			else:
+				self.lastFailure[job.name] = time.time()
+			target = self.config.targetsByName.get(job.name)
+			if target is not None:
+				heapq.heappush(self.heap, (self.nextDue(target), job.name))
+
+	def wait(self):
+		# Blocks until every target started so far has finished.
+		self.runner.wait()
+
+	def run(self):
+		signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reloadRequested', True))
+		signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopRequested', True))
+		signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stopRequested', True))
+		log('Backup daemon started (pid {0}).'.format(os.getpid()))
+		while not self.stopRequested:
+			if self.reloadRequested:
+				self.reloadRequested = False
+				self.load()
+			self.runDue()
+			# Sleep until the next target is due; signals cut the sleep short. Targets rescheduled
+			# in the meantime are looked at again within DAEMON_MAX_SLEEP_SECONDS.
+			wait = self.secondsUntilDue()
+			if not self.stopRequested and not self.reloadRequested:
+				time.sleep(DAEMON_MAX_SLEEP_SECONDS if wait is None else min(wait, DAEMON_MAX_SLEEP_SECONDS))
+		if len(self.running) > 0:
+			log('Waiting for {0} running targets to finish.'.format(len(self.running)))
+		self.wait()
+		log('Backup daemon stopped.')
+
+#
+# Planning.
+#
+
+# Past this many entries, a folder is sized by probing random paths instead of walking all of it.
+PLAN_WALK_ENTRIES = 100000
+PLAN_PROBES = 200
+PLAN_SAMPLE_FILES = 32
+PLAN_SAMPLE_BYTES = 256 * 1024
+TAR_HEADER_SIZE = 512
+
+class SourceEstimate(object):
+	# Running totals of what a target's sources would put into an archive, and a sample of its
+	# files to measure compressibility on. Files are sampled in proportion to their size (weighted
+	# reservoir sampling), so each one counts for as much as its data would in the archive.
+	# Entries found by probeTree stand for 'weight' entries each.
+	def __init__(self, rand):
+		self.rand = rand
+		self.entries = 0
+		self.files = 0
+		self.bytes = 0
+		self.sampled = False
+		self.samples = []
+
+	def add(self, path, st, weight=1):
+		self.entries += weight
+		if not stat.S_ISREG(st.st_mode):
+			return
+		self.files += weight
+		self.bytes += weight * st.st_size
+		if st.st_size > 0:
+			heapq.heappush(self.samples, (self.rand.random() ** (1.0 / (weight * st.st_size)), path))
+			if len(self.samples) > PLAN_SAMPLE_FILES:
+				heapq.heappop(self.samples)
+
+	def samplePaths(self):
+		return [path for key, path in self.samples]
+
+def probeTree(estimate, source, includes=(), excludes=(), probes=PLAN_PROBES):
+	# Sizes a huge tree without walking it (Knuth's estimator). Each probe follows one random path
+	# down from 'source', counting every directory on it as many times as there are directories
+	# like it at that depth: the product of the branching factors above it. Averaged over the
+	# probes, the counts are unbiased, and exact for a tree with the same shape throughout.
+	for probe in range(probes):
+		dirpath = source
+		dirStat = os.lstat(source)
+		relroot = ''
+		weight = 1.0 / probes
+		while True:
+			try:
+				listing = listDirectory(dirpath, dirStat)
+			except OSError:
+				break
+			subdirs = []
+			for name, st in listing:
+				if matchesPattern(relroot + name, name, excludes):
+					continue
+				if stat.S_ISDIR(st.st_mode):
+					subdirs.append((name, st))
+				elif len(includes) > 0 and not matchesPattern(relroot + name, name, includes):
+					continue
+				estimate.add(os.path.join(dirpath, name), st, weight)
+			if len(subdirs) == 0:
+				break
+			name, dirStat = estimate.rand.choice(subdirs)
+			dirpath = os.path.join(dirpath, name)
+			relroot += name + '/'
+			weight *= len(subdirs)
+	estimate.sampled = True
+
+def estimateFolder(estimate, folder, workers=1, index=None):
+	# Adds a folder's entries to the estimate: only those changed since the last run, given an
+	# incremental index. Folders too big to walk quickly are probed instead, and then counted in
+	# full, since probing can't tell what changed.
+	includes = [include.get('pattern') for include in folder.findall('./include')]
+	excludes = [exclude.get('pattern') for exclude in folder.findall('./exclude')]
+	entries = list(itertools.islice(walkTree(folder.get('path'), includes, excludes, workers), PLAN_WALK_ENTRIES + 1))
+	if len(entries) > PLAN_WALK_ENTRIES:
+		estimate.add(entries[0].path, entries[0].stat)
+		probeTree(estimate, folder.get('path'), includes, excludes)
+		return
+	for entry in entries:
+		if index is None or index.isChanged(entry.path, entry.stat):
+			estimate.add(entry.path, entry.stat)
+
+def sampleCompressionRatio(paths, codec):
+	# Compresses the start of each file with the codec, returning the mean ratio, or None.
+	compressBlock = CODECS[codec][2]
+	ratios = []
+	for path in paths:
+		try:
+			with open(path, 'rb') as fileobj:
+				data = fileobj.read(PLAN_SAMPLE_BYTES)
+		except (IOError, OSError):
+			continue
+		if len(data) > 0:
+			ratios.append(len(compressBlock(data, CODECS[codec][1])) / float(len(data)))
+	return sum(ratios) / len(ratios) if len(ratios) > 0 else None
+
+def estimateDatabase(database, credential, codec):
+	# Returns (size, compression ratio) for a database dump, either of which may be None. The size
+	# is the database's data length; the ratio comes from compressing the start of a dump.
+	dbname = database.get('name')
+	rows = runMysqlQuery(None, credential.get('username'), credential.get('password'),
+		"SELECT COALESCE(SUM(data_length), 0) FROM information_schema.tables WHERE table_schema = '{0}'".format(dbname), credential.get('host'))
+	size = int(rows[0][0]) if rows and rows[0][0].isdigit() else None
+	try:
+		dump = openDatabaseDump(dbname, credential.get('username'), credential.get('password'), host=credential.get('host'))
+	except OSError:
+		return (size, None)
+	data = dump.stdout.read(PLAN_SAMPLE_BYTES)
+	try:
+		dump.kill()
+	except OSError:
+		pass
+	dump.stdout.close()
+	dump.wait()
+	ratio = len(CODECS[codec][2](data, CODECS[codec][1])) / float(len(data)) if len(data) > 0 else None
+	return (size, ratio)
+
+#
+# Configuration model.
+#
+
+# Attributes that may be set on <output> and overridden per target, with their minimum values.
+ARCHIVE_INT_ATTRIBUTES = [
+	('compressionWorkers', 1),
+	('compressionBlockSize', 1),
+	('dumpChunkSize', 1),
+	('walkWorkers', 1),
+	('readWorkers', 0),
+	('readAheadBytes', 1),
+	('keepLast', 0),
+	('keepHourly', 0),
+	('keepDaily', 0),
+	('keepWeekly', 0),
+	('keepMonthly', 0),
+	('readBytesPerSecond', 1),
+	('writeBytesPerSecond', 1),
+	('maxLoadAverage', 1),
+	('maxDiskQueue', 1),
+	('niceLevel', 0),
+	('checkpointBytes', 1),
+]
+ARCHIVE_ENUM_ATTRIBUTES = [
+	('codec', CODECS.keys()),
+	('format', ['archive', 'repository']),
+	('metrics', ['true', 'false']),
+	('blockIndex', ['true', 'false']),
+	('ioClass', IO_CLASSES.keys()),
+	('cipher', CIPHERS.keys()),
+]
+OUTPUT_INT_ATTRIBUTES = [
+	('maxConcurrentTargets', 1),
+	('maxTargetsPerDevice', 1),
+	('maxTargetsPerDatabaseHost', 1),
+	('verifyWorkers', 1),
+	('verifyBytesPerSecond', 1),
+	('totalReadBytesPerSecond', 1),
+	('totalWriteBytesPerSecond', 1),
+]
+OUTPUT_ENUM_ATTRIBUTES = [
+	('shareContent', ['true', 'false']),
+]
+S3_INT_ATTRIBUTES = [
+	('uploadWorkers', 1),
+	('partSize', S3_MIN_PART_SIZE),
+]
+TARGET_INT_ATTRIBUTES = [
+	('fullEveryN', 1),
+]
+TARGET_ENUM_ATTRIBUTES = [
+	('incremental', ['true', 'false']),
+	('statCache', ['true', 'false']),
+]
+
+class LineNumberingTreeBuilder(ET.TreeBuilder):
+	# Remembers the line each element starts on, so config errors can point at it.
+	def __init__(self):
+		ET.TreeBuilder.__init__(self)
+		self.parser = None
+		self.lines = {}
+
+	def start(self, tag, attrs):
+		elem = ET.TreeBuilder.start(self, tag, attrs)
+		self.lines[elem] = self.parser._parser.CurrentLineNumber
+		return elem
+
+class Config(object):
+	# A configuration file compiled into indexes: credentials and targets by name, plus every
+	# validation error found, each prefixed with the line it occurs on.
+	def __init__(self, root, lines=None):
+		self.root = root
+		self.lines = lines or {}
+		self.errors = []
+		self.output = None
+		self.credentials = {}
+		self.targets = []
+		self.targetsByName = {}
+
+	def isValid(self):
+		return len(self.errors) == 0
+
+	def error(self, elem, message):
+		line = self.lines.get(elem)
+		self.errors.append('line {0}: {1}'.format('?' if line is None else line, message))
+
+	def checkRequired(self, elem, attrName):
+		if not isString(elem.get(attrName)):
+			self.error(elem, '<{0}> is missing required attribute "{1}".'.format(elem.tag, attrName))
+			return False
+		return True
+
+	def checkInt(self, elem, attrName, minValue=None, required=False):
+		val = elem.get(attrName)
+		if val is None:
+			if required:
+				self.error(elem, '<{0}> is missing required attribute "{1}".'.format(elem.tag, attrName))
+		elif not isInt(val) or (minValue is not None and int(val) < minValue):
+			self.error(elem, '<{0}> attribute "{1}" must be an integer{2}, not "{3}".'.format(
+				elem.tag, attrName, '' if minValue is None else ' of at least {0}'.format(minValue), val))
+
+	def checkEnum(self, elem, attrName, values):
+		if elem.get(attrName) is not None and elem.get(attrName) not in values:
+			self.error(elem, '<{0}> attribute "{1}" must be one of {2}, not "{3}".'.format(
+				elem.tag, attrName, ', '.join(sorted(values)), elem.get(attrName)))
+
+	def checkUnique(self, elem, attrName, seen, what):
+		if elem.get(attrName) in seen:
+			self.error(elem, 'Duplicate {0} "{1}" (first defined on line {2}).'.format(
+				what, elem.get(attrName), self.lines.get(seen[elem.get(attrName)], '?')))
+		else:
+			seen[elem.get(attrName)] = elem
+
+	def credentialFor(self, database):
+		return self.credentials[database.get('credential')]
+
+def compileConfig(root, lines=None):
+	# Validates and indexes a configuration in a single pass over the tree.
+	config = Config(root, lines)
+	if root.tag != 'settings':
+		config.error(root, 'Top-level element must be <settings>, not <{0}>.'.format(root.tag))
+		return config
+
+	sections = collections.defaultdict(list)
+	for elem in root:
+		sections[elem.tag].append(elem)
+	for tag in ['output', 'credentials', 'targets']:
+		for elem in sections[tag][1:]:
+			config.error(elem, 'Duplicate <{0}> section (first defined on line {1}).'.format(tag, config.lines.get(sections[tag][0], '?')))
+	if len(sections['output']) == 0:
+		config.error(root, 'Missing required <output> section.')
+	else:
+		config.output = sections['output'][0]
+		config.checkRequired(config.output, 'path')
+		for attrName, minValue in OUTPUT_INT_ATTRIBUTES + ARCHIVE_INT_ATTRIBUTES:
+			config.checkInt(config.output, attrName, minValue)
+		for attrName, values in OUTPUT_ENUM_ATTRIBUTES + ARCHIVE_ENUM_ATTRIBUTES:
+			config.checkEnum(config.output, attrName, values)
+		for s3 in config.output.findall('./s3'):
+			config.checkRequired(s3, 'bucket')
+			for attrName, minValue in S3_INT_ATTRIBUTES:
+				config.checkInt(s3, attrName, minValue)
+
+	# Index credentials by name.
+	for section in sections['credentials']:
+		for credential in section.findall('./credential'):
+			for attrName in ['name', 'username', 'password']:
+				config.checkRequired(credential, attrName)
+			config.checkUnique(credential, 'name', config.credentials, 'credential')
+
+	# Index targets by name, checking their sources as we go. Credential references are resolved
+	# once every credential is known, since a target may precede the <credentials> section.
+	references = []
+	for section in sections['targets']:
+		for target in section.findall('./target'):
+			config.targets.append(target)
+			config.checkRequired(target, 'name')
+			if target.get('intervalHours') is None and target.get('intervalMinutes') is None:
+				config.error(target, '<target> needs an "intervalHours" or "intervalMinutes" attribute.')
+			config.checkInt(target, 'intervalHours', 1)
+			config.checkInt(target, 'intervalMinutes', 1)
+			for attrName, minValue in ARCHIVE_INT_ATTRIBUTES + TARGET_INT_ATTRIBUTES:
+				config.checkInt(target, attrName, minValue)
+			for attrName, values in ARCHIVE_ENUM_ATTRIBUTES + TARGET_ENUM_ATTRIBUTES:
+				config.checkEnum(target, attrName, values)
+			config.checkUnique(target, 'name', config.targetsByName, 'target')
+
+			folders = {}
+			files = {}
+			databases = {}
+			for source in target:
+				if source.tag == 'folder':
+					config.checkRequired(source, 'path')
+					config.checkEnum(source, 'snapshot', SNAPSHOT_METHODS.keys() + ['auto'])
+					config.checkUnique(source, 'path', folders, 'folder')
+					for pattern in source:
+						if pattern.tag in ['include', 'exclude']:
+							config.checkRequired(pattern, 'pattern')
+				elif source.tag == 'file':
+					config.checkRequired(source, 'path')
+					config.checkUnique(source, 'path', files, 'file')
+				elif source.tag == 'database':
+					config.checkRequired(source, 'name')
+					if config.checkRequired(source, 'credential'):
+						references.append(source)
+					config.checkInt(source, 'parallelTables', 1)
+					config.checkUnique(source, 'name', databases, 'database')
+
+	for database in references:
+		if database.get('credential') not in config.credentials:
+			config.error(database, '<database> "{0}" references unknown credential "{1}".'.format(database.get('name'), database.get('credential')))
+	return config
+
+def loadConfig(source):
+	# Parses a config file (a path or file object), recording line numbers for error messages.
+	builder = LineNumberingTreeBuilder()
+	parser = ET.XMLParser(target=builder)
+	builder.parser = parser
+	try:
+		root = ET.parse(source, parser).getroot()
+	except ET.ParseError as e:
+		config = Config(None)
+		config.errors.append('line {0}: Malformed XML: {1}'.format(e.position[0], e))
+		return config
+	return compileConfig(root, builder.lines)
+
+CONFIG_CACHE_VERSION = 2
+
+def configCachePath(path):
+	return os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.cache')
+
+def packElement(elem):
+	# An element tree as nested tuples that marshal can store.
+	return (elem.tag, elem.attrib, elem.text, elem.tail, [packElement(child) for child in elem])
+
+def unpackElement(packed):
+	tag, attrib, text, tail, children = packed
+	elem = ET.Element(tag, attrib)
+	elem.text = text
+	elem.tail = tail
+	for child in children:
+		elem.append(unpackElement(child))
+	return elem
+
+def indexConfig(root, errors):
+	# Rebuilds a compiled config from its tree and the errors found when it was compiled, without
+	# validating it again. Where names repeat, the first one wins, as in compileConfig.
+	config = Config(root)
+	config.errors = list(errors)
+	config.output = root.find('./output')
+	for credential in root.findall('./credentials/credential'):
+		config.credentials.setdefault(credential.get('name'), credential)
+	for target in root.findall('./targets/target'):
+		config.targets.append(target)
+		config.targetsByName.setdefault(target.get('name'), target)
+	return config
+
+def loadCachedConfig(path):
+	# Loads a compiled config from the cache next to it, skipping parsing and validation, as long
+	# as the file's path, mtime, size and content hash (and this module) are unchanged. Otherwise
+	# the config is compiled afresh and the cache rewritten. The cache holds the config's
+	# passwords, so it gets the config's owner and permissions (and is never more open than
+	# 0600 until then), and one owned by anyone else is ignored. It is stored with marshal, which
+	# unlike pickle can't be made to run code.
+	path = os.path.abspath(path)
+	with open(path, 'rb') as configFile:
+		data = configFile.read()
+		st = os.fstat(configFile.fileno())
+	key = (CONFIG_CACHE_VERSION, path, st.st_mtime, st.st_size, hashlib.sha1(data).hexdigest(), os.path.getmtime(__file__))
+	cachePath = configCachePath(path)
+	try:
+		with open(cachePath, 'rb') as cacheFile:
+			if os.fstat(cacheFile.fileno()).st_uid in [os.geteuid(), st.st_uid]:
+				cachedKey, errors, root = marshal.load(cacheFile)
+				if cachedKey == key:
+					return indexConfig(unpackElement(root), errors)
+	except Exception:
+		# A missing, stale or unreadable cache just means compiling the config again.
+		pass
+
+	config = loadConfig(StringIO.StringIO(data))
+	if config.root is None:
+		return config
+	try:
+		tempPath = cachePath + '.tmp'
+		if os.path.lexists(tempPath):
+			os.remove(tempPath)
+		fd = os.open(tempPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0600)
+		with os.fdopen(fd, 'wb') as cacheFile:
+			if os.geteuid() == 0:
+				os.fchown(fd, st.st_uid, st.st_gid)
+			os.fchmod(fd, stat.S_IMODE(st.st_mode) & 0666)
+			marshal.dump((key, config.errors, packElement(config.root)), cacheFile)
+		os.rename(tempPath, cachePath)
+	except (IOError, OSError) as e:
+		log('Warning: Could not write config cache {0}: {1}'.format(cachePath, e))
+	return config
+
+#
+# Public API methods.
+#
+
+def validateConfig(root):
+	return compileConfig(root).isValid()
+
+def targetResources(config, target, outputDir):
+	# The devices a target reads from or writes to, and the database hosts it dumps from.
+	resources = [('device', os.stat(outputDir).st_dev)]
+	for source in target.findall('./folder') + target.findall('./file'):
+		if os.path.exists(source.get('path')):
+			resources.append(('device', os.stat(source.get('path')).st_dev))
+	for database in target.findall('./database'):
+		credential = config.credentialFor(database)
+		resources.append(('dbhost', credential.get('host', 'localhost')))
+	return resources
+
+def sharedContentResources(config, targets):
+	# With shared content, targets whose folders, files or databases overlap run one after the
+	# other, so each can refer to what the ones before it archived (SharedContent only shares
+	# complete archives). Returns target name -> a 'content' resource held by every target in its
+	# group, for groups of more than one target.
+	def sources(target):
+		paths = [os.path.realpath(source.get('path')) for source in target.findall('./folder') + target.findall('./file')]
+		databases = set((config.credentialFor(database).get('host', 'localhost'), database.get('name')) for database in target.findall('./database'))
+		return (paths, databases)
+
+	def isWithin(path, other):
+		return path == other or path.startswith(other.rstrip('/') + '/')
+
+	def overlaps(first, second):
+		if len(first[1] & second[1]) > 0:
+			return True
+		return any(isWithin(path, other) or isWithin(other, path) for path in first[0] for other in second[0])
+
+	targetSources = [sources(target) for target in targets]
+	groups = range(len(targets))
+	for i in range(len(targets)):
+		for j in range(i):
+			if groups[i] != groups[j] and overlaps(targetSources[i], targetSources[j]):
+				merged = groups[i]
+				groups = [groups[j] if group == merged else group for group in groups]
+	return dict((target.get('name'), [('content', targets[groups[i]].get('name'))]) for i, target in enumerate(targets) if groups.count(groups[i]) > 1)
+
+def targetThrottles(config, target, sharedBuckets=None):
+	# The read and write throttles for a target: its own limits, the limits shared by all targets
+	# (token buckets in 'sharedBuckets', keyed 'read' and 'write') and its load thresholds.
+	sharedBuckets = sharedBuckets or {}
+	maxLoad = getSetting(config, target, 'maxLoadAverage')
+	maxQueue = getSetting(config, target, 'maxDiskQueue')
+	throttles = []
+	for direction in ['read', 'write']:
+		rate = getSetting(config, target, direction + 'BytesPerSecond')
+		throttles.append(Throttle(
+			[TokenBucket(int(rate)) if rate is not None else None, sharedBuckets.get(direction)],
+			int(maxLoad) if maxLoad is not None else None,
+			int(maxQueue) if maxQueue is not None else None))
+	return throttles
+
+def targetCipher(config, target, useRepository=False):
+	# The cipher a target's archives are encrypted with, or None if they are not encrypted.
+	keyPath = getSetting(config, target, 'encryptionKey')
+	if keyPath is None:
+		return None
+	if useRepository:
+		raise ValueError('repository snapshots cannot be encrypted')
+	if not isEncryptionAvailable():
+		raise ImportError('the Python "cryptography" module is not installed')
+	return BlockCipher(loadEncryptionKey(keyPath), getSetting(config, target, 'cipher', 'aes-gcm'))
+
+def backupTarget(config, target, outputDir, timestamp, metrics=NO_METRICS, sharedBuckets=None, sharedContent=None):
+	# Backs up a single target, returning statistics about the archive produced. Phase timings and
+	# counters go to 'metrics'; 'sharedBuckets' holds the I/O limits shared with other targets, and
+	# 'sharedContent' what they have archived so far this run (see SharedContent).
+	# Only one run works on a target at a time, since a run may resume another's journal.
+	lockFile = open(os.path.join(outputDir, target.get('name') + '.lock'), 'w')
+	try:
+		try:
+			fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			log('Warning: "{0}" is still being backed up by another run; skipping it.'.format(target.get('name')))
+			metrics.add('errors')
+			return {'bytesIn': 0, 'bytesOut': 0, 'seconds': 0, 'throttleSeconds': 0, 'success': False}
+		return archiveTarget(config, target, outputDir, timestamp, metrics, sharedBuckets, sharedContent)
+	finally:
+		lockFile.close()
+
+def resumableRun(journal, storage, settings):
+	# The interrupted run recorded in a journal as (run, state), if it was made with the same
+	# settings and its partial archive is still there; otherwise None.
+	interrupted = journal.load()
+	if interrupted is None or interrupted[0]['settings'] != settings:
+		return None
+	if not os.path.isfile(storage.partialPath(interrupted[0]['archive'])):
+		return None
+	return interrupted
+
+def archiveTarget(config, target, outputDir, timestamp, metrics=NO_METRICS, sharedBuckets=None, sharedContent=None):
+	# The body of backupTarget, run while holding the target's lock.
+	import tarfile
+	folders = []
+	databases = []
+	files = []
+	stats = {'bytesIn': 0, 'bytesOut': 0, 'seconds': 0, 'throttleSeconds': 0, 'success': True}
+	log('Starting backup for "{0}".'.format(target.get('name')))
+	
+	# Add folder targets to source list.
+	for folder in target.findall('./folder'):
+		if os.path.isdir(folder.get('path')):
+			folders.append(folder)
+		else:
+			log("Warning: Could not find folder " + folder.get('path') + ".")
+			metrics.add('errors')
+			
+	# Add database targets to source list.
+	for database in target.findall('./database'):
+		databases.append((database, config.credentialFor(database)))
+	
+	# Add file targets to source list.
+	for file in target.findall('./file'):
+		if os.path.isfile(file.get('path')):
+			files.append(file.get('path'))
+		else:
+			log("Warning: Could not find file " + file.get('path') + ".")
+			metrics.add('errors')
+
+	# Create the archive, streaming database dumps into it as we go.
+	sourceCount = len(folders) + len(databases) + len(files)
+	if sourceCount > 0:
+		# Incremental targets only archive what changed since the last run, with periodic fulls.
+		# Repository snapshots are always complete, since unchanged data costs nothing to store.
+		useRepository = getSetting(config, target, 'format', 'archive') == 'repository'
+
+		# A target that should be encrypted is skipped, rather than written in plaintext, if
+		# encryption can't be set up.
+		try:
+			cipher = targetCipher(config, target, useRepository)
+		except (ImportError, IOError, ValueError) as e:
+			log('Error: Could not set up encryption for "{0}": {1}. Skipping it.'.format(target.get('name'), e))
+			metrics.add('errors')
+			stats['success'] = False
+			return stats
+		codec = getSetting(config, target, 'codec', 'gzip')
+		if not useRepository and not isCodecAvailable(codec):
+			log('Warning: Python module for codec "{0}" is not installed; falling back to gzip.'.format(codec))
+			codec = 'gzip'
+
+		# A run that was cut short is resumed from its last checkpoint, as long as the settings that
+		# shape the archive haven't changed. Only indexed archives on local storage are journaled.
+		storage = openStorage(config)
+		journal = None
+		run = None
+		resume = None
+		if not useRepository and isinstance(storage, LocalStorage) and getSetting(config, target, 'blockIndex', 'true') == 'true':
+			journal = Journal(journalPath(outputDir, target.get('name')))
+			settings = [codec, cipher.name if cipher else None, cipher.keyId if cipher else None]
+			interrupted = resumableRun(journal, storage, settings)
+			if interrupted is not None:
+				run, resume = interrupted
+				timestamp = run['timestamp']
+				log('Resuming backup of "{0}" from its last checkpoint ({1} already archived).'.format(target.get('name'), formatBytes(resume['bytesIn'])))
+			else:
+				run = {'timestamp': timestamp, 'time': time.time(), 'settings': settings}
+		if resume is None and not useRepository and isinstance(storage, LocalStorage):
+			# Whatever an earlier run left behind can't be used.
+			for name in fnmatch.filter(os.listdir(outputDir), target.get('name') + 'backup*' + PARTIAL_EXTENSION):
+				os.remove(os.path.join(outputDir, name))
+
+		index = None
+		full = True
+		if target.get('incremental') == 'true' and not useRepository:
+			index = FileIndex(os.path.join(outputDir, target.get('name') + '.index.sqlite'))
+			full = index.isFullDue(int(target.get('fullEveryN', 0))) if resume is None else run['full']
+			log('Taking {0} backup of "{1}".'.format('a full' if full else 'an incremental', target.get('name')))
+
+		# Folders are walked in parallel, optionally reusing directory listings from the last run.
+		walkWorkers = int(getSetting(config, target, 'walkWorkers', 4))
+		readWorkers = int(getSetting(config, target, 'readWorkers', 4))
+		readAheadBytes = int(getSetting(config, target, 'readAheadBytes', DEFAULT_READ_AHEAD_BYTES))
+		statCache = None
+		if target.get('statCache') == 'true':
+			statCache = StatCache(os.path.join(outputDir, target.get('name') + '.statcache'))
+		shared = sharedContent if not useRepository else None
+
+		def addFolder(folder, snapshot=None, snapshotPath=None):
+			try:
+				entries = walkTree(
+					snapshotPath or folder.get('path'),
+					[include.get('pattern') for include in folder.findall('./include')],
+					[exclude.get('pattern') for exclude in folder.findall('./exclude')],
+					walkWorkers,
+					statCache if snapshot is None else None)
+				folderIndex = SnapshotIndex(index, snapshot, snapshotPath) if snapshot is not None and index is not None else index
+				archiveEntries(archive, metrics.timeIterator(entries, 'enumerate'), folderIndex, full, readWorkers, readAheadBytes, metrics, archived, checkpoint, shared)
+			except (IOError, OSError) as e:
+				log('Warning: Could not archive {0}: {1}'.format(folder.get('path'), e))
+				metrics.add('errors')
+
+		def addSingleFile(path):
+			try:
+				archiveEntries(archive, [WalkEntry(path, os.path.basename(path), os.lstat(path))], index, full, metrics=metrics, archived=archived, checkpoint=checkpoint, shared=shared)
+			except (IOError, OSError) as e:
+				log('Warning: Could not archive {0}: {1}'.format(path, e))
+				metrics.add('errors')
+
+		# Source reads and archive writes are held to the configured rates, and mysqldump runs at the
+		# configured priority.
+		readThrottle, writeThrottle = targetThrottles(config, target, sharedBuckets)
+		niceLevel = getSetting(config, target, 'niceLevel')
+		commandPrefix = priorityCommand(int(niceLevel) if niceLevel is not None else None, getSetting(config, target, 'ioClass'))
+
+		archiveStart = time.time()
+		if useRepository:
+			archiveName = target.get('name') + '.' + timestamp
+			archive = RepositoryWriter(
+				openRepository(os.path.join(outputDir, REPOSITORY_DIR)),
+				archiveName,
+				readThrottle if readThrottle.enabled else None,
+				writeThrottle if writeThrottle.enabled else None)
+		else:
+			archiveName = target.get('name') + 'backup' + timestamp + ('' if full else '.incr') + archiveExtension(codec, cipher is not None)
+			archive = ArchiveWriter(
+				os.path.join(outputDir, archiveName),
+				codec,
+				int(getSetting(config, target, 'compressionWorkers', 1)),
+				int(getSetting(config, target, 'compressionBlockSize', DEFAULT_BLOCK_SIZE)),
+				metrics,
+				getSetting(config, target, 'blockIndex', 'true') == 'true',
+				readThrottle if readThrottle.enabled else None,
+				writeThrottle if writeThrottle.enabled else None,
+				cipher,
+				storage,
+				resume)
+
+		try:
+			# Checkpoints are taken every so many bytes at member boundaries, and after each database.
+			# Members already in a resumed archive aren't archived again, nor are its databases dumped.
+			archived = None
+			doneDatabases = set()
+			checkpoint = None
+			if journal is not None:
+				run.update(archive=archiveName, full=full)
+				journal.begin(run, resume)
+				if resume is not None:
+					# Only regular files have a meaningful size; sparse ones get their real size from the checksums.
+					archived = dict((member[0], [member[2] if member[1] == tarfile.REGTYPE else None, member[3], None]) for member in resume['members'])
+					for entry in resume['checksums']:
+						archived[entry[0]][0::2] = [entry[1], entry[2]]
+					archived.update((ref[0], [ref[1], ref[2], ref[6]]) for ref in resume['refs'])
+					doneDatabases.update(resume['databases'])
+				checkpointBytes = int(getSetting(config, target, 'checkpointBytes', DEFAULT_CHECKPOINT_BYTES))
+				lastCheckpoint = [archive.bytesIn]
+
+				def checkpoint(databases=None):
+					if databases is not None or archive.bytesIn - lastCheckpoint[0] >= checkpointBytes:
+						journal.append(dict(archive.checkpoint(), databases=databases or []))
+						lastCheckpoint[0] = archive.bytesIn
+
+			# Folders with a snapshot method are archived from snapshots, all taken before archiving
+			# starts and released once the folders are archived. A folder that can't be snapshotted
+			# is archived live.
+			snapshots = {}
+			for folder in folders:
+				if folder.get('snapshot') is None:
+					continue
+				snapshot = openSnapshot(folder.get('snapshot'), folder.get('path'), snapshotName(target.get('name'), folder.get('path')))
+				try:
+					with metrics.phase('snapshot'):
+						snapshots[folder] = (snapshot, snapshot.create())
+				except (IOError, OSError) as e:
+					log('Warning: Could not snapshot {0}: {1}. Archiving it live.'.format(folder.get('path'), e))
+					metrics.add('errors')
+			try:
+				with metrics.phase('archive'):
+					for folder in folders:
+						addFolder(folder, *snapshots.get(folder, ()))
+			finally:
+				for snapshot, snapshotPath in snapshots.values():
+					try:
+						snapshot.release()
+					except (IOError, OSError) as e:
+						log('Warning: Could not release the snapshot of {0}: {1}'.format(snapshot.source, e))
+						metrics.add('errors')
+			for database, credential in databases:
+				if database.get('name') in doneDatabases:
+					log('Database {0} was already dumped before the interruption.'.format(database.get('name')))
+					continue
+				sharedDump = shared.findDatabase(archive, credential.get('host'), database.get('name')) if shared is not None else None
+				if sharedDump is not None:
+					log('Database {0} was already dumped into {1} this run; referring to it.'.format(database.get('name'), sharedDump))
+					archive.addDatabaseReference(database.get('name'), sharedDump)
+					if checkpoint is not None:
+						checkpoint([database.get('name')])
+					continue
+				chunkSize = int(getSetting(config, target, 'dumpChunkSize', DEFAULT_CHUNK_SIZE))
+				dumpStart = archive.bytesIn
+				with metrics.phase('dump'):
+					if database.get('parallelTables') is not None:
+						dumped = dumpDatabaseTables(
+							archive,
+							'{0}.{1}'.format(database.get('name'), timestamp),
+							database.get('name'),
+							credential.get('username'),
+							credential.get('password'),
+							int(database.get('parallelTables')),
+							chunkSize,
+							credential.get('host'),
+							commandPrefix)
+					else:
+						dumped = dumpDatabase(
+							archive,
+							'{0}.{1}.sql'.format(database.get('name'), timestamp),
+							database.get('name'),
+							credential.get('username'),
+							credential.get('password'),
+							chunkSize,
+							credential.get('host'),
+							commandPrefix)
+				stats['success'] &= dumped
+				metrics.add('databases')
+				metrics.add('dumpBytes', archive.bytesIn - dumpStart)
+				if not dumped:
+					metrics.add('errors')
+					continue
+				if shared is not None:
+					shared.offerDatabase(archive, credential.get('host'), database.get('name'))
+				if checkpoint is not None:
+					checkpoint([database.get('name')])
+			with metrics.phase('archive'):
+				for path in files:
+					addSingleFile(path)
+
+			# Incremental archives list what was deleted since the previous run.
+			with metrics.phase('cleanup'):
+				if index is not None:
+					if not full and len(index.deletedArcnames()) > 0:
+						archive.addBuffer(DELETED_MEMBER, '\n'.join(index.deletedArcnames()) + '\n')
+					archive.close()
+					index.commit(archiveName, full)
+					index.close()
+				else:
+					archive.close()
+				if journal is not None:
+					journal.remove()
+				if shared is not None:
+					shared.publish(archive)
+				if statCache is not None:
+					statCache.save()
+		except ArchiveWriteError as e:
+			# Nothing is committed or cataloged, so retention never trusts a broken archive.
+			log('Error: Could not write {0}: {1}. Giving up on "{2}".'.format(archiveName, e, target.get('name')))
+			metrics.add('errors')
+			archive.abort()
+			if index is not None:
+				index.close()
+			stats['success'] = False
+			return stats
+		except:
+			# Don't leave an upload open (and billed) or a compression pool running.
+			archive.abort()
+			if index is not None:
+				index.close()
+			raise
+
+		metrics.add('files', archive.filesIn)
+		stats['seconds'] = time.time() - archiveStart
+		stats['bytesIn'] = archive.bytesIn
+		stats['bytesOut'] = archive.bytesOut
+		log('Archived {0} from {1} sources into {2} in {3:.2f}s ({4}).'.format(
+			formatBytes(archive.bytesIn), sourceCount, formatBytes(archive.bytesOut), stats['seconds'], formatRate(archive.bytesIn, stats['seconds'])))
+		if not useRepository and not isinstance(storage, LocalStorage):
+			log('Uploaded {0}.'.format(storage.describe(archiveName)))
+		if not useRepository and len(archive.referencedArchives()) > 0:
+			log('Referred to {0} of files and {1} database dumps already archived this run instead of archiving them again.'.format(
+				formatBytes(archive.bytesShared), len(archive.databaseRefs)))
+		if readThrottle.enabled or writeThrottle.enabled:
+			stats['throttleSeconds'] = readThrottle.waitSeconds + writeThrottle.waitSeconds
+			log('Throttled for {0:.2f}s; effective throughput {1} read, {2} written.'.format(
+				stats['throttleSeconds'], formatRate(archive.bytesIn, stats['seconds']), formatRate(archive.bytesOut, stats['seconds'])))
+		if useRepository:
+			log('Snapshot {0} added {1} of new chunks (dedup ratio {2:.2f}x).'.format(
+				archiveName, formatBytes(archive.bytesNew), archive.bytesIn / float(max(archive.bytesNew, 1))))
+
+		# Record the new backup in the catalog, then prune whatever the retention policy no longer
+		# needs. Nothing is pruned after a failed run, so a good older backup is never traded for it.
+		catalog = Catalog(outputDir)
+		if resume is not None:
+			archiveStart = run['time']
+		try:
+			if useRepository:
+				catalog.add(archiveName, target.get('name'), archiveStart, archive.bytesOut, None, 'snapshot')
+			else:
+				catalog.add(archiveName, target.get('name'), archiveStart, archive.bytesOut, archive.checksum,
+					'full' if full else 'incr', index.state['lastFull'] if index is not None else None)
+				catalog.addReferences(archiveName, archive.referencedArchives())
+			policy = dict((attrName, int(getSetting(config, target, attrName))) for attrName in RETENTION_ATTRIBUTES if getSetting(config, target, attrName) is not None)
+			if len(policy) > 0 and stats['success']:
+				with metrics.phase('cleanup'):
+					removed, freed = pruneTarget(catalog, target.get('name'), policy, archive.repository if useRepository else None, storage)
+				if removed > 0:
+					log('Pruned {0} old backups of "{1}", freeing {2}.'.format(removed, target.get('name'), formatBytes(freed)))
+		finally:
+			catalog.close()
+
+	log('Backup complete for "{0}".'.format(target.get('name')))
+	return stats
+
+def targetInterval(target):
+	# How often a target should be backed up, in seconds.
+	if target.get('intervalMinutes') is not None:
+		return int(target.get('intervalMinutes')) * 60
+	return int(target.get('intervalHours')) * 60 * 60
+
+def isTargetDue(target, startTime, outputDir):
+	# When run hourly from cron, a target is due if its interval divides the current hour.
+	# Interrupted runs are picked up on the next run, whether or not the target is due.
+	return (int(startTime / 60 / 60) % max(1, targetInterval(target) / 60 / 60) == 0
+		or os.path.exists(journalPath(outputDir, target.get('name'))))
+
+def totalBuckets(config):
+	# The token buckets for the I/O limits shared by all targets, keyed 'read' and 'write'.
+	sharedBuckets = {}
+	for direction in ['read', 'write']:
+		rate = config.output.get('total' + direction.capitalize() + 'BytesPerSecond')
+		if rate is not None:
+			sharedBuckets[direction] = TokenBucket(int(rate))
+	return sharedBuckets
+
+def jobLimits(config):
+	# (maxConcurrent, resourceLimits) for a JobRunner, from the configured concurrency caps.
+	# Targets that share content run one at a time.
+	output = config.output
+	return (int(output.get('maxConcurrentTargets', 4)), {
+		'device': int(output.get('maxTargetsPerDevice', 2)),
+		'dbhost': int(output.get('maxTargetsPerDatabaseHost', 2)),
+		'content': 1,
+	})
+
+def backupJobs(config, targets, startTime, sharedBuckets):
+	# A job backing up each of the targets, and the metrics each will collect, keyed by target
+	# name. The archives are named after 'startTime'.
+	timestamp = datetime.datetime.fromtimestamp(startTime).strftime('%Y-%m-%d.%H-%M-%S.%f')
+	outputDir = config.output.get('path')
+	history = loadHistory(outputDir)
+	jobs = []
+	jobMetrics = {}
+	sharedContent = SharedContent() if config.output.get('shareContent') == 'true' else None
+	contentResources = sharedContentResources(config, targets) if sharedContent is not None else {}
+	for target in targets:
+		metrics = TargetMetrics(target.get('name')) if getSetting(config, target, 'metrics', 'false') == 'true' else NO_METRICS
+		jobMetrics[target.get('name')] = metrics
+		jobs.append(Job(
+			target.get('name'),
+			lambda target=target, metrics=metrics: backupTarget(config, target, outputDir, timestamp, metrics=metrics, sharedBuckets=sharedBuckets, sharedContent=sharedContent),
+			targetResources(config, target, outputDir) + contentResources.get(target.get('name'), []),
+			history.get(target.get('name'), {}).get('seconds')))
+	return (jobs, jobMetrics)
+
+historyLock = threading.Lock()
+
+def recordJobs(config, jobs, jobMetrics):
+	# Reports how the jobs played out, and remembers their timings for the next run. The history
+	# is re-read under a lock, since jobs started at different times may finish together.
+	outputDir = config.output.get('path')
+	with historyLock:
+		history = loadHistory(outputDir)
+		for job in jobs:
+			if job.result is not None:
+				recordHistory(history, job.name, job.result, job.finishTime)
+				log('Target "{0}" took {1:.2f}s after waiting {2:.2f}s in the queue ({3}).'.format(
+					job.name, job.wallSeconds, job.queueSeconds, formatRate(job.result['bytesIn'], job.result['seconds'])))
+
+		# Export metrics for targets that asked for them. The Prometheus file covers every target's
+		# latest run, so each target's last record is kept in the history.
+		records = [metricsRecord(job, jobMetrics[job.name]) for job in jobs if jobMetrics[job.name].enabled]
+		if len(records) > 0:
+			for record in records:
+				history.setdefault(record['target'], {})['lastMetrics'] = record
+			appendMetrics(outputDir, records)
+			writePrometheusMetrics(outputDir, dict((name, entry['lastMetrics']) for name, entry in history.items() if 'lastMetrics' in entry))
+		saveHistory(outputDir, history)
+
+def doBackup(config, targets=None):
+	# Backs up the given targets, or (when run hourly from cron) every target whose interval
+	# divides the current hour. Returns the jobs that ran.
+	startTime = time.time()
+	outputDir = config.output.get('path')
+	if not os.path.isdir(outputDir):
+		log("Error: No such path: {0}. Aborting backup.".format(outputDir))
+		return []
+
+	# Queue up every target that is due, longest expected first.
+	if targets is not None:
+		dueTargets = targets
+	else:
+		dueTargets = [target for target in config.targets if isTargetDue(target, startTime, outputDir)]
+	if len(dueTargets) == 0:
+		log('No targets need to be backed up right now ({0} targets considered).'.format(len(config.targets)))
+		return []
+	jobs, jobMetrics = backupJobs(config, dueTargets, startTime, totalBuckets(config))
+
+	# Run independent targets side by side, within the configured concurrency caps.
+	runJobs(jobs, *jobLimits(config))
+	recordJobs(config, jobs, jobMetrics)
+	log('Ran {0} targets in {1:.2f}s wall time ({2:.2f}s of target time).'.format(
+		len(jobs), time.time() - startTime, sum(job.wallSeconds for job in jobs)))
+	return jobs
+
+def planTarget(config, target, outputDir, history, startTime, rand):
+	# Estimates a single target's backup; see planBackup.
+	# Repository chunks are zlib-compressed; what they save by deduplication isn't estimated.
+	useRepository = getSetting(config, target, 'format', 'archive') == 'repository'
+	codec = getSetting(config, target, 'codec', 'gzip') if not useRepository else 'gzip'
+	if not isCodecAvailable(codec):
+		codec = 'gzip'
+
+	# An incremental target only reads what changed since its last run. The index is only opened
+	# if it exists, so planning never creates one.
+	index = None
+	indexPath = os.path.join(outputDir, target.get('name') + '.index.sqlite')
+	if target.get('incremental') == 'true' and not useRepository and os.path.isfile(indexPath):
+		index = FileIndex(indexPath)
+		if index.isFullDue(int(target.get('fullEveryN', 0))):
+			index.close()
+			index = None
+
+	estimate = SourceEstimate(rand)
+	try:
+		for folder in target.findall('./folder'):
+			if os.path.isdir(folder.get('path')):
+				estimateFolder(estimate, folder, int(getSetting(config, target, 'walkWorkers', 4)), index)
+		for file in target.findall('./file'):
+			if os.path.isfile(file.get('path')) and (index is None or index.isChanged(file.get('path'), os.lstat(file.get('path')))):
+				estimate.add(file.get('path'), os.lstat(file.get('path')))
+	finally:
+		if index is not None:
+			index.close()
+	ratio = sampleCompressionRatio(estimate.samplePaths(), codec)
+	bytesIn = estimate.bytes + estimate.entries * TAR_HEADER_SIZE
+	bytesOut = bytesIn * (ratio if ratio is not None else 1.0)
+
+	# Databases of unknown size leave the totals as lower bounds.
+	databaseBytes = 0
+	for database in target.findall('./database'):
+		size, dumpRatio = estimateDatabase(database, config.credentialFor(database), codec)
+		if size is None or databaseBytes is None:
+			databaseBytes = None
+			continue
+		databaseBytes += size
+		bytesIn += size
+		bytesOut += size * (dumpRatio if dumpRatio is not None else 1.0)
+
+	# Duration comes from the target's own recorded throughput, or else the median of the others'.
+	rates = sorted(entry['bytesPerSecond'] for entry in history.values() if entry.get('bytesPerSecond'))
+	rate = history.get(target.get('name'), {}).get('bytesPerSecond') or (rates[len(rates) / 2] if len(rates) > 0 else None)
+	seconds = bytesIn / rate if rate else None
+	return {
+		'name': target.get('name'),
+		'due': isTargetDue(target, startTime, outputDir),
+		'incremental': index is not None,
+		'sampled': estimate.sampled,
+		'files': int(round(estimate.files)),
+		'bytes': int(estimate.bytes),
+		'databases': len(target.findall('./database')),
+		'databaseBytes': databaseBytes,
+		'ratio': ratio,
+		'bytesIn': int(bytesIn),
+		'bytesOut': int(bytesOut),
+		'seconds': seconds,
+		'intervalSeconds': targetInterval(target),
+		'tooSlow': seconds is not None and seconds > targetInterval(target),
+	}
+
+def planBackup(config, targets=None):
+	# Estimates what doBackup would do right now, without writing anything: which targets are due,
+	# how much each would read (walking its sources, or probing huge trees), how big its archive
+	# would be (from compression ratios sampled from its files and dumps), and how long it would
+	# take (from the throughput recorded in the history). Returns a plan for each target.
+	startTime = time.time()
+	outputDir = config.output.get('path')
+	history = loadHistory(outputDir)
+	rand = random.Random(startTime)
+	return [planTarget(config, target, outputDir, history, startTime, rand) for target in (targets if targets is not None else config.targets)]
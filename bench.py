@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import subprocess
+import backuplib
+
+#
+# Synthetic datasets.
+#
+
+WORDS = ['select', 'insert', 'update', 'backup', 'archive', 'table', 'value', 'index', 'config', 'server', 'request', 'error', 'warning', 'info']
+
+def writeText(path, size, rand):
+	# Compressible, log-like text.
+	lines = []
+	written = 0
+	while written < size:
+		line = ' '.join(rand.choice(WORDS) for i in range(8)) + ' {0}\n'.format(rand.randint(0, 99999))
+		lines.append(line)
+		written += len(line)
+	with open(path, 'w') as outfile:
+		outfile.write(''.join(lines)[:size])
+
+def writeRandom(path, size):
+	# Incompressible data.
+	with open(path, 'wb') as outfile:
+		for offset in range(0, size, 1024 * 1024):
+			outfile.write(os.urandom(min(1024 * 1024, size - offset)))
+
+def makeSmallFiles(path, scale, rand):
+	for i in range(20 * scale):
+		os.makedirs(os.path.join(path, 'dir{0:03d}'.format(i)))
+		for j in range(100):
+			writeText(os.path.join(path, 'dir{0:03d}'.format(i), 'file{0:03d}.log'.format(j)), rand.randint(512, 8192), rand)
+
+def makeHugeFiles(path, scale, rand):
+	os.makedirs(path)
+	writeText(os.path.join(path, 'huge.log'), 32 * 1024 * 1024 * scale, rand)
+	writeRandom(os.path.join(path, 'huge.bin'), 32 * 1024 * 1024 * scale)
+
+def makeSparseImage(path, scale, rand):
+	# A disk image that is mostly holes, with 1 MB of data every 16 MB.
+	os.makedirs(path)
+	with open(os.path.join(path, 'disk.img'), 'wb') as image:
+		image.truncate(256 * 1024 * 1024 * scale)
+		for offset in range(0, 256 * 1024 * 1024 * scale, 16 * 1024 * 1024):
+			image.seek(offset)
+			image.write(os.urandom(1024 * 1024))
+
+def makeDeepTree(path, scale, rand):
+	for chain in range(10 * scale):
+		levelPath = os.path.join(path, 'chain{0:03d}'.format(chain))
+		for level in range(40):
+			levelPath = os.path.join(levelPath, 'level{0:02d}'.format(level))
+			os.makedirs(levelPath)
+			for j in range(5):
+				writeText(os.path.join(levelPath, 'file{0}.txt'.format(j)), rand.randint(128, 2048), rand)
+
+def makeIncompressible(path, scale, rand):
+	os.makedirs(path)
+	for i in range(16 * scale):
+		writeRandom(os.path.join(path, 'blob{0:03d}.bin'.format(i)), rand.randint(256 * 1024, 4 * 1024 * 1024))
+
+def makeFakeMysqldump(binPath):
+	# Emits $BENCH_DUMP_BYTES bytes of INSERT statements, standing in for a real database.
+	os.makedirs(binPath)
+	with open(os.path.join(binPath, 'mysqldump'), 'w') as script:
+		script.write('#!/bin/sh\nyes "INSERT INTO \\`orders\\` VALUES (1234,\'2017-06-02 20:27:00\',\'shipped\',99.95);" | head -c "$BENCH_DUMP_BYTES"\n')
+	os.chmod(os.path.join(binPath, 'mysqldump'), 0755)
+
+# Dataset name -> (generator, XML for the target's sources).
+DATASETS = [
+	('smallfiles', makeSmallFiles, '<folder path="{0}" />'),
+	('hugefiles', makeHugeFiles, '<folder path="{0}" />'),
+	('sparse', makeSparseImage, '<folder path="{0}" />'),
+	('deeptree', makeDeepTree, '<folder path="{0}" />'),
+	('incompressible', makeIncompressible, '<folder path="{0}" />'),
+	('mysqldump', None, '<database name="benchdb" credential="bench" />'),
+]
+
+def datasetSize(path):
+	numBytes = 0
+	numFiles = 0
+	for dirpath, dirnames, filenames in os.walk(path):
+		for name in filenames:
+			numBytes += os.path.getsize(os.path.join(dirpath, name))
+			numFiles += 1
+	return (numBytes, numFiles)
+
+#
+# Measurement.
+#
+
+def runDataset(configPath):
+	# Runs in a child process, so peak RSS and process counts belong to this dataset alone.
+	forks = [0]
+	popenInit = subprocess.Popen.__init__
+	def countingInit(self, *args, **kwargs):
+		forks[0] += 1
+		popenInit(self, *args, **kwargs)
+	subprocess.Popen.__init__ = countingInit
+	backuplib.log = lambda line: None
+
+	validateStart = time.time()
+	config = backuplib.loadConfig(configPath)
+	validateSeconds = time.time() - validateStart
+	backupStart = time.time()
+	backuplib.doBackup(config)
+	backupSeconds = time.time() - backupStart
+
+	print json.dumps({
+		'valid': config.isValid(),
+		'validateSeconds': validateSeconds,
+		'wallSeconds': backupSeconds,
+		'peakRssKb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+		'forks': forks[0],
+	})
+
+def runBenchmarks(workDir, scale):
+	rand = random.Random(1234)
+	binPath = os.path.join(workDir, 'bin')
+	if os.path.isdir(workDir):
+		shutil.rmtree(workDir)
+	makeFakeMysqldump(binPath)
+	env = dict(os.environ, PATH=binPath + os.pathsep + os.environ['PATH'], BENCH_DUMP_BYTES=str(64 * 1024 * 1024 * scale))
+
+	results = {}
+	for name, generator, sourceXml in DATASETS:
+		dataPath = os.path.join(workDir, 'data', name)
+		outputPath = os.path.join(workDir, 'output', name)
+		os.makedirs(outputPath)
+		print 'Generating {0}...'.format(name)
+		if generator is not None:
+			generator(dataPath, scale, rand)
+			numBytes, numFiles = datasetSize(dataPath)
+		else:
+			numBytes, numFiles = (int(env['BENCH_DUMP_BYTES']), 1)
+
+		configPath = os.path.join(workDir, name + '.xml')
+		with open(configPath, 'w') as configFile:
+			configFile.write('<settings><output path="{0}" /><credentials><credential name="bench" username="bench" password="bench" /></credentials>'
+				'<targets><target name="{1}" intervalHours="1">{2}</target></targets></settings>'.format(outputPath, name, sourceXml.format(dataPath)))
+
+		print 'Backing up {0} ({1} in {2} files)...'.format(name, backuplib.formatBytes(numBytes), numFiles)
+		child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', configPath], stdout=subprocess.PIPE, env=env)
+		result = json.loads(child.communicate()[0].strip().split('\n')[-1])
+		result['bytes'] = numBytes
+		result['files'] = numFiles
+		result['outputBytes'] = datasetSize(outputPath)[0]
+		result['mbPerSecond'] = numBytes / 1048576.0 / max(result['wallSeconds'], 0.001)
+		result['filesPerSecond'] = numFiles / max(result['wallSeconds'], 0.001)
+		results[name] = result
+		printResult(name, result)
+
+	return {
+		'time': time.time(),
+		'host': platform.node(),
+		'python': platform.python_version(),
+		'scale': scale,
+		'datasets': results,
+	}
+
+def printResult(name, result):
+	print '  {0}: {1:.2f}s, {2:.1f} MB/s, {3:.0f} files/s, peak RSS {4}, {5} forks, {6} written'.format(
+		name, result['wallSeconds'], result['mbPerSecond'], result['filesPerSecond'],
+		backuplib.formatBytes(result['peakRssKb'] * 1024), result['forks'], backuplib.formatBytes(result['outputBytes']))
+
+def compareResults(basePath, newPath):
+	base = json.load(open(basePath))
+	new = json.load(open(newPath))
+	print '{0:<16}{1:>12}{2:>12}{3:>10}'.format('dataset', 'base (s)', 'new (s)', 'speedup')
+	for name in sorted(set(base['datasets']) & set(new['datasets'])):
+		baseSeconds = base['datasets'][name]['wallSeconds']
+		newSeconds = new['datasets'][name]['wallSeconds']
+		print '{0:<16}{1:>12.2f}{2:>12.2f}{3:>9.2f}x'.format(name, baseSeconds, newSeconds, baseSeconds / max(newSeconds, 0.001))
+
+#
+# Entry point.
+#
+
+def usageMsg():
+	print 'bench.py - GoodBackup benchmark utility'
+	print 'Usage: bench.py <path-to-work-folder> <path-to-results-file> [scale]'
+	print '       bench.py --compare <path-to-results-file> <path-to-results-file>'
+	print
+
+def parseArgs(argv):
+	parsedArgs = None
+	if len(argv) == 4 and argv[1] == '--compare':
+		parsedArgs = [argv[1], argv[2], argv[3]]
+	elif len(argv) == 3 and argv[1] == '--run':
+		parsedArgs = [argv[1], argv[2]]
+	elif len(argv) in [3, 4] and not argv[1].startswith('-') and (len(argv) == 3 or argv[3].isdigit()):
+		parsedArgs = [None, argv[1], argv[2], int(argv[3]) if len(argv) == 4 else 1]
+	return parsedArgs
+
+def main(argv):
+	# Read cmd arguments.
+	parsedArgs = parseArgs(argv)
+	if parsedArgs is None:
+		usageMsg()
+		return
+
+	if parsedArgs[0] == '--run':
+		runDataset(parsedArgs[1])
+	elif parsedArgs[0] == '--compare':
+		compareResults(parsedArgs[1], parsedArgs[2])
+	else:
+		results = runBenchmarks(os.path.abspath(parsedArgs[1]), parsedArgs[3])
+		with open(parsedArgs[2], 'w') as resultsFile:
+			json.dump(results, resultsFile, indent=1, sort_keys=True)
+		print 'Results saved to {0}.'.format(parsedArgs[2])
+
+main(sys.argv)
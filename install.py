@@ -2,19 +2,21 @@
 
 import sys
 import os
-import xml.etree.ElementTree as ET
 import subprocess
 import backuplib
 
 def usageMsg():
 	print 'install.py - GoodBackup installation utility'
-	print 'Usage: install.py <path-to-config-file> <path-to-log-file>'
+	print 'Usage: install.py <path-to-config-file> <path-to-log-file> [--daemon]'
+	print '       (--daemon starts a resident backup.py at boot instead of running it hourly)'
 	print
 
 def parseArgs(argv):
 	parsedArgs = None
 	if len(argv) == 3:
-		parsedArgs = [argv[1], argv[2]]
+		parsedArgs = [argv[1], argv[2], False]
+	elif len(argv) == 4 and argv[3] == '--daemon':
+		parsedArgs = [argv[1], argv[2], True]
 	return parsedArgs
 
 def main(argv):
@@ -32,23 +34,24 @@ def main(argv):
 	if not os.path.isfile(parsedArgs[0]):
 		print 'Couldn\'t find config file: {0}. Aborting installation.'.format(parsedArgs[0])
 		return
-	tree = ET.parse(parsedArgs[0])
-	root = tree.getroot()
-	if not backuplib.validateConfig(root):
+	config = backuplib.loadConfig(parsedArgs[0])
+	if not config.isValid():
 		print 'Invalid config file: {0}. Aborting installation.'.format(parsedArgs[0])
+		for error in config.errors:
+			print '  ' + error
 		return
 	if not os.path.isdir(os.path.dirname(parsedArgs[1])):
 		print 'Logging directory doesn\'t exist: {0}. Aborting installation.'.format(os.path.dirname(parsedArgs[1]))
 		return
-	if not os.path.isdir(root.find('./output').get('path')):
-		print 'Backup directory doesn\'t exist: {0}. Aborting installation.'.format(root.find('./output').get('path'))
+	if not os.path.isdir(config.output.get('path')):
+		print 'Backup directory doesn\'t exist: {0}. Aborting installation.'.format(config.output.get('path'))
 		return
 	
 	# Check for existing installations.
 	crontab = subprocess.Popen(["crontab", "-l"], stdout=subprocess.PIPE).communicate()[0]
 	existingEntries = []
 	for entry in crontab.split('\n'):
-		if '0\t*\t*\t*\t*' in entry and 'backup.py' in entry:
+		if ('0\t*\t*\t*\t*' in entry or '@reboot' in entry) and 'backup.py' in entry:
 			existingEntries.append(entry)
 
 	choice = 'y'
@@ -63,7 +66,11 @@ def main(argv):
 
 	# Append to crontab.
 	if choice in ['y', 'Y']:
-		line = '0\t*\t*\t*\t*\t{0} {1} >> {2} 2>&1'.format(os.path.dirname(os.path.realpath(__file__)) + '/backup.py', parsedArgs[0], parsedArgs[1])
+		backupScript = os.path.dirname(os.path.realpath(__file__)) + '/backup.py'
+		if parsedArgs[2]:
+			line = '@reboot\t{0} --daemon {1} >> {2} 2>&1'.format(backupScript, parsedArgs[0], parsedArgs[1])
+		else:
+			line = '0\t*\t*\t*\t*\t{0} {1} >> {2} 2>&1'.format(backupScript, parsedArgs[0], parsedArgs[1])
 		if len(crontab) > 0:
 			cronEntries = crontab.split('\n')
 			cronEntries = [entry for entry in cronEntries if entry != '']
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+import sys
+import os
+import backuplib
+
+def usageMsg():
+	print 'repository.py - GoodBackup deduplicating repository utility'
+	print 'Usage: repository.py <path-to-config-file> list'
+	print '       repository.py <path-to-config-file> restore <snapshot> <destination-folder>'
+	print '       repository.py <path-to-config-file> forget <snapshot>'
+	print '       repository.py <path-to-config-file> gc'
+	print
+
+def parseArgs(argv):
+	parsedArgs = None
+	argCounts = {'list': 3, 'restore': 5, 'forget': 4, 'gc': 3}
+	if len(argv) >= 3 and argCounts.get(argv[2]) == len(argv):
+		parsedArgs = argv[1:]
+	return parsedArgs
+
+def main(argv):
+	# Read cmd arguments.
+	parsedArgs = parseArgs(argv)
+	if parsedArgs is None:
+		usageMsg()
+		return
+
+	# Read configuration file.
+	config = backuplib.loadConfig(parsedArgs[0])
+	if not config.isValid():
+		print 'Invalid configuration file.'
+		return
+	repositoryPath = os.path.join(config.output.get('path'), backuplib.REPOSITORY_DIR)
+	if not os.path.isdir(repositoryPath):
+		print 'No repository found at {0}.'.format(repositoryPath)
+		return
+	repository = backuplib.Repository(repositoryPath)
+
+	# Run the command.
+	if parsedArgs[1] == 'list':
+		for name in repository.listSnapshots():
+			print name
+	elif parsedArgs[1] in ['restore', 'forget'] and parsedArgs[2] not in repository.listSnapshots():
+		print 'No such snapshot: {0}'.format(parsedArgs[2])
+	elif parsedArgs[1] == 'restore':
+		backuplib.restoreSnapshot(repository, parsedArgs[2], parsedArgs[3])
+		print 'Restored {0} to {1}.'.format(parsedArgs[2], parsedArgs[3])
+	elif parsedArgs[1] == 'forget':
+		repository.forgetSnapshot(parsedArgs[2])
+		print 'Forgot {0}. Run "gc" to free its chunks.'.format(parsedArgs[2])
+	elif parsedArgs[1] == 'gc':
+		removedChunks, freedBytes = repository.collectGarbage()
+		print 'Removed {0} unreferenced chunks, freeing {1}.'.format(removedChunks, backuplib.formatBytes(freedBytes))
+
+main(sys.argv)
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import sys
+import time
+import backuplib
+
+def usageMsg():
+	print 'restore.py - GoodBackup restore utility'
+	print 'Usage: restore.py <path-to-config-file> <path-to-archive> <database-name>'
+	print '       restore.py --list <path-to-archive> [--key <path-to-key-file>]'
+	print '       restore.py --extract <path-to-archive> <destination-folder> <member> [<member> ...] [--key <path-to-key-file>]'
+	print
+
+def parseArgs(argv):
+	# An encrypted archive's key file may be given at the end when listing or extracting.
+	parsedArgs = None
+	keyPath = None
+	if len(argv) >= 4 and argv[-2] == '--key':
+		keyPath = argv[-1]
+		argv = argv[:-2]
+	if keyPath is not None and argv[1] not in ['--list', '--extract']:
+		return None
+	if len(argv) == 3 and argv[1] == '--list':
+		parsedArgs = [argv[1], argv[2]]
+	elif len(argv) >= 5 and argv[1] == '--extract':
+		parsedArgs = [argv[1], argv[2], argv[3], argv[4:]]
+	elif len(argv) == 4 and not argv[1].startswith('--'):
+		parsedArgs = [argv[1], argv[2], argv[3]]
+	if parsedArgs is not None:
+		parsedArgs.append(keyPath)
+	return parsedArgs
+
+def openIndexedArchive(path, keyPath):
+	if not backuplib.hasArchiveIndex(path):
+		print 'No index found for {0}; it was written with blockIndex="false" or by an older version. Use tar to read it.'.format(path)
+		return None
+	if backuplib.isEncryptedArchive(path) and keyPath is None:
+		print '{0} is encrypted; give its key file with --key.'.format(path)
+		return None
+	return backuplib.ArchiveReader(path, backuplib.loadEncryptionKey(keyPath) if keyPath is not None else None)
+
+def main(argv):
+	# Read cmd arguments.
+	parsedArgs = parseArgs(argv)
+	if parsedArgs is None:
+		usageMsg()
+		return
+
+	# List an archive's contents from its index alone.
+	if parsedArgs[0] == '--list':
+		reader = openIndexedArchive(parsedArgs[1], parsedArgs[-1])
+		if reader is not None:
+			for member in reader.members:
+				print '{0:>12} {1} {2}'.format(member.size, time.strftime('%Y-%m-%d %H:%M', time.localtime(member.mtime)), member.name)
+		return
+
+	# Extract files or folders, decompressing only the blocks they occupy.
+	if parsedArgs[0] == '--extract':
+		reader = openIndexedArchive(parsedArgs[1], parsedArgs[-1])
+		if reader is None:
+			return
+		members = reader.select(parsedArgs[3])
+		if len(members) == 0:
+			print 'None of the requested members are in {0}.'.format(parsedArgs[1])
+			return
+		reader.extract(members, parsedArgs[2])
+		reader.close()
+		print 'Extracted {0} members, decompressing {1} of {2} blocks.'.format(len(members), reader.blocksRead, len(reader.blocks))
+		return
+
+	# Read configuration file.
+	config = backuplib.loadConfig(parsedArgs[0])
+	if not config.isValid():
+		print 'Invalid configuration file. Aborting restore.'
+		return
+
+	# Find the credential, worker count and encryption key the database is backed up with.
+	targets = [target for target in config.targets if target.find('./database[@name="{0}"]'.format(parsedArgs[2])) is not None]
+	if len(targets) == 0:
+		print 'Database {0} is not backed up by this configuration. Aborting restore.'.format(parsedArgs[2])
+		return
+	database = targets[0].find('./database[@name="{0}"]'.format(parsedArgs[2]))
+	credential = config.credentialFor(database)
+	keyPath = backuplib.getSetting(config, targets[0], 'encryptionKey')
+
+	# Restore the database.
+	backuplib.log('Restoring database "{0}" from {1}.'.format(parsedArgs[2], parsedArgs[1]))
+	if backuplib.restoreDatabase(parsedArgs[1], parsedArgs[2], credential.get('username'), credential.get('password'), int(database.get('parallelTables', 4)), credential.get('host'), backuplib.loadEncryptionKey(keyPath) if keyPath is not None else None):
+		backuplib.log('Restore complete.')
+	else:
+		backuplib.log('Restore failed.')
+
+main(sys.argv)
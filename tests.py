@@ -6,6 +6,20 @@ import backuplib
 import xml.etree.ElementTree as ET
 import shutil
 import glob
+import tarfile
+import gzip
+import StringIO
+import json
+import threading
+import time
+import hashlib
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import errno
+import heapq
+import zlib
 
 #
 # Types.
@@ -51,16 +65,92 @@ def compareFiles(filePattern1, filePattern2):
 # Mock helper functions.
 #
 
-def mockDumpDatabase(dbname, username, password, outfile):
-	if os.path.isfile(outfile):
-		os.remove(outfile)
-	os.system('echo {0} >> {1}'.format(dbname, outfile))
-	os.system('echo {0} >> {1}'.format(username, outfile))
-	os.system('echo {0} >> {1}'.format(password, outfile))
+def useFakeTools():
+	# Put the stand-in mysql tools in testdata/bin ahead of any real ones.
+	binPath = os.path.abspath('testdata/bin')
+	if not os.environ['PATH'].startswith(binPath + os.pathsep):
+		os.environ['PATH'] = binPath + os.pathsep + os.environ['PATH']
 
 def mockLog(line):
 	pass
 
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# Serves the S3 calls backuplib makes from memory, failing the first part upload with a 500,
+	# and every part upload with a 400 once 'failParts' is set.
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def respond(self, status, body='', headers=None):
+		self.send_response(status)
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def handleRequest(self):
+		server = self.server
+		path, _, query = self.path.partition('?')
+		params = urlparse.parse_qs(query, keep_blank_values=True)
+		key = urllib.unquote(path).split('/', 2)[2]
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		with server.lock:
+			server.requests.append((self.command, key, sorted(params)))
+			server.connections.add(self.client_address)
+		if not self.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 Credential=test/'):
+			return self.respond(403)
+		if hashlib.sha256(body).hexdigest() != self.headers.get('x-amz-content-sha256'):
+			return self.respond(400)
+		if self.command == 'POST' and 'uploads' in params:
+			uploadId = str(len(server.uploads) + 1)
+			server.uploads[uploadId] = {}
+			return self.respond(200, '<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><UploadId>{0}</UploadId></InitiateMultipartUploadResult>'.format(uploadId))
+		if self.command == 'PUT' and 'partNumber' in params:
+			with server.lock:
+				if server.failParts:
+					return self.respond(400)
+				if not server.failedOnce:
+					server.failedOnce = True
+					return self.respond(500)
+			server.uploads[params['uploadId'][0]][int(params['partNumber'][0])] = body
+			return self.respond(200, headers={'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest())})
+		if self.command == 'POST' and 'uploadId' in params:
+			parts = server.uploads.pop(params['uploadId'][0])
+			server.objects[key] = ''.join(parts[number] for number in sorted(parts))
+			server.partCounts[key] = len(parts)
+			return self.respond(200, '<CompleteMultipartUploadResult />')
+		if self.command == 'DELETE' and 'uploadId' in params:
+			server.uploads.pop(params['uploadId'][0], None)
+			return self.respond(204)
+		if self.command == 'PUT':
+			server.objects[key] = body
+			return self.respond(200)
+		if self.command == 'DELETE':
+			server.objects.pop(key, None)
+			return self.respond(204)
+		self.respond(404)
+
+	do_GET = do_PUT = do_POST = do_DELETE = handleRequest
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeS3Handler)
+		self.lock = threading.Lock()
+		self.objects = {}
+		self.uploads = {}
+		self.partCounts = {}
+		self.requests = []
+		self.connections = set()
+		self.failedOnce = False
+		self.failParts = False
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
 #
 # Test methods.
 #
@@ -202,7 +292,8 @@ def testValidateTopLevelXml():
 		'<root></root>', # Missing top-level 'settings' node
 		'<settings><credentials /><targets /></settings>', # Missing output section
 		'<settings><output path="~/backups" /><credentials section="first" /><credentials section="second" /></settings>', # Duplicate credentials sections
-		'<settings><output path="~/backups" /><targets section="first" /><targets section="second" /></settings>' # Duplicate targets sections
+		'<settings><output path="~/backups" /><targets section="first" /><targets section="second" /></settings>', # Duplicate targets sections
+		'<settings><output path="~/backups" compressionWorkers="two" /></settings>' # Non-integer worker count
 	]
 
 	# Do tests.
@@ -250,7 +341,9 @@ def testValidateInnerXml():
 		'<target name="app4" intervalHours="24"><database name="myDB" credential="remoteDB" /></target>', # Invalid credential reference
 		'<target name="app4" />', # Missing interval
 		'<target name="app4" intervalHours="24"><database name="app4" credential="database" /><database name="app4" credential="backup" /></target>', # Duplicate database
-		'<target name="app4" intervalHours="24"><file path="~/documents/mydoc.txt" /><file path="~/documents/mydoc.txt" /></target>' # Duplicate file path
+		'<target name="app4" intervalHours="24"><file path="~/documents/mydoc.txt" /><file path="~/documents/mydoc.txt" /></target>', # Duplicate file path
+		'<target name="app4" intervalHours="24" codec="rar" />', # Unknown codec
+		'<target name="app4" intervalHours="24" compressionWorkers="0" />' # No compression workers
 	]
 
 	# Do passing tests.
@@ -264,6 +357,1222 @@ def testValidateInnerXml():
 
 	return res
 
+def testLoadConfig():
+	res = True
+	config = backuplib.loadConfig(StringIO.StringIO("""<?xml version="1.0"?>
+<settings>
+	<output path="~/backups" codec="rar" />
+	<credentials>
+		<credential name="database" username="user" password="pass" />
+		<credential name="database" username="other" password="pass" />
+	</credentials>
+	<targets>
+		<target name="app1" intervalHours="24">
+			<database name="app1" credential="database" />
+		</target>
+		<target name="app2">
+			<database name="app2" credential="missing" />
+		</target>
+	</targets>
+</settings>"""))
+
+	# Every error is reported, each with the line it occurs on.
+	res &= runTest(len, [config.errors], 4, "Ensure every config error is collected.")
+	res &= runTest(lambda: [error.split(':')[0] for error in config.errors], [], ['line 3', 'line 6', 'line 12', 'line 13'], "Ensure config errors carry line numbers.")
+	res &= runTest(lambda: 'first defined on line 5' in config.errors[1], [], True, "Ensure duplicates point at the original definition.")
+
+	# Credentials and targets are indexed by name.
+	res &= runTest(lambda: config.credentials['database'].get('username'), [], 'user', "Ensure credentials are indexed by name.")
+	res &= runTest(lambda: config.credentialFor(config.targetsByName['app1'].find('./database')).get('password'), [], 'pass', "Ensure database credentials resolve through the index.")
+	res &= runTest(lambda: [target.get('name') for target in config.targets], [], ['app1', 'app2'], "Ensure targets keep their config order.")
+
+	# Malformed XML is reported rather than raised.
+	config = backuplib.loadConfig(StringIO.StringIO('<settings>\n<output path="x">\n</settings>'))
+	res &= runTest(lambda: (config.isValid(), config.errors[0].startswith('line 3: Malformed XML')), [], (False, True), "Ensure malformed XML is reported with its line.")
+
+	return res
+
+def testConfigCache():
+	os.system('rm -rf testdata/output/cache')
+	os.system('mkdir -p testdata/output/cache')
+	configPath = 'testdata/output/cache/config.xml'
+	open(configPath, 'w').write('<settings><output path="/a" /><targets><target name="app1" intervalHours="24" /></targets></settings>')
+
+	# Count how often the config is actually compiled.
+	compiles = []
+	compileConfig = backuplib.compileConfig
+	def countingCompile(root, lines=None):
+		compiles.append(root)
+		return compileConfig(root, lines)
+	backuplib.compileConfig = countingCompile
+
+	res = True
+	try:
+		res &= runTest(lambda: backuplib.loadCachedConfig(configPath).targetsByName.keys(), [], ['app1'], "Ensure a cold start compiles the config.")
+		res &= runTest(os.path.isfile, ['testdata/output/cache/.config.xml.cache'], True, "Ensure the compiled config is cached next to it.")
+		res &= runTest(lambda: (backuplib.loadCachedConfig(configPath).output.get('path'), len(compiles)), [], ('/a', 1), "Ensure a warm start skips parsing and validation.")
+
+		# Same size and mtime, different content: the hash still catches it.
+		st = os.stat(configPath)
+		open(configPath, 'w').write('<settings><output path="/b" /><targets><target name="app1" intervalHours="24" /></targets></settings>')
+		os.utime(configPath, (st.st_atime, st.st_mtime))
+		res &= runTest(lambda: (backuplib.loadCachedConfig(configPath).output.get('path'), len(compiles)), [], ('/b', 2), "Ensure an edited config invalidates the cache.")
+
+		# A corrupt cache is recompiled rather than trusted.
+		open('testdata/output/cache/.config.xml.cache', 'w').write('garbage')
+		res &= runTest(lambda: (backuplib.loadCachedConfig(configPath).isValid(), len(compiles)), [], (True, 3), "Ensure a corrupt cache is ignored.")
+
+		# The cache holds passwords, so it is no more readable than the config, and a cache someone
+		# else could have written is not trusted.
+		os.chmod(configPath, 0600)
+		open(configPath, 'a').write('\n')
+		backuplib.loadCachedConfig(configPath)
+		res &= runTest(lambda: os.stat('testdata/output/cache/.config.xml.cache').st_mode & 0777, [], 0600, "Ensure the cache gets the config's permissions.")
+		os.chown('testdata/output/cache/.config.xml.cache', os.geteuid() + 4242, -1)
+		res &= runTest(lambda: (backuplib.loadCachedConfig(configPath).output.get('path'), len(compiles)), [], ('/b', 5), "Ensure a cache owned by someone else is ignored.")
+	finally:
+		backuplib.compileConfig = compileConfig
+
+	return res
+
+def testArchiveWriter():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+
+	# Write a folder and an in-memory member into a single archive.
+	archive = backuplib.ArchiveWriter('testdata/output/archive.tar.gz')
+	archive.addPath('testdata/input/testfolder2')
+	archive.addBuffer('dump.sql', 'select 1;\n')
+	archive.close()
+
+	# Verify the archive is a well-formed .tar.gz and the byte counts add up.
+	res = True
+	res &= runTest(os.system, ['gzip -t testdata/output/archive.tar.gz'], 0, "Ensure archives pass gzip integrity checks.")
+	tar = tarfile.open('testdata/output/archive.tar.gz', 'r:gz')
+	res &= runTest(sorted, [tar.getnames()], ['dump.sql', 'testfolder2', 'testfolder2/testfile3.txt', 'testfolder2/testfile4.txt'], "Ensure all members are archived.")
+	res &= runTest(tar.extractfile('dump.sql').read, [], 'select 1;\n', "Ensure buffered members are archived.")
+	tar.close()
+	res &= runTest(lambda: archive.bytesIn, [], 28, "Ensure uncompressed bytes are counted.")
+	res &= runTest(lambda: archive.bytesOut, [], os.path.getsize('testdata/output/archive.tar.gz'), "Ensure compressed bytes are counted.")
+
+	# A file that can't be read to the end is padded, so the archive stays well-formed.
+	class FailingFile(object):
+		def __init__(self, reads):
+			self.reads = reads
+		def read(self, size=-1):
+			if len(self.reads) == 0:
+				raise IOError(errno.EIO, 'Input/output error')
+			return self.reads.pop(0)
+	archive = backuplib.ArchiveWriter('testdata/output/padded.tar.gz')
+	reader = backuplib.HashingReader(FailingFile([]), 6)
+	tarinfo = tarfile.TarInfo('broken.txt')
+	tarinfo.size = 6
+	archive.addMember(tarinfo, reader)
+	archive.addBuffer('after.txt', 'ok\n')
+	archive.close()
+	tar = tarfile.open('testdata/output/padded.tar.gz', 'r:gz')
+	res &= runTest(lambda: (tar.extractfile('broken.txt').read(), tar.extractfile('after.txt').read(), reader.error.errno), [], ('\0' * 6, 'ok\n', errno.EIO), "Ensure files that fail to read are padded with zeros.")
+	tar.close()
+
+	# Failing to write the archive itself fails the target, and nothing is committed.
+	os.system('mkdir -p testdata/output/full/source testdata/output/full/archives')
+	for number in range(24):
+		open('testdata/output/full/source/f{0:02d}'.format(number), 'wb').write(os.urandom(128 * 1024))
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output/full/archives" />
+					<targets>
+						<target name="full" intervalHours="1" keepLast="1">
+							<folder path="testdata/output/full/source" />
+						</target>
+					</targets>
+				</settings>"""))
+	class FullDisk(object):
+		def __init__(self, fileobj):
+			self.fileobj = fileobj
+			self.writes = 0
+		def write(self, data):
+			self.writes += 1
+			if self.writes == 3:
+				raise IOError(errno.ENOSPC, 'No space left on device')
+			self.fileobj.write(data)
+		def close(self):
+			self.fileobj.close()
+	create = backuplib.LocalStorage.create
+	backuplib.LocalStorage.create = lambda self, name: FullDisk(create(self, name))
+	log = backuplib.log
+	backuplib.log = mockLog
+	stats = backuplib.backupTarget(config, config.targets[0], 'testdata/output/full/archives', '2017-06-02.20-27-00')
+	backuplib.log = log
+	backuplib.LocalStorage.create = create
+	catalog = backuplib.Catalog('testdata/output/full/archives')
+	res &= runTest(lambda: (stats['success'], glob.glob('testdata/output/full/archives/*.tar.gz'), catalog.archives('full')), [], (False, [], []), "Ensure failed archive writes fail the target without committing the archive.")
+	catalog.close()
+
+	return res
+
+def testArchiveStream():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+
+	# Archive one stream that fits in a chunk and one that has to be split.
+	archive = backuplib.ArchiveWriter('testdata/output/archive.tar.gz')
+	archive.addStream('short.sql', StringIO.StringIO('abc'), 4)
+	archive.addStream('long.sql', StringIO.StringIO('abcdefghij'), 4)
+	archive.close()
+
+	# Verify chunk members concatenate back into the original stream.
+	res = True
+	tar = tarfile.open('testdata/output/archive.tar.gz', 'r:gz')
+	res &= runTest(tar.getnames, [], ['short.sql', 'long.sql.000000', 'long.sql.000001', 'long.sql.000002'], "Ensure long streams are split into chunk members.")
+	res &= runTest(lambda: ''.join(tar.extractfile(name).read() for name in tar.getnames()[1:]), [], 'abcdefghij', "Ensure chunk members concatenate to the stream.")
+	tar.close()
+
+	return res
+
+def testArchiveIndex():
+	# Prepare filesystem: several files spanning many small compression blocks.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/data/sub')
+	for i in range(8):
+		open('testdata/output/data/file{0}.txt'.format(i), 'w').write(''.join('line {0} of file {1}\n'.format(j, i) for j in range(2000)))
+	open('testdata/output/data/sub/small.txt', 'w').write('small file\n')
+	os.symlink('small.txt', 'testdata/output/data/sub/link.txt')
+	archive = backuplib.ArchiveWriter('testdata/output/indexed.tar.gz', 'gzip', 1, 8192, indexed=True)
+	archive.addPath('testdata/output/data')
+	archive.close()
+
+	# Listing reads only the index; extracting one file only touches the blocks it spans.
+	res = True
+	res &= runTest(backuplib.hasArchiveIndex, ['testdata/output/indexed.tar.gz'], True, "Ensure indexed archives get a sidecar index.")
+	reader = backuplib.ArchiveReader('testdata/output/indexed.tar.gz')
+	res &= runTest(lambda: len(reader.members), [], 12, "Ensure the index lists every member.")
+	res &= runTest(lambda: reader.blocksRead, [], 0, "Ensure listing decompresses nothing.")
+	reader.extract(reader.select(['data/file5.txt']), 'testdata/output/restored')
+	res &= compareFiles('testdata/output/data/file5.txt', 'testdata/output/restored/data/file5.txt')
+	res &= runTest(lambda: 0 < reader.blocksRead <= 6 and len(reader.blocks) >= 30, [], True, "Ensure only the member's own blocks are decompressed.")
+
+	# Whole folders can be extracted too, symlinks included.
+	reader.extract(reader.select(['data/sub']), 'testdata/output/restored')
+	res &= compareFiles('testdata/output/data/sub/small.txt', 'testdata/output/restored/data/sub/small.txt')
+	res &= runTest(os.readlink, ['testdata/output/restored/data/sub/link.txt'], 'small.txt', "Ensure symlinks are restored from the index.")
+	reader.close()
+
+	# The blocks still form one ordinary gzip stream.
+	tar = tarfile.open('testdata/output/indexed.tar.gz', 'r:gz')
+	res &= runTest(lambda: len(tar.getmembers()), [], 12, "Ensure indexed archives remain standard tarballs.")
+	tar.close()
+
+	return res
+
+def testVerify():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+	for name, workers in [('good', 1), ('blocks', 2), ('corrupt', 1), ('truncated', 1)]:
+		archive = backuplib.ArchiveWriter('testdata/output/{0}.tar.gz'.format(name), 'gzip', workers, 4096)
+		archive.addPath('testdata/input/testfolder2')
+		archive.addBuffer('dump.sql', 'INSERT INTO t VALUES (1);\n' * 1000)
+		archive.close()
+
+	# Flip a byte in one archive and cut another short.
+	data = open('testdata/output/corrupt.tar.gz', 'rb').read()
+	open('testdata/output/corrupt.tar.gz', 'wb').write(data[:100] + chr(ord(data[100]) ^ 0xff) + data[101:])
+	data = open('testdata/output/truncated.tar.gz', 'rb').read()
+	open('testdata/output/truncated.tar.gz', 'wb').write(data[:len(data) / 2])
+
+	res = True
+	manifest = json.load(open('testdata/output/good.tar.gz.manifest.json'))
+	res &= runTest(lambda: sorted(member[0] for member in manifest['members']), [], ['dump.sql', 'testfolder2/testfile3.txt', 'testfolder2/testfile4.txt'], "Ensure the manifest checksums every member with data.")
+	res &= runTest(backuplib.verifyArchive, ['testdata/output/good.tar.gz'], [], "Ensure an intact archive verifies.")
+	res &= runTest(backuplib.verifyArchive, ['testdata/output/blocks.tar.gz', 1024 * 1024], [], "Ensure block-compressed archives verify under a read limit.")
+	res &= runTest(lambda: len(backuplib.verifyArchive('testdata/output/corrupt.tar.gz')) > 0, [], True, "Ensure corruption is detected.")
+	res &= runTest(lambda: len(backuplib.verifyArchive('testdata/output/truncated.tar.gz')) > 0, [], True, "Ensure truncation is detected.")
+	results = dict(backuplib.verifyArchives(glob.glob('testdata/output/*.tar.gz'), 2))
+	res &= runTest(lambda: sorted(name for name in results if len(results[name]) > 0), [], ['testdata/output/corrupt.tar.gz', 'testdata/output/truncated.tar.gz'], "Ensure archives are verified in parallel.")
+
+	# The token bucket holds readers to its rate once the initial burst is spent.
+	bucket = backuplib.TokenBucket(1000)
+	start = time.time()
+	for i in range(5):
+		bucket.consume(500)
+	res &= runTest(lambda: 1.3 < time.time() - start < 2.0, [], True, "Ensure the token bucket throttles to its rate.")
+
+	return res
+
+def testThrottling():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/source')
+	open('testdata/output/source/data.bin', 'wb').write(os.urandom(300 * 1000))
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output" metrics="true" totalWriteBytesPerSecond="1000000000" niceLevel="5" ioClass="idle" />
+					<credentials>
+						<credential name="database" username="user" password="pass" />
+					</credentials>
+					<targets>
+						<target name="limited" intervalHours="1" readBytesPerSecond="100000">
+							<folder path="testdata/output/source" />
+							<database name="testapp1" credential="database" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+	useFakeTools()
+	start = time.time()
+	jobs = backuplib.doBackup(config)
+	seconds = time.time() - start
+	backuplib.log = log
+
+	res = True
+	res &= runTest(lambda: config.isValid(), [], True, "Ensure throttling settings are accepted.")
+	res &= runTest(lambda: jobs[0].result['success'], [], True, "Ensure mysqldump runs under nice and ionice.")
+	res &= runTest(lambda: 1.5 < seconds < 4, [], True, "Ensure reads are held to the target's rate.")
+	records = [json.loads(line) for line in open('testdata/output/goodbackup-metrics.jsonl')]
+	res &= runTest(lambda: records[0]['throttleSeconds'] > 1, [], True, "Ensure time spent throttled is reported.")
+	res &= runTest(backuplib.priorityCommand, [10, 'best-effort'], ['ionice', '-c', '2', '-n', '7', 'nice', '-n', '10'], "Ensure child priorities map to a command prefix.")
+	res &= runTest(backuplib.priorityCommand, [], [], "Ensure children run as-is by default.")
+	errors = backuplib.loadConfig(StringIO.StringIO('<settings><output path="testdata/output" ioClass="realtime" readBytesPerSecond="0" /><targets /></settings>')).errors
+	res &= runTest(lambda: sorted('ioClass' in error for error in errors), [], [False, True], "Ensure bad throttling settings are rejected.")
+
+	# The adaptive throttle slows down while the disk is busy, but never stops for long.
+	diskQueueDepth = backuplib.diskQueueDepth
+	backoffSeconds = (backuplib.LOAD_BACKOFF_SECONDS, backuplib.LOAD_BACKOFF_MAX_SECONDS)
+	queueDepths = [20] * 8 + [0] * 8
+	backuplib.diskQueueDepth = lambda: queueDepths.pop(0)
+	backuplib.LOAD_BACKOFF_SECONDS, backuplib.LOAD_BACKOFF_MAX_SECONDS = (0.01, 0.05)
+	throttle = backuplib.Throttle(maxQueue=10)
+	throttle.consume(100)
+	res &= runTest(lambda: (len(queueDepths), throttle.bytes, throttle.waitSeconds >= 0.01), [], (15, 100, True), "Ensure the throttle backs off while the disk is busy.")
+	waitSeconds = throttle.waitSeconds
+	throttle.consume(100)
+	res &= runTest(lambda: (len(queueDepths), throttle.waitSeconds - waitSeconds < 0.005), [], (15, True), "Ensure the load is only sampled now and then.")
+	pauses = []
+	while len(queueDepths) > 0:
+		throttle.nextSample = 0
+		throttle.consume(100)
+		pauses.append(throttle.pause)
+	res &= runTest(lambda: (pauses[:7], throttle.bytes), [], ([0.02, 0.04, 0.05, 0.05, 0.05, 0.05, 0.05], 1700), "Ensure each busy sample pauses a bounded, growing time.")
+	res &= runTest(lambda: (pauses[7:10], pauses[-1]), [], ([0.025, 0.0125, 0.00625], 0.0), "Ensure the rate recovers gradually once the disk is calm.")
+	backuplib.diskQueueDepth = diskQueueDepth
+	backuplib.LOAD_BACKOFF_SECONDS, backuplib.LOAD_BACKOFF_MAX_SECONDS = backoffSeconds
+
+	return res
+
+def testEncryption():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+	key = os.urandom(32)
+	open('testdata/output/raw.key', 'wb').write(key)
+	open('testdata/output/hex.key', 'w').write(key.encode('hex') + '\n')
+	open('testdata/output/short.key', 'wb').write(key[:16])
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output" encryptionKey="testdata/output/hex.key" cipher="chacha20-poly1305" compressionBlockSize="4096" />
+					<credentials>
+						<credential name="database" username="user" password="pass" />
+					</credentials>
+					<targets>
+						<target name="secret" intervalHours="1" compressionWorkers="2">
+							<folder path="testdata/input/testfolder2" />
+							<database name="testapp1" credential="database" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+	useFakeTools()
+	jobs = backuplib.doBackup(config)
+	backuplib.log = log
+
+	res = True
+	res &= runTest(backuplib.loadEncryptionKey, ['testdata/output/raw.key'], key, "Ensure raw key files are read.")
+	res &= runTest(backuplib.loadEncryptionKey, ['testdata/output/hex.key'], key, "Ensure hex key files are read.")
+	def loadShortKey():
+		try:
+			return backuplib.loadEncryptionKey('testdata/output/short.key')
+		except ValueError:
+			return None
+	res &= runTest(loadShortKey, [], None, "Ensure short keys are rejected.")
+	res &= runTest(lambda: backuplib.parseArchiveName('appbackup2017-06-02.20-27-00.123.tar.gz.enc')[0], [], 'app', "Ensure encrypted archives are recognised by name.")
+	archives = glob.glob('testdata/output/*.tar.gz*')
+	if not backuplib.isEncryptionAvailable():
+		# Without the cryptography module, nothing may be written in plaintext instead.
+		res &= runTest(lambda: (jobs[0].result['success'], archives), [], (False, []), "Ensure encrypted targets are skipped when encryption is unavailable.")
+		return res
+
+	archivePath = [path for path in archives if path.endswith('.tar.gz.enc')][0]
+	res &= runTest(lambda: jobs[0].result['success'], [], True, "Ensure encrypted backups succeed.")
+	res &= runTest(lambda: any('testfile3' in open(path, 'rb').read() for path in archives), [], False, "Ensure no member names leak from the archive or its sidecars.")
+	res &= runTest(backuplib.verifyArchive, [archivePath, None, key], [], "Ensure encrypted archives verify with their key.")
+	res &= runTest(lambda: len(backuplib.verifyArchive(archivePath, None, os.urandom(32))) > 0, [], True, "Ensure the wrong key is detected.")
+	reader = backuplib.ArchiveReader(archivePath, key)
+	res &= runTest(lambda: reader.read(reader.select(['testfolder2/testfile3.txt'])[0]), [], open('testdata/input/testfolder2/testfile3.txt').read(), "Ensure encrypted archives support random access.")
+	reader.close()
+	tar = backuplib.openArchive(archivePath, key)
+	res &= runTest(lambda: tar.extractfile([name for name in tar.getnames() if name.startswith('testapp1.')][0]).read(), [], open('testdata/input/testapp1.sql').read(), "Ensure encrypted archives stream through tarfile.")
+	tar.close()
+
+	# Cutting the final frame off must not go unnoticed.
+	data = open(archivePath, 'rb').read()
+	open(archivePath, 'wb').write(data[:-40])
+	res &= runTest(lambda: len(backuplib.verifyArchive(archivePath, None, key)) > 0, [], True, "Ensure truncated encrypted archives are detected.")
+
+	return res
+
+def testS3Storage():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/source')
+	open('testdata/output/source/data.bin', 'wb').write(os.urandom(16 * 1024 * 1024))
+	server = FakeS3Server()
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output" keepLast="1">
+						<s3 endpoint="http://127.0.0.1:{0}" bucket="backups" prefix="host1/" accessKey="test" secretKey="secret" partSize="5242880" uploadWorkers="3" />
+					</output>
+					<targets>
+						<target name="offsite" intervalHours="1">
+							<folder path="testdata/output/source" />
+						</target>
+					</targets>
+				</settings>""".format(server.server_port)))
+	log = backuplib.log
+	backuplib.log = mockLog
+	jobs = backuplib.doBackup(config)
+	firstObjects = dict(server.objects)
+	firstRun = (len(server.requests), len(server.connections))
+	time.sleep(0.01)
+	backuplib.doBackup(config)
+	secondObjects = dict(server.objects)
+
+	# An upload that fails is aborted rather than left behind, and fails the target.
+	server.failParts = True
+	time.sleep(0.01)
+	failedJobs = backuplib.doBackup(config)
+	backuplib.log = log
+	server.shutdown()
+	server.server_close()
+
+	# Signing follows the worked example in the AWS Signature Version 4 documentation.
+	res = True
+	res &= runTest(backuplib.signV4, [
+		'GET', '/', [('Action', 'ListUsers'), ('Version', '2010-05-08')],
+		{'Host': 'iam.amazonaws.com', 'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8', 'X-Amz-Date': '20150830T123600Z'},
+		hashlib.sha256('').hexdigest(), 'AKIDEXAMPLE', 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', 'us-east-1', 'iam'],
+		'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/iam/aws4_request, SignedHeaders=content-type;host;x-amz-date, '
+		'Signature=5d672d79c15b13162d9279b0855cfba6789a8edb4c82c400e06b5924a6f2b5d7', "Ensure requests are signed with AWS Signature Version 4.")
+
+	res &= runTest(lambda: (jobs[0].result['success'], glob.glob('testdata/output/*.tar.gz')), [], (True, []), "Ensure archives go to object storage instead of the output folder.")
+	archives = [name for name in firstObjects if name.endswith('.tar.gz')]
+	res &= runTest(lambda: sorted(firstObjects), [], [archives[0] + extension for extension in ['', '.idx', '.manifest.json']], "Ensure the archive and its sidecars are uploaded.")
+	res &= runTest(lambda: archives[0].startswith('host1/offsitebackup'), [], True, "Ensure objects are named under the prefix.")
+	res &= runTest(lambda: server.partCounts[archives[0]] > 3, [], True, "Ensure large archives are uploaded in parts, retrying failures.")
+	tar = tarfile.open(fileobj=StringIO.StringIO(firstObjects[archives[0]]), mode='r:gz')
+	res &= runTest(lambda: tar.extractfile('source/data.bin').read() == open('testdata/output/source/data.bin', 'rb').read(), [], True, "Ensure the uploaded archive is complete.")
+	res &= runTest(lambda: firstRun[1] <= 3 and firstRun[0] > firstRun[1], [], True, "Ensure connections are pooled and reused.")
+	res &= runTest(lambda: (len(secondObjects), archives[0] in secondObjects), [], (3, False), "Ensure retention prunes archives from object storage.")
+	res &= runTest(lambda: (failedJobs[0].result['success'], server.uploads, server.objects == secondObjects), [], (False, {}, True), "Ensure failed uploads are aborted.")
+
+	errors = backuplib.loadConfig(StringIO.StringIO('<settings><output path="testdata/output"><s3 partSize="65536" /></output><targets /></settings>')).errors
+	res &= runTest(len, [errors], 2, "Ensure bad object storage settings are rejected.")
+
+	return res
+
+def testResume():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/source')
+	for i in range(20):
+		open('testdata/output/source/file{0:02d}.bin'.format(i), 'wb').write(os.urandom(20 * 1000))
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output" />
+					<targets>
+						<target name="large" intervalHours="1" incremental="true" checkpointBytes="50000">
+							<folder path="testdata/output/source" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	# Kill the first run part way through, after a few checkpoints.
+	added = []
+	addFile = backuplib.ArchiveWriter.addFile
+	def interruptingAddFile(self, path, arcname, fileStat, data):
+		if len(added) == 12:
+			raise KeyboardInterrupt()
+		added.append(arcname)
+		return addFile(self, path, arcname, fileStat, data)
+	backuplib.ArchiveWriter.addFile = interruptingAddFile
+	try:
+		backuplib.backupTarget(config, config.targets[0], 'testdata/output', '2017-06-02_20-27-00')
+	except KeyboardInterrupt:
+		pass
+	interrupted = (len(glob.glob('testdata/output/*.partial')), len(glob.glob('testdata/output/*.tar.gz')), os.path.exists('testdata/output/large.journal'))
+
+	# Rewrite a checkpointed file before resuming; its old copy mustn't stand in for the new one.
+	run, state = backuplib.Journal('testdata/output/large.journal').load()
+	changedName = [entry[0] for entry in state['checksums']][0]
+	changedData = os.urandom(30 * 1000)
+	open('testdata/output/' + changedName, 'wb').write(changedData)
+	os.utime('testdata/output/' + changedName, (time.time() + 10, time.time() + 10))
+
+	# The next run picks up from the last checkpoint under the interrupted run's name.
+	del added[:]
+	stats = backuplib.backupTarget(config, config.targets[0], 'testdata/output', '2017-06-02_21-27-00')
+	resumed = list(added)
+	del added[:]
+	backuplib.backupTarget(config, config.targets[0], 'testdata/output', '2017-06-02_22-27-00')
+	backuplib.ArchiveWriter.addFile = addFile
+	backuplib.log = log
+
+	res = True
+	res &= runTest(lambda: interrupted, [], (1, 0, True), "Ensure an interrupted archive stays partial and its journal is kept.")
+	res &= runTest(lambda: stats['success'] and 0 < len(resumed) < 20, [], True, "Ensure a resumed run only archives what wasn't checkpointed.")
+	res &= runTest(lambda: changedName in resumed, [], True, "Ensure files changed since their checkpoint are archived again on resume.")
+	res &= runTest(lambda: added, [], [], "Ensure files skipped on resume are still recorded in the incremental index.")
+	archives = glob.glob('testdata/output/*[0-9].tar.gz')
+	res &= runTest(lambda: [os.path.basename(path) for path in archives], [], ['largebackup2017-06-02_20-27-00.tar.gz'], "Ensure a resumed run completes the interrupted archive.")
+	tar = tarfile.open(archives[0])
+	names = [member.name for member in tar.getmembers() if member.isfile()]
+	res &= runTest(lambda: (len(names), len(set(names)), names.count(changedName)), [], (21, 20, 2), "Ensure the resumed archive holds every file once, and the changed one twice.")
+	res &= runTest(lambda: all(tar.extractfile(name).read() == open('testdata/output/' + name, 'rb').read() for name in names), [], True, "Ensure the copy added on resume wins on extract.")
+	reader = backuplib.ArchiveReader(archives[0])
+	reader.extract(reader.select([changedName]), 'testdata/output/restored')
+	res &= runTest(lambda: open('testdata/output/restored/' + changedName, 'rb').read() == changedData, [], True, "Ensure indexed restores get the copy added on resume.")
+	res &= runTest(backuplib.verifyArchive, [archives[0]], [], "Ensure the resumed archive matches its checksum and index.")
+	res &= runTest(lambda: glob.glob('testdata/output/*.partial') + glob.glob('testdata/output/*.journal'), [], [], "Ensure the journal and partial files are cleaned up.")
+
+	return res
+
+def testSharedContent():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/source/common testdata/output/archives')
+	open('testdata/output/source/common/app.conf', 'w').write('listen 8080\n')
+	open('testdata/output/source/common/vendor.bin', 'wb').write(os.urandom(300 * 1000))
+	open('testdata/output/source/own.txt', 'w').write('only in app1\n')
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output/archives" shareContent="true" keepLast="1" />
+					<credentials>
+						<credential name="database" username="user" password="pass" />
+					</credentials>
+					<targets>
+						<target name="app1" intervalHours="1">
+							<folder path="testdata/output/source" />
+							<folder path="testdata/output/source/common" />
+							<database name="shop" credential="database" />
+						</target>
+						<target name="app2" intervalHours="1">
+							<folder path="testdata/output/source/common" />
+							<database name="shop" credential="database" />
+						</target>
+					</targets>
+				</settings>"""))
+	useFakeTools()
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	# Back both targets up in one run, one after the other.
+	shared = backuplib.SharedContent()
+	first = backuplib.backupTarget(config, config.targets[0], 'testdata/output/archives', '2017-06-02.20-27-00', sharedContent=shared)
+	second = backuplib.backupTarget(config, config.targets[1], 'testdata/output/archives', '2017-06-02.20-27-00', sharedContent=shared)
+	app1Archive = 'testdata/output/archives/app1backup2017-06-02.20-27-00.tar.gz'
+	app2Archive = 'testdata/output/archives/app2backup2017-06-02.20-27-00.tar.gz'
+	os.environ['FAKE_MYSQL_LOG'] = os.path.abspath('testdata/output/replay')
+	restored = backuplib.restoreDatabase(app2Archive, 'shop', 'user', 'pass')
+	del os.environ['FAKE_MYSQL_LOG']
+	reader = backuplib.ArchiveReader(app2Archive)
+	reader.extract(reader.members, 'testdata/output/restored')
+	reader.close()
+
+	res = True
+	tar = tarfile.open(app1Archive)
+	res &= runTest(lambda: (tar.getmember('common/vendor.bin').islnk(), tar.getmember('common/vendor.bin').linkname), [], (True, 'source/common/vendor.bin'), "Ensure overlapping folders of a target are archived once, as hard links.")
+	tar.close()
+	res &= runTest(lambda: first['success'] and second['success'] and second['bytesIn'] < 1000, [], True, "Ensure files and dumps already archived this run aren't read again.")
+	res &= runTest(lambda: [compareFiles('testdata/output/source/common/' + name, 'testdata/output/restored/common/' + name) for name in ['app.conf', 'vendor.bin']], [], [True, True], "Ensure referenced files are extracted from the archive holding them.")
+	res &= runTest(lambda: (restored, [open(path).read() for path in glob.glob('testdata/output/replay.*')]), [], (True, ['shop\nuser\npass\n']), "Ensure referenced database dumps restore.")
+
+	# An archive other targets refer to outlives its own retention, until they are pruned too.
+	backuplib.backupTarget(config, config.targets[0], 'testdata/output/archives', '2017-06-02.21-27-00')
+	kept = len(glob.glob('testdata/output/archives/app1backup*.tar.gz'))
+	backuplib.backupTarget(config, config.targets[1], 'testdata/output/archives', '2017-06-02.21-27-00')
+	backuplib.backupTarget(config, config.targets[0], 'testdata/output/archives', '2017-06-02.22-27-00')
+	backuplib.log = log
+	res &= runTest(lambda: (kept, len(glob.glob('testdata/output/archives/app1backup*.tar.gz'))), [], (2, 1), "Ensure referenced archives are kept until nothing refers to them.")
+
+	# Overlapping targets scheduled together run one after the other, so the second can share.
+	backuplib.log = mockLog
+	jobs = backuplib.doBackup(config, config.targets)
+	backuplib.log = log
+	jobs.sort(key=lambda job: job.finishTime)
+	res &= runTest(lambda: (all(job.result['success'] for job in jobs), jobs[1].finishTime - jobs[1].wallSeconds >= jobs[0].finishTime, jobs[1].result['bytesIn'] < 1000), [], (True, True, True), "Ensure overlapping targets in one run share content.")
+
+	errors = backuplib.loadConfig(StringIO.StringIO('<settings><output path="testdata/output" shareContent="yes" /><targets /></settings>')).errors
+	res &= runTest(len, [errors], 1, "Ensure bad sharing settings are rejected.")
+
+	return res
+
+def testPlan():
+	# Prepare filesystem: compressible logs, incompressible data, and a tree with the same shape throughout.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/logs testdata/output/blobs testdata/output/archives')
+	for i in range(10):
+		open('testdata/output/logs/app{0}.log'.format(i), 'w').write('GET /index.html 200\n' * 5000)
+	open('testdata/output/blobs/data.bin', 'wb').write(os.urandom(500 * 1000))
+	for i in range(4):
+		for j in range(3):
+			os.makedirs('testdata/output/tree/dir{0}/sub{1}'.format(i, j))
+			for k in range(5):
+				open('testdata/output/tree/dir{0}/sub{1}/file{2}.txt'.format(i, j, k), 'w').write('x' * 1000)
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output/archives" />
+					<targets>
+						<target name="logs" intervalHours="24">
+							<folder path="testdata/output/logs" />
+						</target>
+						<target name="blobs" intervalHours="1">
+							<folder path="testdata/output/blobs" />
+						</target>
+						<target name="tree" intervalHours="1">
+							<folder path="testdata/output/tree" />
+						</target>
+					</targets>
+				</settings>"""))
+	json.dump({'logs': {'bytesPerSecond': 1000 * 1000}, 'blobs': {'bytesPerSecond': 100}}, open('testdata/output/archives/goodbackup-history.json', 'w'))
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	# Plan, forcing the biggest tree to be probed rather than walked, then back up for real.
+	walkEntries = backuplib.PLAN_WALK_ENTRIES
+	backuplib.PLAN_WALK_ENTRIES = 50
+	plans = dict((plan['name'], plan) for plan in backuplib.planBackup(config))
+	backuplib.PLAN_WALK_ENTRIES = walkEntries
+	written = sorted(os.listdir('testdata/output/archives'))
+	jobs = dict((job.name, job.result) for job in backuplib.doBackup(config, config.targets[:2]))
+	backuplib.log = log
+
+	res = True
+	res &= runTest(lambda: written, [], ['goodbackup-history.json'], "Ensure planning writes nothing.")
+	res &= runTest(lambda: (plans['logs']['files'], plans['logs']['bytes'], plans['logs']['sampled']), [], (10, 10 * 5000 * 20, False), "Ensure small trees are walked in full.")
+	res &= runTest(lambda: (plans['tree']['files'], plans['tree']['bytes'], plans['tree']['sampled']), [], (60, 60 * 1000, True), "Ensure huge trees are sized by probing.")
+	res &= runTest(lambda: all(0.5 < plans[name]['bytesOut'] / float(jobs[name]['bytesOut']) < 2 for name in ['logs', 'blobs']), [], True, "Ensure archive sizes are estimated from sampled compression ratios.")
+	res &= runTest(lambda: (round(plans['logs']['seconds'], 1), plans['logs']['tooSlow'], plans['blobs']['tooSlow']), [], (round(plans['logs']['bytesIn'] / 1e6, 1), False, True), "Ensure durations come from recorded throughput, flagging targets that overrun their interval.")
+
+	return res
+
+def testSnapshots():
+	# Prepare filesystem, including a snapshot left behind by a killed run.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/source/sub testdata/output/archives')
+	open('testdata/output/source/a.txt', 'w').write('before\n')
+	open('testdata/output/source/sub/b.txt', 'w').write('unchanged\n')
+	stale = os.path.join(os.path.abspath('testdata/output'), backuplib.SNAPSHOT_PREFIX + backuplib.snapshotName('snap', 'testdata/output/source'))
+	os.system('mkdir -p {0}/source && touch {0}/source/junk'.format(stale))
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output/archives" />
+					<targets>
+						<target name="snap" intervalHours="1" incremental="true">
+							<folder path="testdata/output/source" snapshot="copy" />
+						</target>
+						<target name="fallback" intervalHours="1">
+							<folder path="testdata/output/source" snapshot="btrfs" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	# Change a file once the snapshot is taken; the archive should hold it as it was.
+	take = backuplib.CopySnapshot.take
+	def takeThenWrite(self):
+		path = take(self)
+		open('testdata/output/source/a.txt', 'a').write('after\n')
+		return path
+	backuplib.CopySnapshot.take = takeThenWrite
+	backuplib.backupTarget(config, config.targets[0], 'testdata/output/archives', '2017-06-02.20-27-00')
+	backuplib.CopySnapshot.take = take
+	leftover = glob.glob('testdata/output/' + backuplib.SNAPSHOT_PREFIX + '*')
+	backuplib.backupTarget(config, config.targets[0], 'testdata/output/archives', '2017-06-02.21-27-00')
+	fallback = backuplib.backupTarget(config, config.targets[1], 'testdata/output/archives', '2017-06-02.20-27-00')
+	backuplib.log = log
+
+	res = True
+	tar = tarfile.open('testdata/output/archives/snapbackup2017-06-02.20-27-00.tar.gz')
+	res &= runTest(lambda: sorted(tar.getnames()), [], ['source', 'source/a.txt', 'source/sub', 'source/sub/b.txt'], "Ensure snapshots are archived under the live folder's names.")
+	res &= runTest(lambda: tar.extractfile('source/a.txt').read(), [], 'before\n', "Ensure the archive holds the folder as it was when the snapshot was taken.")
+	res &= runTest(lambda: leftover, [], [], "Ensure snapshots are released, including ones left behind by a killed run.")
+	tar = tarfile.open('testdata/output/archives/snapbackup2017-06-02.21-27-00.incr.tar.gz')
+	res &= runTest(lambda: [member.name for member in tar.getmembers() if member.isfile()], [], ['source/a.txt'], "Ensure incremental runs match snapshot files to their live paths.")
+	tar = tarfile.open('testdata/output/archives/fallbackbackup2017-06-02.20-27-00.tar.gz')
+	res &= runTest(lambda: (fallback['success'], tar.extractfile('source/a.txt').read()), [], (True, 'before\nafter\n'), "Ensure folders that can't be snapshotted are archived live.")
+
+	# Reflink snapshots must fail where cloning isn't supported, not silently copy everything.
+	runSnapshotCommand = backuplib.runSnapshotCommand
+	commands = []
+	def cloneUnsupported(args):
+		commands.append(args)
+		raise OSError('cp -a --reflink=always failed: Operation not supported')
+	backuplib.runSnapshotCommand = cloneUnsupported
+	snapshot = backuplib.openSnapshot('reflink', 'testdata/output/source', 'clone')
+	try:
+		snapshot.create()
+		reflinkError = None
+	except OSError as e:
+		reflinkError = str(e)
+	backuplib.runSnapshotCommand = runSnapshotCommand
+	res &= runTest(lambda: ('--reflink=always' in commands[0], 'snapshot="copy"' in reflinkError, os.path.exists(snapshot.container)), [], (True, True, False), "Ensure reflink snapshots fail clearly instead of copying in full.")
+
+	errors = backuplib.loadConfig(StringIO.StringIO('<settings><output path="testdata/output" /><targets><target name="t" intervalHours="1"><folder path="x" snapshot="zfs" /></target></targets></settings>')).errors
+	res &= runTest(len, [errors], 1, "Ensure unknown snapshot methods are rejected.")
+
+	return res
+
+def testSparseFiles():
+	# Prepare filesystem: a disk image that is mostly holes, with more data runs than fit in the
+	# tar header, and one ending in data.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/source')
+	image = 'testdata/output/source/disk.img'
+	with open(image, 'wb') as imageFile:
+		imageFile.truncate(64 * 1024 * 1024)
+		for run in range(10):
+			imageFile.seek(run * 6 * 1024 * 1024 + 4096)
+			imageFile.write(os.urandom(64 * 1024))
+		segments = backuplib.dataSegments(imageFile.fileno(), 64 * 1024 * 1024)
+	with open('testdata/output/source/tail.img', 'wb') as imageFile:
+		imageFile.seek(16 * 1024 * 1024 - 4096)
+		imageFile.write('end of file\n')
+
+	archive = backuplib.ArchiveWriter('testdata/output/archive.tar.gz', indexed=True)
+	archive.addPath('testdata/output/source')
+	archive.close()
+
+	res = True
+	tar = tarfile.open('testdata/output/archive.tar.gz')
+	member = tar.getmember('source/disk.img')
+	res &= runTest(lambda: tar.extractfile(member).read() == open(image, 'rb').read(), [], True, "Ensure sparse files read back as the original file.")
+	res &= runTest(lambda: tar.extractfile('source/tail.img').read() == open('testdata/output/source/tail.img', 'rb').read(), [], True, "Ensure sparse files ending in data read back as the original file.")
+	tar.close()
+	res &= runTest(backuplib.verifyArchive, ['testdata/output/archive.tar.gz'], [], "Ensure sparse files verify against the manifest.")
+	reader = backuplib.ArchiveReader('testdata/output/archive.tar.gz')
+	reader.extract(reader.select(['source']), 'testdata/output/restored')
+	reader.close()
+	restored = 'testdata/output/restored/source/disk.img'
+	res &= runTest(lambda: open(restored, 'rb').read() == open(image, 'rb').read(), [], True, "Ensure sparse files are extracted intact.")
+	if segments is None or len(segments) != 10:
+		# Where the filesystem doesn't report holes, sparse files are archived whole.
+		return res
+
+	res &= runTest(lambda: archive.bytesIn < 1024 * 1024, [], True, "Ensure only the data runs of sparse files are read.")
+	res &= runTest(lambda: (member.issparse(), member.size), [], (True, 64 * 1024 * 1024), "Ensure sparse files are archived as sparse members.")
+	res &= runTest(lambda: os.stat(restored).st_blocks * 512 < 4 * 1024 * 1024, [], True, "Ensure extracted sparse files keep their holes.")
+
+	return res
+
+def testParallelTableDump():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+	useFakeTools()
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	# Dump each table of the database on its own connection.
+	archive = backuplib.ArchiveWriter('testdata/output/archive.tar.gz')
+	dumped = backuplib.dumpDatabaseTables(archive, 'shop.2017-06-02.20-27-00', 'shop', 'user', 'pass', 2)
+	archive.close()
+
+	# Verify each table got its own member and the manifest doesn't claim one snapshot point.
+	res = True
+	res &= runTest(lambda: dumped, [], True, "Ensure per-table dumps succeed.")
+	tar = tarfile.open('testdata/output/archive.tar.gz', 'r:gz')
+	res &= runTest(sorted, [tar.getnames()], ['shop.2017-06-02.20-27-00/customers.sql', 'shop.2017-06-02.20-27-00/manifest.json', 'shop.2017-06-02.20-27-00/orders.sql', 'shop.2017-06-02.20-27-00/products.sql'], "Ensure each table is archived as its own member.")
+	res &= runTest(tar.extractfile('shop.2017-06-02.20-27-00/orders.sql').read, [], 'shop.orders\nuser\npass\n', "Ensure table members hold that table's dump.")
+	manifest = json.load(tar.extractfile('shop.2017-06-02.20-27-00/manifest.json'))
+	tar.close()
+	res &= runTest(lambda: (manifest['consistent'], 'binlogPosition' in json.dumps(manifest), all(table['started'] for table in manifest['tables'])), [], (False, False, True), "Ensure the manifest records when each table was dumped, and no binary log position.")
+	res &= runTest(lambda: sorted(table['name'] for table in manifest['tables']), [], ['customers', 'orders', 'products'], "Ensure the manifest lists every table.")
+
+	# Replay the tables in parallel and check every table reached the mysql client.
+	os.environ['FAKE_MYSQL_LOG'] = os.path.abspath('testdata/output/replay')
+	restored = backuplib.restoreDatabase('testdata/output/archive.tar.gz', 'shop', 'user', 'pass', 2)
+	del os.environ['FAKE_MYSQL_LOG']
+	backuplib.log = log
+	res &= runTest(lambda: restored, [], True, "Ensure per-table dumps restore.")
+	res &= runTest(lambda: sorted(open(path).read() for path in glob.glob('testdata/output/replay.*')), [],
+		['shop.customers\nuser\npass\n', 'shop.orders\nuser\npass\n', 'shop.products\nuser\npass\n'], "Ensure each table is replayed on its own connection.")
+
+	# Backed-up files that merely look like dumps of the database are never replayed.
+	os.system('rm -f testdata/output/replay.*')
+	archive = backuplib.ArchiveWriter('testdata/output/whole.tar.gz')
+	archive.addBuffer('shop.sql.bak', 'DROP DATABASE shop;\n')
+	backuplib.dumpDatabase(archive, 'shop.2017-06-02.20-27-00.sql', 'shop', 'user', 'pass')
+	archive.addBuffer('shop.sql.gz', 'DROP DATABASE shop;\n')
+	archive.close()
+	backuplib.log = mockLog
+	os.environ['FAKE_MYSQL_LOG'] = os.path.abspath('testdata/output/replay')
+	restored = backuplib.restoreDatabase('testdata/output/whole.tar.gz', 'shop', 'user', 'pass')
+	del os.environ['FAKE_MYSQL_LOG']
+	backuplib.log = log
+	res &= runTest(lambda: (restored, [open(path).read() for path in glob.glob('testdata/output/replay.*')]), [], (True, ['shop\nuser\npass\n']), "Ensure only members named like dumps are restored.")
+
+	return res
+
+def testBlockCompressWriter():
+	# Compress a few blocks' worth of data on a worker pool.
+	data = ''.join(str(i) for i in range(20000))
+	output = StringIO.StringIO()
+	output.close = lambda: None
+	writer = backuplib.BlockCompressWriter(output, 'gzip', 3, 8192)
+	for i in range(0, len(data), 1000):
+		writer.write(data[i:i + 1000])
+	writer.close()
+
+	# The result should be a multi-member gzip stream that decompresses back to the input.
+	res = True
+	compressed = output.getvalue()
+	res &= runTest(compressed.count, ['\x1f\x8b\x08'], (len(data) + 8191) / 8192, "Ensure each block is written as its own gzip member.")
+	res &= runTest(gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read, [], data, "Ensure multi-member output decompresses as one stream.")
+
+	return res
+
+def testRunJobs():
+	# Track how many jobs hold each resource at once, and the order they start in.
+	lock = threading.Lock()
+	active = {'all': 0, 'disk': 0}
+	peak = {'all': 0, 'disk': 0}
+	started = []
+	def work(name, usesDisk):
+		with lock:
+			started.append(name)
+			for key in (['all', 'disk'] if usesDisk else ['all']):
+				active[key] += 1
+				peak[key] = max(peak[key], active[key])
+		time.sleep(0.05)
+		with lock:
+			for key in (['all', 'disk'] if usesDisk else ['all']):
+				active[key] -= 1
+		return name
+
+	# Run a mix of jobs, some of which share a device.
+	jobs = [
+		backuplib.Job('a', lambda: work('a', True), [('device', 'disk')], 1),
+		backuplib.Job('b', lambda: work('b', True), [('device', 'disk')], 3),
+		backuplib.Job('c', lambda: work('c', False), [], 2),
+		backuplib.Job('d', lambda: work('d', True), [('device', 'disk')]),
+		backuplib.Job('e', lambda: work('e', False), [], 5),
+	]
+	backuplib.runJobs(jobs, 3, {'device': 2})
+
+	# Verify every job ran, the caps held and jobs started in order of expected duration.
+	res = True
+	res &= runTest(lambda: [job.result for job in jobs], [], ['a', 'b', 'c', 'd', 'e'], "Ensure every job runs.")
+	res &= runTest(lambda: peak, [], {'all': 3, 'disk': 2}, "Ensure global and per-resource caps are respected.")
+	res &= runTest(lambda: started[:3], [], ['d', 'e', 'b'], "Ensure unknown and longer jobs start first.")
+
+	# Run strictly serially to check the order of the remaining jobs.
+	del started[:]
+	backuplib.runJobs(jobs, 1)
+	res &= runTest(lambda: started, [], ['d', 'e', 'b', 'c', 'a'], "Ensure jobs are prioritized by expected duration.")
+
+	return res
+
+def testWalkTree():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/tree/logs testdata/output/tree/cache/deep testdata/output/tree/conf')
+	for path in ['logs/app.log', 'logs/app.txt', 'cache/deep/blob.bin', 'conf/app.conf', 'conf/app.tmp', 'readme.txt']:
+		open('testdata/output/tree/' + path, 'w').write(path)
+
+	# Walk everything, on several threads.
+	res = True
+	walk = lambda *args: sorted(entry.arcname for entry in backuplib.walkTree('testdata/output/tree', *args))
+	res &= runTest(walk, [[], [], 3], ['tree', 'tree/cache', 'tree/cache/deep', 'tree/cache/deep/blob.bin', 'tree/conf', 'tree/conf/app.conf', 'tree/conf/app.tmp', 'tree/logs', 'tree/logs/app.log', 'tree/logs/app.txt', 'tree/readme.txt'], "Ensure the walker finds every entry.")
+
+	# Excluded subtrees and names are skipped, and includes filter files.
+	res &= runTest(walk, [[], ['cache', '*.tmp'], 3], ['tree', 'tree/conf', 'tree/conf/app.conf', 'tree/logs', 'tree/logs/app.log', 'tree/logs/app.txt', 'tree/readme.txt'], "Ensure excluded entries are skipped.")
+	res &= runTest(walk, [['logs/*', '*.conf'], ['cache'], 1], ['tree', 'tree/conf', 'tree/conf/app.conf', 'tree/logs', 'tree/logs/app.log', 'tree/logs/app.txt'], "Ensure only included files are walked.")
+
+	# Listings cached by one walk are reused by the next while directories are unchanged.
+	os.system('touch -d "1 minute ago" testdata/output/tree testdata/output/tree/*')
+	statCache = backuplib.StatCache('testdata/output/statcache')
+	walk([], [], 1, statCache)
+	statCache.save()
+	statCache = backuplib.StatCache('testdata/output/statcache')
+	res &= runTest(lambda: sorted(statCache.lookup('testdata/output/tree/logs', os.stat('testdata/output/tree/logs').st_mtime)), [], ['app.log', 'app.txt'], "Ensure directory listings are cached between runs.")
+	open('testdata/output/tree/logs/new.log', 'w').write('new')
+	res &= runTest(lambda: 'tree/logs/new.log' in walk([], [], 1, statCache), [], True, "Ensure changed directories are listed again.")
+
+	return res
+
+def testReadEntries():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/files')
+	for i in range(50):
+		open('testdata/output/files/file{0:02d}.txt'.format(i), 'w').write('x' * (i + 1))
+	open('testdata/output/files/large.bin', 'wb').write('y' * (backuplib.SMALL_FILE_SIZE + 1))
+	entries = list(backuplib.walkTree('testdata/output/files'))
+
+	# Read ahead with a budget that only fits a few files at a time.
+	res = True
+	results = list(backuplib.readEntries(iter(entries), 3, 100))
+	res &= runTest(lambda: sorted(entry.arcname for entry, data in results), [], sorted(entry.arcname for entry in entries), "Ensure every entry passes through read-ahead.")
+	res &= runTest(lambda: all(data == open(entry.path).read() for entry, data in results if entry.arcname.endswith('.txt')), [], True, "Ensure small files are read ahead.")
+	res &= runTest(lambda: [data for entry, data in results if not entry.arcname.endswith('.txt')], [], [None, None], "Ensure directories and large files are left to the archive writer.")
+	res &= runTest(lambda: [entry.stat.st_ino for entry, data in results] == sorted(entry.stat.st_ino for entry in entries), [], True, "Ensure entries are read in inode order.")
+
+	# Empty and large files take no read-ahead budget, but still mustn't pile up in memory.
+	os.system('rm -rf testdata/output/files')
+	os.system('mkdir -p testdata/output/files')
+	for i in range(40):
+		open('testdata/output/files/empty{0:02d}'.format(i), 'w').close()
+		open('testdata/output/files/large{0:02d}.bin'.format(i), 'wb').truncate(backuplib.SMALL_FILE_SIZE + 1)
+	entries = list(backuplib.walkTree('testdata/output/files'))
+	pulled = [0]
+	def countingEntries():
+		for entry in entries:
+			pulled[0] += 1
+			yield entry
+	batchSize = backuplib.READ_BATCH_SIZE
+	backuplib.READ_BATCH_SIZE = 4
+	pending = []
+	for count, (entry, data) in enumerate(backuplib.readEntries(countingEntries(), 3, 100)):
+		pending.append(pulled[0] - count)
+	backuplib.READ_BATCH_SIZE = batchSize
+	res &= runTest(lambda: (len(pending), max(pending) <= 2 * 4), [], (len(entries), True), "Ensure entries without read-ahead data are bounded in flight.")
+
+	return res
+
+def testDaemon():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/archives')
+	os.system('cp -r testdata/input/testfolder2 testdata/output/data')
+	configPath = 'testdata/output/config.xml'
+	template = """<?xml version="1.0"?>
+		<settings>
+			<output path="testdata/output/archives" />
+			<targets>
+				<target name="often" intervalMinutes="{0}"><folder path="testdata/output/data" /></target>
+				<target name="daily" intervalHours="24"><folder path="testdata/output/data" /></target>
+				<target name="broken" intervalMinutes="5"><folder path="testdata/output/data" /></target>
+			</targets>
+		</settings>"""
+	open(configPath, 'w').write(template.format(10))
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	# 'daily' last succeeded three days ago, so it is overdue and catches up with a single run.
+	backuplib.saveHistory('testdata/output/archives', {'daily': {'seconds': 1, 'bytesIn': 1, 'bytesOut': 1, 'lastSuccess': time.time() - 3 * 24 * 3600}})
+	daemon = backuplib.Daemon(configPath)
+	backupTarget = backuplib.backupTarget
+	def failingBackupTarget(config, target, outputDir, timestamp, metrics=backuplib.NO_METRICS, sharedBuckets=None, sharedContent=None):
+		if target.get('name') == 'broken':
+			raise IOError('disk on fire')
+		return backupTarget(config, target, outputDir, timestamp, metrics, sharedBuckets, sharedContent)
+	backuplib.backupTarget = failingBackupTarget
+
+	res = True
+	try:
+		start = time.time()
+		res &= runTest(lambda: sorted(daemon.runDue()), [], ['broken', 'daily', 'often'], "Ensure new and overdue targets run straight away.")
+		daemon.wait()
+		res &= runTest(lambda: len(glob.glob('testdata/output/archives/dailybackup*.tar.gz')), [], 1, "Ensure missed runs are caught up only once.")
+		res &= runTest(daemon.runDue, [], [], "Ensure nothing runs again before it is due.")
+
+		# The next runs are scheduled from each target's completion, failures retry sooner.
+		due = dict((name, when - start) for when, name in daemon.heap)
+		res &= runTest(lambda: (590 < due['often'] < 610, 86390 < due['daily'] < 86410, 290 < due['broken'] < 310), [], (True, True, True), "Ensure targets are rescheduled from their last run.")
+
+		# Reloading picks up the new interval without losing track of the last run.
+		open(configPath, 'w').write(template.format(30))
+		daemon.load()
+		due = dict((name, when - start) for when, name in daemon.heap)
+		res &= runTest(lambda: 1790 < due['often'] < 1810, [], True, "Ensure a reload reschedules targets with their new interval.")
+
+		# An invalid config is rejected on reload, keeping the old one.
+		open(configPath, 'w').write('<settings />')
+		daemon.load()
+		res &= runTest(lambda: len(daemon.config.targets), [], 3, "Ensure an invalid config is not loaded.")
+
+		# A slow target runs on its own while a fast one keeps being started on time.
+		open(configPath, 'w').write("""<?xml version="1.0"?>
+			<settings>
+				<output path="testdata/output/archives" />
+				<targets>
+					<target name="slow" intervalHours="24"><folder path="testdata/output/data" /></target>
+					<target name="fast" intervalMinutes="1"><folder path="testdata/output/data" /></target>
+				</targets>
+			</settings>""")
+		release = threading.Event()
+		def slowBackupTarget(config, target, outputDir, timestamp, metrics=backuplib.NO_METRICS, sharedBuckets=None, sharedContent=None):
+			if target.get('name') == 'slow':
+				release.wait(10)
+			return backupTarget(config, target, outputDir, timestamp, metrics, sharedBuckets, sharedContent)
+		backuplib.backupTarget = slowBackupTarget
+		daemon = backuplib.Daemon(configPath)
+		started = sorted(daemon.runDue())
+		deadline = time.time() + 10
+		while 'fast' in daemon.running and time.time() < deadline:
+			time.sleep(0.01)
+		rescheduled = sorted(name for due, name in daemon.heap)
+		daemon.heap = [(0, name) for due, name in daemon.heap] + [(0, 'slow')]
+		heapq.heapify(daemon.heap)
+		startedAgain = daemon.runDue()
+		slowRunning = 'slow' in daemon.running
+		release.set()
+		daemon.wait()
+		res &= runTest(lambda: (started, rescheduled, startedAgain, slowRunning), [], (['fast', 'slow'], ['fast'], ['fast'], True), "Ensure a slow target doesn't hold up others, nor run twice at once.")
+		res &= runTest(lambda: (sorted(name for due, name in daemon.heap), 'fast' in daemon.lastSuccess and 'slow' in daemon.lastSuccess), [], (['fast', 'slow'], True), "Ensure each target is rescheduled when its own run completes.")
+	finally:
+		backuplib.backupTarget = backupTarget
+		backuplib.log = log
+
+	return res
+
+def testIncrementalBackup():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/archives')
+	os.system('cp -r testdata/input/testfolder2 testdata/output/data')
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output/archives" />
+					<targets>
+						<target name="inc" intervalHours="1" incremental="true" fullEveryN="3">
+							<folder path="testdata/output/data" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+
+	def archiveMembers(pattern):
+		archives = glob.glob('testdata/output/archives/' + pattern)
+		if len(archives) != 1:
+			return None
+		tar = tarfile.open(archives[0], 'r:gz')
+		members = dict((member.name, tar.extractfile(member).read() if member.isreg() else None) for member in tar.getmembers())
+		tar.close()
+		os.remove(archives[0])
+		return members
+
+	# The first run is a full backup.
+	res = True
+	backuplib.doBackup(config)
+	res &= runTest(lambda: sorted(archiveMembers('incbackup*[0-9].tar.gz')), [], ['data', 'data/testfile3.txt', 'data/testfile4.txt'], "Ensure the first incremental run is a full backup.")
+
+	# The next run only picks up changes, plus a list of deleted files.
+	open('testdata/output/data/testfile3.txt', 'a').write('more data\n')
+	open('testdata/output/data/new.txt', 'w').write('new file\n')
+	os.remove('testdata/output/data/testfile4.txt')
+	backuplib.doBackup(config)
+	members = archiveMembers('incbackup*.incr.tar.gz')
+	res &= runTest(lambda: sorted(members), [], ['.goodbackup-deleted', 'data', 'data/new.txt', 'data/testfile3.txt'], "Ensure incremental runs only archive changes.")
+	res &= runTest(lambda: members['.goodbackup-deleted'], [], 'data/testfile4.txt\n', "Ensure incremental runs record deletions.")
+
+	# With nothing changed, the incremental archive is empty.
+	backuplib.doBackup(config)
+	res &= runTest(lambda: sorted(archiveMembers('incbackup*.incr.tar.gz')), [], [], "Ensure unchanged files are skipped.")
+
+	# Every third run is a full backup again.
+	backuplib.doBackup(config)
+	res &= runTest(lambda: sorted(archiveMembers('incbackup*[0-9].tar.gz')), [], ['data', 'data/new.txt', 'data/testfile3.txt'], "Ensure full backups recur every fullEveryN runs.")
+
+	backuplib.log = log
+	return res
+
+def testRetention():
+	# Hourly archives over three days, as catalog rows (name, time, size, kind, chain), newest first.
+	start = time.mktime((2017, 6, 1, 0, 0, 0, 0, 0, -1))
+	hourly = [('a{0:02d}'.format(hour), start + hour * 3600, 1, 'full', 'a{0:02d}'.format(hour)) for hour in range(72)]
+	hourly.reverse()
+	res = True
+	res &= runTest(lambda: sorted(backuplib.selectRetained(hourly, {'keepDaily': 3})), [], ['a23', 'a47', 'a71'], "Ensure daily retention keeps the newest archive of each day.")
+	res &= runTest(lambda: sorted(backuplib.selectRetained(hourly, {'keepLast': 2, 'keepHourly': 3, 'keepDaily': 2})), [], ['a47', 'a69', 'a70', 'a71'], "Ensure retention rules combine.")
+	res &= runTest(lambda: sorted(backuplib.selectRetained(hourly, {})), [], ['a71'], "Ensure the newest archive is always kept.")
+
+	# Keeping an incremental archive keeps the full backup and incrementals it builds on.
+	chains = [
+		('i3', 5, 1, 'incr', 'f2'),
+		('f2', 4, 1, 'full', 'f2'),
+		('i2', 3, 1, 'incr', 'f1'),
+		('i1', 2, 1, 'incr', 'f1'),
+		('f1', 1, 1, 'full', 'f1'),
+	]
+	res &= runTest(lambda: sorted(backuplib.selectRetained(chains, {'keepLast': 1})), [], ['f2', 'i3'], "Ensure the base of a kept incremental is kept.")
+	res &= runTest(lambda: sorted(backuplib.selectRetained(chains, {'keepLast': 4})), [], ['f1', 'f2', 'i1', 'i2', 'i3'], "Ensure whole incremental chains are kept.")
+
+	# Archives from before the catalog existed are adopted, then pruned along with newer ones.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+	for name in ['appbackup2017-06-01.00-00-00.000000.tar.gz', 'appbackup2017-06-02.00-00-00.000000.tar.gz', 'otherbackup2017-06-01.00-00-00.000000.tar.gz']:
+		open('testdata/output/' + name, 'w').write('old archive')
+	open('testdata/output/appbackup2017-06-02.00-00-00.000000.tar.gz.idx', 'w').write('old index')
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output" />
+					<targets>
+						<target name="app" intervalHours="1" keepLast="2">
+							<file path="testdata/input/testfile1.txt" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+	backuplib.doBackup(config)
+	backuplib.doBackup(config)
+	backuplib.log = log
+	catalog = backuplib.Catalog('testdata/output')
+	res &= runTest(lambda: len(catalog.archives('app')), [], 2, "Ensure pruned archives leave the catalog.")
+	res &= runTest(lambda: len(catalog.archives('other')), [], 1, "Ensure other targets are left alone.")
+	res &= runTest(lambda: all(row[2] > 0 for row in catalog.archives('app')), [], True, "Ensure the catalog records archive sizes.")
+	catalog.close()
+	res &= runTest(lambda: sorted(name[:21] for name in os.listdir('testdata/output') if name.startswith('appbackup2017')), [], [], "Ensure pruned archives and their indexes are deleted.")
+	res &= runTest(lambda: len(glob.glob('testdata/output/appbackup*.tar.gz')), [], 2, "Ensure retained archives are kept.")
+
+	return res
+
+def testRepository():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir -p testdata/output/archives')
+	os.system('cp -r testdata/input/testfolder2 testdata/output/data')
+	open('testdata/output/data/random.bin', 'wb').write(os.urandom(2 * 1024 * 1024))
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output/archives" format="repository" />
+					<targets>
+						<target name="repo" intervalHours="1">
+							<folder path="testdata/output/data" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+	repository = backuplib.openRepository('testdata/output/archives/repository')
+
+	def chunkCount():
+		return repository.db.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+	# Back up the same data twice; the second snapshot should add no chunks.
+	res = True
+	backuplib.doBackup(config)
+	firstCount = chunkCount()
+	backuplib.doBackup(config)
+	res &= runTest(chunkCount, [], firstCount, "Ensure unchanged data is stored only once.")
+
+	# Insert data at the front of the big file; only the chunks around the edit should change.
+	data = open('testdata/output/data/random.bin', 'rb').read()
+	open('testdata/output/data/random.bin', 'wb').write('inserted' + data)
+	backuplib.doBackup(config)
+	editedCount = chunkCount()
+	res &= runTest(lambda: editedCount - firstCount <= 2, [], True, "Ensure insertions only add the chunks around them.")
+
+	# Drop the first two snapshots and collect their orphaned chunks.
+	snapshots = repository.listSnapshots()
+	res &= runTest(len, [snapshots], 3, "Ensure each run writes a snapshot.")
+	for name in snapshots[:2]:
+		repository.forgetSnapshot(name)
+	removedChunks, freedBytes = repository.collectGarbage()
+	res &= runTest(lambda: removedChunks > 0 and chunkCount() == editedCount - removedChunks, [], True, "Ensure garbage collection removes unreferenced chunks.")
+
+	# The remaining snapshot should still restore intact.
+	backuplib.restoreSnapshot(repository, snapshots[2], 'testdata/output/restored')
+	res &= compareFiles('testdata/output/data/random.bin', 'testdata/output/restored/data/random.bin')
+	res &= compareFiles('testdata/input/testfolder2/testfile3.txt', 'testdata/output/restored/data/testfile3.txt')
+
+	# A taken pack number is skipped, but any other error must not be retried on the next number.
+	taken = repository.packPath(int(sorted(os.listdir('testdata/output/archives/repository/packs'))[-1].split('.')[0]) + 1)
+	open(taken, 'wb').close()
+	repository.newPack()
+	res &= runTest(lambda: repository.packNumber, [], int(os.path.basename(taken).split('.')[0]) + 1, "Ensure new packs skip numbers already taken.")
+	osOpen = os.open
+	def fullOpen(path, flags, mode=0777):
+		raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+	os.open = fullOpen
+	try:
+		repository.newPack()
+		newPackError = None
+	except OSError as e:
+		newPackError = e.errno
+	os.open = osOpen
+	res &= runTest(lambda: newPackError, [], errno.ENOSPC, "Ensure new packs give up on errors other than a taken number.")
+
+	# Two processes writing to the repository at once neither block each other nor clash on a
+	# chunk both store.
+	first = backuplib.Repository('testdata/output/archives/repository')
+	second = backuplib.Repository('testdata/output/archives/repository')
+	batchChunks = backuplib.INDEX_BATCH_CHUNKS
+	backuplib.INDEX_BATCH_CHUNKS = 3
+	chunks = [os.urandom(100) for i in range(8)]
+	for i, chunk in enumerate(chunks):
+		first.storeChunk(hashlib.sha256(chunk).hexdigest(), zlib.compress(chunk), len(chunk))
+		second.storeChunk(hashlib.sha256(chunks[-1 - i]).hexdigest(), zlib.compress(chunks[-1 - i]), len(chunk))
+	first.commit()
+	second.commit()
+	backuplib.INDEX_BATCH_CHUNKS = batchChunks
+	res &= runTest(lambda: [first.readChunk(hashlib.sha256(chunk).hexdigest()) == chunk for chunk in chunks], [], [True] * 8, "Ensure concurrent writers index their chunks in short batches.")
+
+	backuplib.log = log
+	return res
+
+def testMetrics():
+	# Prepare filesystem.
+	os.system('rm -rf testdata/output')
+	os.system('mkdir testdata/output')
+	config = backuplib.compileConfig(ET.fromstring("""<?xml version="1.0"?>
+				<settings>
+					<output path="testdata/output" metrics="true" />
+					<credentials>
+						<credential name="database" username="user" password="pass" />
+					</credentials>
+					<targets>
+						<target name="app1" intervalHours="1">
+							<folder path="testdata/input/testfolder2" />
+							<folder path="testdata/input/missing" />
+							<database name="testapp1" credential="database" />
+						</target>
+						<target name="quiet" intervalHours="1" metrics="false">
+							<file path="testdata/input/testfile1.txt" />
+						</target>
+					</targets>
+				</settings>"""))
+	log = backuplib.log
+	backuplib.log = mockLog
+	useFakeTools()
+	backuplib.doBackup(config)
+	backuplib.doBackup(config)
+	backuplib.log = log
+
+	# Every run of an instrumented target is appended as one JSON line.
+	records = [json.loads(line) for line in open('testdata/output/goodbackup-metrics.jsonl')]
+	res = True
+	res &= runTest(lambda: [record['target'] for record in records], [], ['app1', 'app1'], "Ensure only instrumented targets emit metrics.")
+	res &= runTest(lambda: sorted(records[0]['phases']), [], ['archive', 'cleanup', 'compress', 'dump', 'enumerate'], "Ensure every phase is timed.")
+	res &= runTest(lambda: (records[0]['files'], records[0]['databases'], records[0]['errors'], records[0]['success']), [], (3, 1, 1, True), "Ensure file, database and error counts are recorded.")
+	res &= runTest(lambda: records[0]['dumpBytes'] == os.path.getsize('testdata/input/testapp1.sql') and records[0]['compressionRatio'] > 0, [], True, "Ensure dump size and compression ratio are recorded.")
+
+	# The Prometheus textfile holds the latest values.
+	prom = open('testdata/output/goodbackup.prom').read()
+	res &= runTest(lambda: 'goodbackup_target_success{target="app1"} 1.0' in prom and 'goodbackup_target_phase_seconds{target="app1",phase="dump"}' in prom, [], True, "Ensure a Prometheus textfile is written.")
+	res &= runTest(lambda: 'quiet' in prom, [], False, "Ensure uninstrumented targets are left out of the textfile.")
+
+	return res
+
 def testBackup():
 	# Prepare filesystem.
 	os.system('rm -rf testdata/output')
@@ -282,25 +1591,23 @@ def testBackup():
 							<folder path="testdata/input/testfolder2" />
 							<database name="testapp1" credential="database" />
 						</target>
-						<target name="testapp2" intervalHours="1">
+						<target name="testapp2" intervalHours="1" compressionWorkers="2" compressionBlockSize="4096">
 							<file path="testdata/input/testfolder1/testfile2.txt" />
 							<database name="testapp2" credential="database" />
 						</target>
 					</targets>
 				</settings>"""
 
-	# Mock out the MySQL dump routine and logging statements.
-	dumpDatabase = backuplib.dumpDatabase
+	# Mock out logging statements, and use the fake mysqldump.
 	log = backuplib.log
-	backuplib.dumpDatabase = mockDumpDatabase
 	backuplib.log = mockLog
+	useFakeTools()
 
 	# Do backup.
-	backuplib.doBackup(ET.fromstring(config))
+	backuplib.doBackup(backuplib.compileConfig(ET.fromstring(config)))
 	
 	# Restore the mocked helper functions.
 	backuplib.log = log
-	backuplib.dumpDatabase = dumpDatabase
 	
 	# Verify output for testapp1.
 	res = True
@@ -317,6 +1624,9 @@ def testBackup():
 	res &= compareFiles('testdata/input/testfolder1/testfile2.txt', 'testdata/output/testapp2/testfile2.txt')
 	res &= compareFiles('testdata/input/testapp2.sql', 'testdata/output/testapp2/testapp2.*.sql')
 
+	# Database dumps should never be written to the output directory.
+	res &= runTest(glob.glob, ['testdata/output/*.sql'], [], "Ensure no temporary dump files are left behind.")
+
 	return res
 
 #
@@ -333,6 +1643,30 @@ def runAllTests():
 		(testValidateAttributeReference, "Test attribute references helper"),
 		(testValidateTopLevelXml, "Test validating top-level XML"),
 		(testValidateInnerXml, "Test validating inner XML"),
+		(testLoadConfig, "Test compiled config model"),
+		(testConfigCache, "Test compiled config cache"),
+		(testArchiveWriter, "Test streaming archive writer"),
+		(testArchiveStream, "Test streaming unsized archive members"),
+		(testArchiveIndex, "Test indexed random-access archives"),
+		(testVerify, "Test archive verification"),
+		(testThrottling, "Test I/O throttling"),
+		(testEncryption, "Test archive encryption"),
+		(testS3Storage, "Test object storage uploads"),
+		(testResume, "Test resuming interrupted backups"),
+		(testSharedContent, "Test sharing content between targets"),
+		(testPlan, "Test backup planning"),
+		(testSnapshots, "Test folder snapshots"),
+		(testSparseFiles, "Test sparse file archiving"),
+		(testParallelTableDump, "Test parallel per-table database dumps"),
+		(testBlockCompressWriter, "Test parallel block compression"),
+		(testRunJobs, "Test concurrent job scheduler"),
+		(testWalkTree, "Test parallel filesystem walker"),
+		(testReadEntries, "Test read-ahead ingestion"),
+		(testDaemon, "Test backup daemon scheduling"),
+		(testIncrementalBackup, "Test incremental backups"),
+		(testRetention, "Test retention and pruning"),
+		(testRepository, "Test deduplicating repository"),
+		(testMetrics, "Test backup metrics export"),
 		(testBackup, "Test end-to-end backup process")
 	]
 
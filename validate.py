@@ -2,7 +2,6 @@
 
 import os
 import sys
-import xml.etree.ElementTree as ET
 import backuplib
 
 def usageMsg():
@@ -24,12 +23,16 @@ def main(argv):
 		return
 	
 	# Validate configuration file.
-	tree = ET.parse(parsedArgs[0])
-	root = tree.getroot()
-	print 'Configuration file is valid. {0} backup targets detected.'.format(len(root.findall('./targets/target'))) if backuplib.validateConfig(root) else 'Error - configuration file failed schema validation.'
+	config = backuplib.loadConfig(parsedArgs[0])
+	if not config.isValid():
+		print 'Error - configuration file failed schema validation:'
+		for error in config.errors:
+			print '  ' + error
+		return
+	print 'Configuration file is valid. {0} backup targets detected.'.format(len(config.targets))
 
 	# Check backup directory existence.
-	if not os.path.isdir(root.find('./output').get('path')):
-		print 'Warning: backup directory doesn\'t exist: {0}. Please create it before installing.'.format(root.find('./output').get('path'))
+	if not os.path.isdir(config.output.get('path')):
+		print 'Warning: backup directory doesn\'t exist: {0}. Please create it before installing.'.format(config.output.get('path'))
 	
 main(sys.argv)
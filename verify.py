@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+import os
+import sys
+import multiprocessing
+import backuplib
+
+def usageMsg():
+	print 'verify.py - GoodBackup archive verification utility'
+	print 'Usage: verify.py <path-to-config-file> [<path-to-archive> ...]'
+	print '       (with no archives given, every archive in the catalog is verified)'
+	print
+
+def parseArgs(argv):
+	parsedArgs = None
+	if len(argv) >= 2 and argv[1] not in ['--h', '-?', '/?', '--help']:
+		parsedArgs = [argv[1], argv[2:]]
+	return parsedArgs
+
+def main(argv):
+	# Read cmd arguments.
+	parsedArgs = parseArgs(argv)
+	if parsedArgs is None:
+		usageMsg()
+		return
+
+	# Read configuration file.
+	config = backuplib.loadConfig(parsedArgs[0])
+	if not config.isValid():
+		print 'Invalid configuration file.'
+		return
+	outputDir = config.output.get('path')
+
+	# Default to every archive the catalog knows about, each with its target's key. Archives
+	# named on the command line are decrypted with the key set on <output>.
+	paths = parsedArgs[1]
+	keys = {}
+	if len(paths) == 0:
+		catalog = backuplib.Catalog(outputDir)
+		for target in config.targets:
+			keyPath = backuplib.getSetting(config, target, 'encryptionKey')
+			for row in catalog.archives(target.get('name')):
+				if row[3] != 'snapshot':
+					paths.append(os.path.join(outputDir, row[0]))
+					keys[paths[-1]] = backuplib.loadEncryptionKey(keyPath) if keyPath is not None else None
+		catalog.close()
+	elif config.output.get('encryptionKey') is not None:
+		key = backuplib.loadEncryptionKey(config.output.get('encryptionKey'))
+		keys = dict((path, key) for path in paths)
+
+	# Check archives in parallel, within the configured read rate.
+	workers = int(config.output.get('verifyWorkers', multiprocessing.cpu_count()))
+	bytesPerSecond = int(config.output.get('verifyBytesPerSecond', 0)) or None
+	failures = 0
+	for path, problems in backuplib.verifyArchives(paths, workers, bytesPerSecond, keys):
+		print '{0}: {1}'.format(path, 'OK' if len(problems) == 0 else 'FAILED')
+		for problem in problems:
+			print '  ' + problem
+		failures += 1 if len(problems) > 0 else 0
+	print 'Verified {0} archives, {1} failed.'.format(len(paths), failures)
+	if failures > 0:
+		sys.exit(1)
+
+main(sys.argv)